@@ -1,49 +1,63 @@
 import os
 import json
-import httpx
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import JSONResponse
 from pydantic import RootModel
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
+
+import cbu_rates
+import listings
+import pipeline
+import pricing
+import prompts
+import reasons
+import valuation_cache
+from llm_clients import get_llm
 
 router = APIRouter()
 
 # Load environment variables
 load_dotenv()
-API_KEY = os.getenv("OPENAI_API_KEY")
 
-if not API_KEY:
-    raise RuntimeError("OPENAI_API_KEY is not set")
+# Static prompts (cacheable prefix); the exchange rate is sent in the trailing parameters message
+SEARCH_PROMPT = prompts.register("avto.search", """Siz internet qidiruv agentisiz. Vazifa — kiritilgan avtomobil ma’lumotlari asosida O‘zbekiston internetidagi e’lon saytlaridan eng o‘xshash e’lonlarni topish. FAQAT JSON FORMATIDA CHIQARING.""")
+
+VALUATION_PROMPT = prompts.register("avto.valuation", """Siz O‘zbekiston bozorida avtomobil narxini aniqlaydigan ekspert agentsiz. 
+    Vazifa: mashinaning bozor narxini aniqlash. Kurs: oxirgi xabardagi "usd_rate" parametri. 
+    Depresatsiya: har yil farqi uchun 2%.
+    CHIQISH FAQAT JSON: 
+    {
+      "estimated_min_price": <number_uzs>, 
+      "estimated_max_price": <number_uzs>, 
+      "reason": "<HTML, oxirgi xabardagi "language" parametridagi tilda>"
+    }""")
+
+# Comparable listings shown to the model (and kept for the explanation)
+LISTINGS_IN_PROMPT = 10
+
+# reasons language -> response field
+REASON_FIELDS = {"uz": "reason_uz", "cyrl": "reason_uz_kiril", "ru": "reason_ru", "en": "reason_en"}
 
 class WebhookRequest(RootModel):
     root: Dict[str, Any]
 
-async def get_usd_rate() -> float:
-    url = "https://cbu.uz/uz/arkhiv-kursov-valyut/json/"
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-            for item in data:
-                if item.get("Ccy") == "USD":
-                    return float(item.get("Rate", 0))
-    except Exception as e:
-        print(f"Error fetching exchange rate: {e}")
-    return 12850.0
 
 @router.post("/webhook/avto")
-async def handle_avto(payload: WebhookRequest):
+async def handle_avto(payload: WebhookRequest, language: str | None = Query(None)):
     raw_payload = payload.root
     
     if isinstance(raw_payload, list):
         body = raw_payload[0] if raw_payload else {}
     else:
         body = raw_payload.get("body") if isinstance(raw_payload.get("body"), dict) else raw_payload
-    
+
+    # Only the requested explanation is generated (uz by default); "all" fans out concurrently
+    language = reasons.normalize_language(language or body.get("language"))
+    return JSONResponse(content=await value_avto(body, language))
+
+async def value_avto(body: Dict[str, Any], language: str) -> Dict[str, Any]:
+    """One vehicle valuation (shared by the webhook and the batch endpoint)."""
     model = body.get("MODEL", "---")
     color = body.get("COLOR", "---")
     year = body.get("YEAR", "---")
@@ -51,42 +65,115 @@ async def handle_avto(payload: WebhookRequest):
     shassi = body.get("SHASSI", "---")
     kuzov = body.get("KUZOV", "---")
 
-    llm = ChatOpenAI(model="gpt-4o", api_key=API_KEY, temperature=0.3)
+    llm = get_llm("gpt-4o", 0.3)
+
+    # What the explanation may say about this car (chassis, body, colour); never shared between requests
+    car_info = f"Car Info: {json.dumps(body)}"
+
+    # 0. Already valued (same fingerprint): reused, rescaled to the current USD rate if it moved
+    fingerprint = valuation_cache.vehicle_fingerprint(body)
+    cached = await valuation_cache.lookup("avto", fingerprint, car_info, body.get("rateDate"))
+    if cached is not None:
+        valuation_id, result = cached
+        try:
+            texts = await reasons.get_reasons(valuation_id, "avto", language)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return {"valuation_id": valuation_id, **result, **{REASON_FIELDS[lang]: text for lang, text in texts.items()}}
+
+    # 1. Local comparables (same model, nearby model years)
+    async def comparables() -> Optional[Dict[str, Any]]:
+        return await listings.find_vehicle_comparables(model, year, listings.vehicle_engine(body))
 
-    # 1. Search Agent
-    search_system_prompt = """Siz internet qidiruv agentisiz. Vazifa — kiritilgan avtomobil ma’lumotlari asosida O‘zbekiston internetidagi e’lon saytlaridan eng o‘xshash e’lonlarni topish. FAQAT JSON FORMATIDA CHIQARING."""
+    # 2. Search Agent, only when the local dump has nothing for this model
     search_user_message = f"Model: {model}, Year: {year}, Color: {color}, Motor: {motor}, Shassi: {shassi}, Kuzov: {kuzov}"
 
-    try:
-        search_result = llm.invoke([SystemMessage(content=search_system_prompt), HumanMessage(content=search_user_message)])
+    async def search(comparables: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if comparables is not None:
+            rows = comparables["rows"].head(LISTINGS_IN_PROMPT).to_dict("records")
+            return {"status": "ok", "source": "local_listings", "listings": rows}
+
+        search_result = await prompts.ainvoke(llm, "avto.search", search_user_message)
         stext = search_result.content.strip()
         if "```json" in stext: stext = stext.split("```json")[1].split("```")[0].strip()
-        market_data = json.loads(stext)
-    except: market_data = {"status": "no_listing_found", "listings": []}
+        return json.loads(stext)
 
-    # 2. Rate
-    usd_rate = await get_usd_rate()
+    # 3. Rate (doesn't depend on the search, so it runs alongside it)
+    async def rate() -> float:
+        return await cbu_rates.get_usd_rate(body.get("rateDate"))
 
-    # 3. Valuation Agent
-    val_system_prompt = f"""Siz O‘zbekiston bozorida avtomobil narxini aniqlaydigan ekspert agentsiz. 
-    Vazifa: mashinaning bozor narxini aniqlash. Kurs: {usd_rate}. 
-    Depresatsiya: har yil farqi uchun 2%.
-    CHIQISH FAQAT JSON: 
-    {{
-      "estimated_min_price": <number_uzs>, 
-      "estimated_max_price": <number_uzs>, 
-      "reason_uz": "<HTML>", 
-      "reason_uz_kiril": "<HTML>", 
-      "reason_ru": "<HTML>", 
-      "reason_en": "<HTML>"
-    }}"""
-    
-    val_user_msg = f"Car Info: {json.dumps(body)}, Listings: {json.dumps(market_data)}"
+    # 4. Valuation: computed from the comparables when there are enough, Valuation Agent otherwise
+    async def valuation(comparables: Optional[Dict[str, Any]], search: Dict[str, Any], rate: float) -> Tuple[str, Dict[str, Any]]:
+        val_user_msg = f"{car_info}, Listings: {json.dumps(search, default=str)}"
+        priced = None
+        if comparables is not None:
+            priced = pricing.price_range(comparables["prices_usd"], comparables["years"], year, rate)
+
+        if priced is not None:
+            result = {
+                "estimated_min_price": priced["estimated_min_price"],
+                "estimated_max_price": priced["estimated_max_price"],
+            }
+            reason = None
+        else:
+            val_result = await prompts.ainvoke(
+                llm, "avto.valuation", val_user_msg,
+                {"usd_rate": rate, "language": reasons.LANGUAGES[reasons.model_language(language)]},
+            )
+            vtext = val_result.content.strip()
+            if "```json" in vtext: vtext = vtext.split("```json")[1].split("```")[0].strip()
+            result = json.loads(vtext)
+            reason = result.pop("reason", None)
+
+        valuation_id = await reasons.new_valuation(
+            "avto",
+            {
+                "input": car_info,
+                # Kept apart from the input text so a cached valuation can reuse them for another car
+                # and move the figures to a new rate
+                "listings": search,
+                "pricing": priced,
+                "usd_rate": rate,
+                "estimated_min_price": result.get("estimated_min_price"),
+                "estimated_max_price": result.get("estimated_max_price"),
+            },
+            reason,
+            reasons.model_language(language),
+        )
+        return valuation_id, result
+
+    # 5. Explanations in the requested language(s); the only LLM work when pricing was local
+    async def explain(valuation: Tuple[str, Dict[str, Any]]) -> Dict[str, str]:
+        return await reasons.get_reasons(valuation[0], "avto", language)
+
+    try:
+        results = await pipeline.run("avto", [
+            pipeline.Stage("comparables", comparables, fallback=None),
+            pipeline.Stage("search", search, deps=("comparables",), timeout=pipeline.SEARCH_TIMEOUT,
+                           fallback=lambda e: {"status": "no_listing_found", "listings": []}),
+            pipeline.Stage("rate", rate, timeout=pipeline.RATE_TIMEOUT, fallback=lambda e: cbu_rates.get_rate("USD")),
+            pipeline.Stage("valuation", valuation, deps=("comparables", "search", "rate"), timeout=pipeline.LLM_TIMEOUT),
+            pipeline.Stage("explain", explain, deps=("valuation",), timeout=pipeline.LLM_TIMEOUT),
+        ])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    valuation_id, result = results["valuation"]
+    await valuation_cache.store("avto", fingerprint, valuation_id, result, body.get("rateDate"))
+    return {"valuation_id": valuation_id, **result, **{REASON_FIELDS[lang]: text for lang, text in results["explain"].items()}}
 
+@router.get("/webhook/avto/{valuation_id}/reason")
+async def avto_reason(valuation_id: str, language: str = Query("uz")):
+    """Explanation of an earlier valuation in another language, generated once and cached."""
+    language = reasons.normalize_language(language)
     try:
-        val_result = llm.invoke([SystemMessage(content=val_system_prompt), HumanMessage(content=val_user_msg)])
-        vtext = val_result.content.strip()
-        if "```json" in vtext: vtext = vtext.split("```json")[1].split("```")[0].strip()
-        return JSONResponse(content=json.loads(vtext))
+        texts = await reasons.get_reasons(valuation_id, "avto", language)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return JSONResponse(content={"valuation_id": valuation_id, **{REASON_FIELDS[lang]: text for lang, text in texts.items()}})
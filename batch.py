@@ -0,0 +1,273 @@
+import os
+import io
+import csv
+import json
+import time
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+import avto
+import listings
+import llm_clients
+import reasons
+import spreadsheet
+import uy_joy
+
+router = APIRouter()
+
+# Load environment variables
+load_dotenv()
+
+# Portfolio re-valuation: NDJSON or CSV in, NDJSON out as each item finishes.
+# A valuation keeps up to ~4 LLM calls in flight (with language=all), so the default
+# concurrency keeps every batch running on the server inside the shared connection pool.
+CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", str(max(1, llm_clients.MAX_CONNECTIONS // 4))))
+MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+
+# Shared by all batch requests, so two portfolios at once don't double the LLM load
+_semaphore = asyncio.Semaphore(CONCURRENCY)
+
+_counters = {"batches": 0, "items": 0, "valuations": 0, "duplicates": 0, "errors": 0, "in_flight": 0}
+
+# (position, body, error): position is {"index": line/row of the input}, plus "vehicle" for
+# the vehicles of an application line that lists several
+Record = Tuple[Dict[str, int], Optional[Dict[str, Any]], Optional[str]]
+
+BATCH_EXTENSIONS = (".csv", ".ndjson", ".jsonl", ".json", ".txt")
+
+# --- Input ---
+def _cell(value: str) -> Any:
+    """CSV cells: numbers become numbers, blanks are dropped by the caller."""
+    text = value.strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+def parse_csv(text: str) -> List[Record]:
+    """One record per row; dotted headers ("area.actualLandArea") become nested objects."""
+    records: List[Record] = []
+    for index, row in enumerate(csv.DictReader(io.StringIO(text))):
+        record: Dict[str, Any] = {}
+        for column, value in row.items():
+            if not column or value is None or not value.strip():
+                continue
+            *parents, leaf = column.strip().split(".")
+            target = record
+            for part in parents:
+                target = target.setdefault(part, {})
+            target[leaf] = _cell(value)
+        records.append(({"index": index}, record, None))
+    return records
+
+def parse_ndjson(text: str) -> List[Record]:
+    """One JSON object per line; a bad line becomes an error item instead of failing the batch."""
+    records: List[Record] = []
+    index = 0
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("expected a JSON object")
+            records.append(({"index": index}, record, None))
+        except ValueError as e:
+            records.append(({"index": index}, None, f"Invalid JSON line: {e}"))
+        index += 1
+    return records
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as fh:
+        return fh.read()
+
+async def read_body(request: Request) -> bytes:
+    """The raw request body, stopped with 413 as soon as it crosses MAX_UPLOAD_BYTES."""
+    spreadsheet.check_content_length(request.headers.get("content-length"))
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > spreadsheet.MAX_UPLOAD_BYTES:
+            raise spreadsheet.too_large()
+    return bytes(data)
+
+async def read_records(request: Request) -> List[Record]:
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        # Same streamed, size-limited reader as the forma uploads
+        with await spreadsheet.receive_upload(request, extensions=BATCH_EXTENSIONS) as upload:
+            data = upload.content if upload.path is None else await asyncio.to_thread(_read_file, upload.path)
+        is_csv = upload.filename.endswith(".csv")
+    else:
+        data = await read_body(request)
+        is_csv = "csv" in content_type
+
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Batch input must be UTF-8 encoded.")
+    records = parse_csv(text) if is_csv else parse_ndjson(text)
+    if not records:
+        raise HTTPException(status_code=400, detail="Batch is empty.")
+    if len(records) > MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch is too large. Maximum is {MAX_ITEMS} items.")
+    return records
+
+# --- Vehicles ---
+VEHICLE_FIELDS = ("MODEL", "COLOR", "YEAR", "MOTOR", "SHASSI", "KUZOV", "ENGINE")
+
+def expand_vehicles(records: List[Record]) -> List[Record]:
+    """Accepts /webhook/avto bodies as well as raw carDataObject items (lowercase keys);
+    a whole application line with taxObjects.carDataObject expands to its vehicles."""
+    out: List[Record] = []
+    for position, record, error in records:
+        if record is None:
+            out.append((position, None, error))
+            continue
+        record = record.get("body") if isinstance(record.get("body"), dict) else record
+        cars = (record.get("taxObjects") or {}).get("carDataObject")
+        if not isinstance(cars, list):
+            out.append((position, _vehicle(record), None))
+            continue
+        # Results keep the caller's line index; "vehicle" tells the line's vehicles apart
+        for n, car in enumerate(cars):
+            out.append(({**position, "vehicle": n}, _vehicle(car or {}), None))
+    return out
+
+def _vehicle(car: Dict[str, Any]) -> Dict[str, Any]:
+    return {(k.upper() if k.upper() in VEHICLE_FIELDS else k): v for k, v in car.items()}
+
+def _present(value: Any) -> str:
+    text = str(value or "").strip().upper()
+    return "" if text in ("", "---", "-") else text
+
+def vehicle_key(body: Dict[str, Any]) -> Hashable:
+    # Body (VIN) or chassis number identifies the vehicle; model/year/engine number otherwise
+    vin = _present(body.get("KUZOV")) or _present(body.get("SHASSI"))
+    if vin:
+        return ("vin", vin)
+    return (listings.normalize_model(body.get("MODEL")), str(body.get("YEAR")), _present(body.get("MOTOR")))
+
+# --- Properties ---
+def expand_properties(records: List[Record]) -> List[Record]:
+    return [
+        (position, record.get("body") if record is not None and isinstance(record.get("body"), dict) else record, error)
+        for position, record, error in records
+    ]
+
+def property_key(body: Dict[str, Any]) -> Hashable:
+    def coord(value: Any) -> Optional[float]:
+        try:
+            return round(float(value), 5)
+        except (TypeError, ValueError):
+            return None
+    return (
+        " ".join(str(body.get("address") or "").lower().split()),
+        str((body.get("area") or {}).get("actualLandArea")),
+        body.get("type"),
+        coord(body.get("latitude")),
+        coord(body.get("longitude")),
+    )
+
+# --- Runner ---
+async def run_batch(
+    records: List[Record],
+    value: Callable[[Dict[str, Any], str], Awaitable[Dict[str, Any]]],
+    key: Callable[[Dict[str, Any]], Hashable],
+    language: str,
+) -> AsyncIterator[str]:
+    """Values each distinct item once and yields NDJSON lines in completion order;
+    duplicates get the same result with "duplicate_of" pointing at the first occurrence."""
+    start = time.perf_counter()
+    # Items by dedup key, as positions in `records`
+    groups: Dict[Hashable, List[int]] = {}
+    bodies: Dict[Hashable, Dict[str, Any]] = {}
+    counts = {"items": len(records), "valuations": 0, "duplicates": 0, "errors": 0}
+
+    def line(n: int, outcome: Dict[str, Any], first: Optional[int] = None) -> str:
+        item = {**records[n][0], **outcome}
+        if first is not None and first != n:
+            item["duplicate_of"] = records[first][0]["index"]
+            if "vehicle" in records[first][0]:
+                item["duplicate_of_vehicle"] = records[first][0]["vehicle"]
+        if outcome["status"] != "ok":
+            counts["errors"] += 1
+        return json.dumps(item, ensure_ascii=False) + "\n"
+
+    invalid = []
+    for n, (_, body, error) in enumerate(records):
+        if body is None:
+            invalid.append((n, error))
+            continue
+        k = key(body)
+        groups.setdefault(k, []).append(n)
+        bodies.setdefault(k, body)
+    counts["valuations"] = len(groups)
+    counts["duplicates"] = len(records) - len(invalid) - len(groups)
+
+    async def one(k: Hashable) -> Tuple[Hashable, Dict[str, Any]]:
+        async with _semaphore:
+            _counters["in_flight"] += 1
+            try:
+                return k, {"status": "ok", "result": await value(bodies[k], language)}
+            except HTTPException as e:
+                return k, {"status": "error", "error": e.detail}
+            except Exception as e:
+                return k, {"status": "error", "error": str(e)}
+            finally:
+                _counters["in_flight"] -= 1
+
+    # A fixed set of workers takes keys one at a time, so a large batch never has more than
+    # CONCURRENCY valuations (or finished results the client hasn't read) alive at once
+    pending = iter(groups)
+    results: "asyncio.Queue[Tuple[Hashable, Dict[str, Any]]]" = asyncio.Queue(maxsize=CONCURRENCY)
+
+    async def worker() -> None:
+        for k in pending:
+            await results.put(await one(k))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(CONCURRENCY, len(groups)))]
+    try:
+        for n, error in invalid:
+            yield line(n, {"status": "error", "error": error})
+        for _ in range(len(groups)):
+            k, outcome = await results.get()
+            first = groups[k][0]
+            for n in groups[k]:
+                yield line(n, outcome, first)
+        yield json.dumps({"summary": {**counts, "elapsed_ms": round((time.perf_counter() - start) * 1000)}}) + "\n"
+    finally:
+        # Client went away: don't keep valuing a portfolio nobody reads
+        for task in workers:
+            task.cancel()
+        _counters["batches"] += 1
+        for name in ("items", "valuations", "duplicates", "errors"):
+            _counters[name] += counts[name]
+
+def _stream(lines: AsyncIterator[str]) -> StreamingResponse:
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@router.post("/webhook/avto/batch")
+async def avto_batch(request: Request, language: str = Query("uz")):
+    """Vehicles as NDJSON (or a CSV upload with MODEL, YEAR, MOTOR, ... columns)."""
+    language = reasons.normalize_language(language)
+    records = expand_vehicles(await read_records(request))
+    return _stream(run_batch(records, avto.value_avto, vehicle_key, language))
+
+@router.post("/webhook/uy-joy/batch")
+async def uy_joy_batch(request: Request, language: str = Query("uz")):
+    """Properties as NDJSON (or a CSV upload; nested fields as dotted headers, e.g. area.actualLandArea)."""
+    language = reasons.normalize_language(language)
+    records = expand_properties(await read_records(request))
+    return _stream(run_batch(records, uy_joy.value_uy_joy, property_key, language))
+
+def batch_stats() -> Dict[str, Any]:
+    return {**_counters, "concurrency": CONCURRENCY, "max_items": MAX_ITEMS}
@@ -0,0 +1,233 @@
+import os
+import json
+import asyncio
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+CBU_RATES_URL = os.getenv("CBU_RATES_URL", "https://cbu.uz/uz/arkhiv-kursov-valyut/json/")
+ARCHIVE_DIR = os.getenv("CBU_RATES_ARCHIVE_DIR", "data/cbu_rates")
+REFRESH_INTERVAL = float(os.getenv("CBU_REFRESH_INTERVAL", "3600"))
+REQUEST_TIMEOUT = float(os.getenv("CBU_REQUEST_TIMEOUT", "10"))
+# Historical days kept in memory (least recently used dropped; the disk archive keeps them all)
+HISTORY_SIZE = int(os.getenv("CBU_HISTORY_SIZE", "366"))
+FALLBACK_USD_RATE = 12850.0
+
+# Latest rates: currency code -> UZS per 1 unit
+_rates: Dict[str, float] = {}
+_rates_date: Optional[str] = None
+_updated_at: Optional[datetime] = None
+_last_error: Optional[str] = None
+
+# Historical rates already loaded from disk or cbu.uz: ISO date -> {ccy: rate}
+_history: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+
+_client: httpx.AsyncClient | None = None
+_task: asyncio.Task | None = None
+
+# --- Helpers ---
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+    return _client
+
+def normalize_date(value: Any) -> Optional[str]:
+    """Accepts date objects, "YYYY-MM-DD" or CBU's "DD.MM.YYYY" and returns ISO format."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    text = str(value).strip()
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognized date: {value}")
+
+def parse_rates(data: Any) -> Tuple[Optional[str], Dict[str, float]]:
+    """Turns the CBU JSON list into (ISO date, {ccy: UZS per unit})."""
+    rates: Dict[str, float] = {}
+    rates_date = None
+    for item in data if isinstance(data, list) else []:
+        ccy = item.get("Ccy")
+        try:
+            rate = float(str(item.get("Rate", "")).replace(",", "."))
+            nominal = float(item.get("Nominal") or 1) or 1.0
+        except ValueError:
+            continue
+        if ccy and rate > 0:
+            rates[ccy] = rate / nominal
+        if rates_date is None and item.get("Date"):
+            try:
+                rates_date = normalize_date(item["Date"])
+            except ValueError:
+                pass
+    return rates_date, rates
+
+def _archive_path(iso_date: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"{iso_date}.json")
+
+def _write_archive(iso_date: str, rates: Dict[str, float]) -> None:
+    try:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        path = _archive_path(iso_date)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(rates, fh, ensure_ascii=False, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Error writing rate archive for {iso_date}: {e}")
+
+def _read_archive(iso_date: str) -> Optional[Dict[str, float]]:
+    try:
+        with open(_archive_path(iso_date), encoding="utf-8") as fh:
+            return {k: float(v) for k, v in json.load(fh).items()}
+    except (OSError, ValueError):
+        return None
+
+def _latest_archive() -> Tuple[Optional[str], Dict[str, float]]:
+    try:
+        names = sorted(n for n in os.listdir(ARCHIVE_DIR) if n.endswith(".json"))
+    except OSError:
+        return None, {}
+    for name in reversed(names):
+        iso_date = name[:-len(".json")]
+        rates = _read_archive(iso_date)
+        if rates:
+            return iso_date, rates
+    return None, {}
+
+def _remember(iso_date: str, rates: Dict[str, float]) -> None:
+    _history[iso_date] = rates
+    _history.move_to_end(iso_date)
+    while len(_history) > HISTORY_SIZE:
+        _history.popitem(last=False)
+
+async def _fetch(url: str) -> Tuple[Optional[str], Dict[str, float]]:
+    response = await _get_client().get(url)
+    response.raise_for_status()
+    return parse_rates(response.json())
+
+# --- Refresh ---
+async def refresh_rates() -> bool:
+    """Downloads today's rates for all currencies, swaps them in and archives them."""
+    global _rates, _rates_date, _updated_at, _last_error
+    try:
+        rates_date, rates = await _fetch(CBU_RATES_URL)
+        if not rates:
+            raise ValueError("empty rate list")
+    except Exception as e:
+        _last_error = str(e)
+        print(f"Error fetching exchange rate: {e}")
+        return False
+
+    rates_date = rates_date or date.today().isoformat()
+    _rates, _rates_date = rates, rates_date
+    _updated_at = datetime.now()
+    _last_error = None
+    _remember(rates_date, rates)
+    await asyncio.to_thread(_write_archive, rates_date, rates)
+    return True
+
+async def _refresh_loop() -> None:
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        await refresh_rates()
+
+async def start() -> None:
+    """Loads rates before the app starts serving and schedules periodic refreshes."""
+    global _task, _rates, _rates_date
+    if not await refresh_rates() and not _rates:
+        # cbu.uz unreachable: serve the most recent archived day rather than nothing
+        _rates_date, _rates = _latest_archive()
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_refresh_loop())
+
+async def stop() -> None:
+    global _task, _client
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# --- Lookups ---
+def get_rate(ccy: str = "USD") -> float:
+    """Latest rate from memory; never touches the network."""
+    rate = _rates.get(ccy.upper())
+    if rate is None:
+        if ccy.upper() == "USD":
+            return FALLBACK_USD_RATE
+        raise KeyError(f"No CBU rate for {ccy}")
+    return rate
+
+async def get_rate_on(on_date: Any, ccy: str = "USD") -> float:
+    """Rate for a specific date: memory, then the on-disk archive, then cbu.uz."""
+    iso_date = normalize_date(on_date)
+    # A future date has no rate of its own yet: archiving today's under it would go stale
+    if iso_date is not None and iso_date > date.today().isoformat():
+        iso_date = date.today().isoformat()
+    if iso_date is None or iso_date == _rates_date:
+        return get_rate(ccy)
+
+    rates = _history.get(iso_date)
+    if rates is not None:
+        _history.move_to_end(iso_date)
+    else:
+        rates = await asyncio.to_thread(_read_archive, iso_date)
+    if rates is None:
+        try:
+            _, rates = await _fetch(f"{CBU_RATES_URL.rstrip('/')}/all/{iso_date}/")
+        except Exception as e:
+            print(f"Error fetching exchange rate for {iso_date}: {e}")
+            rates = {}
+        if rates:
+            await asyncio.to_thread(_write_archive, iso_date, rates)
+    if rates:
+        _remember(iso_date, rates)
+
+    rate = (rates or {}).get(ccy.upper())
+    if rate is None:
+        if ccy.upper() == "USD":
+            return get_rate("USD")
+        raise KeyError(f"No CBU rate for {ccy} on {iso_date}")
+    return rate
+
+async def get_usd_rate(on_date: Any = None) -> float:
+    """USD to UZS rate, latest unless a date is given."""
+    if on_date is None:
+        return get_rate("USD")
+    try:
+        return await get_rate_on(on_date, "USD")
+    except ValueError as e:
+        print(f"Error parsing rate date: {e}")
+        return get_rate("USD")
+
+def rates_date() -> Optional[str]:
+    return _rates_date
+
+def rates_stats() -> Dict[str, Any]:
+    return {
+        "date": _rates_date,
+        "currencies": len(_rates),
+        "usd": _rates.get("USD"),
+        "updated_at": _updated_at.isoformat() if _updated_at else None,
+        "last_error": _last_error,
+        "history_days_loaded": len(_history),
+        "refresh_interval_s": REFRESH_INTERVAL,
+    }
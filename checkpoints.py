@@ -0,0 +1,367 @@
+import os
+import time
+import sqlite3
+import asyncio
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+    writes_sort_key,
+)
+from langgraph.checkpoint.memory import InMemorySaver
+
+# Load environment variables
+load_dotenv()
+
+# Conversation state for the chat agents. "sqlite" survives restarts and is shared by all
+# uvicorn workers on the host; "memory" is per worker. Both forget idle sessions (TTL),
+# drop the least recently used ones over MAX_SESSIONS and keep only the newest
+# MAX_CHECKPOINTS checkpoints of a thread (older ones are never read back by the agent).
+BACKEND = os.getenv("XMED_CHECKPOINTER", "sqlite")
+DB_PATH = os.getenv("XMED_CHECKPOINT_DB", "data/xmed_checkpoints.sqlite3")
+SESSION_TTL = float(os.getenv("XMED_SESSION_TTL", str(24 * 3600)))
+MAX_SESSIONS = int(os.getenv("XMED_MAX_SESSIONS", "10000"))
+MAX_CHECKPOINTS = int(os.getenv("XMED_MAX_CHECKPOINTS", "4"))
+SWEEP_INTERVAL = float(os.getenv("XMED_SWEEP_INTERVAL", "60"))
+
+def _parent_config(thread_id: str, checkpoint_ns: str, parent_id: Optional[str]) -> Optional[RunnableConfig]:
+    if not parent_id:
+        return None
+    return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+
+class _Bounded(ABC):
+    """TTL / LRU / per-thread cap bookkeeping shared by the backends."""
+
+    backend = ""
+
+    def _init_bounds(self) -> None:
+        self.counters = {"expired_sessions": 0, "evicted_sessions": 0, "pruned_checkpoints": 0}
+        self._last_sweep = 0.0
+
+    def _maybe_sweep(self) -> None:
+        now = time.time()
+        if now - self._last_sweep >= SWEEP_INTERVAL:
+            self._last_sweep = now
+            self.sweep()
+
+    @abstractmethod
+    def sweep(self) -> None:
+        """Deletes sessions idle for longer than SESSION_TTL."""
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        # Same string versions as InMemorySaver, so the backends are interchangeable
+        return InMemorySaver.get_next_version(self, current, channel)
+
+class BoundedMemorySaver(_Bounded, InMemorySaver):
+    """InMemorySaver that forgets idle and excess sessions."""
+
+    backend = "memory"
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._init_bounds()
+        # thread_id -> last use, least recent first
+        self.last_used: "OrderedDict[str, float]" = OrderedDict()
+
+    def _touch(self, thread_id: str) -> None:
+        self.last_used[thread_id] = time.time()
+        self.last_used.move_to_end(thread_id)
+
+    def _expired(self, thread_id: str) -> bool:
+        used = self.last_used.get(thread_id)
+        return used is not None and time.time() - used > SESSION_TTL
+
+    def delete_thread(self, thread_id: str) -> None:
+        super().delete_thread(thread_id)
+        self.last_used.pop(thread_id, None)
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        if self._expired(thread_id):
+            self.delete_thread(thread_id)
+            self.counters["expired_sessions"] += 1
+            return None
+        if thread_id in self.last_used:
+            self._touch(thread_id)
+        return super().get_tuple(config)
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        result = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = config["configurable"]["thread_id"]
+        self._touch(thread_id)
+        self._prune(thread_id, config["configurable"]["checkpoint_ns"])
+        while len(self.last_used) > MAX_SESSIONS:
+            self.delete_thread(next(iter(self.last_used)))
+            self.counters["evicted_sessions"] += 1
+        self._maybe_sweep()
+        return result
+
+    def _prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= MAX_CHECKPOINTS:
+            return
+        for checkpoint_id in sorted(checkpoints)[:-MAX_CHECKPOINTS]:
+            del checkpoints[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            self.counters["pruned_checkpoints"] += 1
+        # Channel values are stored once per version; keep the versions the kept checkpoints use
+        used = {
+            (channel, version)
+            for saved, _, _ in checkpoints.values()
+            for channel, version in self.serde.loads_typed(saved)["channel_versions"].items()
+        }
+        for key in [k for k in self.blobs if k[0] == thread_id and k[1] == checkpoint_ns and (k[2], k[3]) not in used]:
+            del self.blobs[key]
+
+    def sweep(self) -> None:
+        cutoff = time.time() - SESSION_TTL
+        while self.last_used:
+            thread_id, used = next(iter(self.last_used.items()))
+            if used > cutoff:
+                break
+            self.delete_thread(thread_id)
+            self.counters["expired_sessions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        size = sum(len(c[1]) + len(m[1]) for ns in self.storage.values() for cps in ns.values() for c, m, _ in cps.values())
+        size += sum(len(b[1]) for b in self.blobs.values())
+        size += sum(len(w[2][1]) for ws in self.writes.values() for w in ws.values())
+        return {
+            "sessions": len(self.last_used),
+            "checkpoints": sum(len(cps) for ns in self.storage.values() for cps in ns.values()),
+            "writes": sum(len(ws) for ws in self.writes.values()),
+            "bytes": size,
+        }
+
+class SQLiteSaver(_Bounded, BaseCheckpointSaver[str]):
+    """Checkpoints in a SQLite file (WAL), one connection per operation like forma_cache.
+
+    Each checkpoint row holds its full channel values, so pruning old rows never breaks the
+    newer ones. Async methods run the queries in a worker thread."""
+
+    backend = "sqlite"
+
+    def __init__(self, path: str = DB_PATH, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._init_bounds()
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, "
+                "checkpoint_id TEXT NOT NULL, parent_id TEXT, type TEXT, checkpoint BLOB, metadata_type TEXT, metadata BLOB, "
+                "PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS writes (thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, "
+                "checkpoint_id TEXT NOT NULL, task_id TEXT NOT NULL, idx INTEGER NOT NULL, channel TEXT, type TEXT, "
+                "value BLOB, task_path TEXT, PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS threads (thread_id TEXT PRIMARY KEY, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS threads_last_used ON threads (last_used)")
+
+    @contextmanager
+    def _db(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _delete(conn: sqlite3.Connection, thread_ids: Sequence[str]) -> None:
+        for table in ("checkpoints", "writes", "threads"):
+            conn.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(t,) for t in thread_ids])
+
+    # --- Reads ---
+    def _tuple(self, conn: sqlite3.Connection, row: Tuple[Any, ...]) -> CheckpointTuple:
+        thread_id, checkpoint_ns, checkpoint_id, parent_id, type_, checkpoint, metadata_type, metadata = row
+        writes = conn.execute(
+            "SELECT task_id, channel, type, value, task_path, idx FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        writes.sort(key=lambda w: writes_sort_key(w[4], w[0], w[5]))
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=_parent_config(thread_id, checkpoint_ns, parent_id),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for task_id, channel, t, v, _, _ in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        with self._db() as conn:
+            used = conn.execute("SELECT last_used FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+            if used is not None and time.time() - used[0] > SESSION_TTL:
+                self._delete(conn, [thread_id])
+                self.counters["expired_sessions"] += 1
+                return None
+            query = "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+            args: Tuple[Any, ...] = (thread_id, checkpoint_ns)
+            if checkpoint_id:
+                row = conn.execute(query + " AND checkpoint_id = ?", args + (checkpoint_id,)).fetchone()
+            else:
+                row = conn.execute(query + " ORDER BY checkpoint_id DESC LIMIT 1", args).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE threads SET last_used = ? WHERE thread_id = ?", (time.time(), thread_id))
+            return self._tuple(conn, row)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        query, args = "SELECT * FROM checkpoints WHERE 1 = 1", []
+        if config:
+            query += " AND thread_id = ?"
+            args.append(config["configurable"]["thread_id"])
+            if config["configurable"].get("checkpoint_ns") is not None:
+                query += " AND checkpoint_ns = ?"
+                args.append(config["configurable"]["checkpoint_ns"])
+            if get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                args.append(get_checkpoint_id(config))
+        if before and get_checkpoint_id(before):
+            query += " AND checkpoint_id < ?"
+            args.append(get_checkpoint_id(before))
+        query += " ORDER BY checkpoint_id DESC"
+        with self._db() as conn:
+            items = []
+            for row in conn.execute(query, args).fetchall():
+                item = self._tuple(conn, row)
+                if filter and not all(item.metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                items.append(item)
+                if limit is not None and len(items) >= limit:
+                    break
+        yield from items
+
+    # --- Writes ---
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        type_, data = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_data = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 type_, data, metadata_type, metadata_data),
+            )
+            conn.execute("INSERT OR REPLACE INTO threads VALUES (?, ?)", (thread_id, time.time()))
+            # Per-thread cap: only the newest MAX_CHECKPOINTS (and their writes) are kept
+            old = [r[0] for r in conn.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?",
+                (thread_id, checkpoint_ns, MAX_CHECKPOINTS),
+            )]
+            for table in ("checkpoints", "writes"):
+                conn.executemany(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    [(thread_id, checkpoint_ns, c) for c in old],
+                )
+            self.counters["pruned_checkpoints"] += len(old)
+        self._maybe_sweep()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        configurable = config["configurable"]
+        rows = []
+        for i, (channel, value) in enumerate(writes):
+            type_, data = self.serde.dumps_typed(value)
+            rows.append((configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"],
+                         task_id, WRITES_IDX_MAP.get(channel, i), channel, type_, data, task_path))
+        # Regular writes are kept from the first attempt, special ones (errors, interrupts) replaced
+        with self._db() as conn:
+            conn.executemany("INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [r for r in rows if r[4] >= 0])
+            conn.executemany("INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [r for r in rows if r[4] < 0])
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._db() as conn:
+            self._delete(conn, [thread_id])
+
+    def sweep(self) -> None:
+        with self._db() as conn:
+            expired = [r[0] for r in conn.execute("SELECT thread_id FROM threads WHERE last_used < ?", (time.time() - SESSION_TTL,))]
+            excess = [r[0] for r in conn.execute(
+                "SELECT thread_id FROM threads WHERE last_used >= ? ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                (time.time() - SESSION_TTL, MAX_SESSIONS),
+            )]
+            self._delete(conn, expired + excess)
+        self.counters["expired_sessions"] += len(expired)
+        self.counters["evicted_sessions"] += len(excess)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._db() as conn:
+            sessions, = conn.execute("SELECT COUNT(*) FROM threads").fetchone()
+            checkpoints, = conn.execute("SELECT COUNT(*) FROM checkpoints").fetchone()
+            writes, = conn.execute("SELECT COUNT(*) FROM writes").fetchone()
+            pages, = conn.execute("PRAGMA page_count").fetchone()
+            page_size, = conn.execute("PRAGMA page_size").fetchone()
+        return {"path": self.path, "sessions": sessions, "checkpoints": checkpoints, "writes": writes, "bytes": pages * page_size}
+
+    # --- Async ---
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+def create_checkpointer(backend: str = BACKEND) -> BaseCheckpointSaver:
+    """A networked store (e.g. langgraph's Postgres saver) plugs in here under its own name."""
+    if backend == "memory":
+        return BoundedMemorySaver()
+    if backend == "sqlite":
+        return SQLiteSaver(DB_PATH)
+    raise ValueError(f"Unknown XMED_CHECKPOINTER backend '{backend}'. Use memory or sqlite.")
+
+def checkpoint_stats(saver: BaseCheckpointSaver) -> Dict[str, Any]:
+    stats = saver.stats() if hasattr(saver, "stats") else {}
+    return {
+        "backend": getattr(saver, "backend", type(saver).__name__),
+        **stats,
+        **getattr(saver, "counters", {}),
+        "session_ttl_s": SESSION_TTL,
+        "max_sessions": MAX_SESSIONS,
+        "max_checkpoints_per_thread": MAX_CHECKPOINTS,
+    }
@@ -0,0 +1,5 @@
+import os
+
+# Modules read their settings on import; tests never reach OpenAI or the on-disk checkpointer
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("XMED_CHECKPOINTER", "memory")
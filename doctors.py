@@ -0,0 +1,364 @@
+import os
+import re
+import json
+import time
+import fcntl
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import httpx
+from dotenv import load_dotenv
+
+import translit
+
+# Load environment variables
+load_dotenv()
+
+# Local mirror of the plusmed doctor catalog. search_doctor answers from the in-memory
+# index and only calls the API when the mirror has nothing for the query.
+API_URL = os.getenv("DOCTORS_API_URL", "https://api.plusmed.uz/be/common/searchDoctor")
+SNAPSHOT_PATH = os.getenv("DOCTORS_SNAPSHOT_PATH", "data/doctors.json")
+SYNC_INTERVAL = float(os.getenv("DOCTORS_SYNC_INTERVAL", "3600"))
+# One worker (the holder of this lock) downloads the catalog; the others pick up its
+# snapshot, checking for a newer one every RELOAD_INTERVAL seconds
+LOCK_PATH = os.getenv("DOCTORS_LOCK_PATH", f"{SNAPSHOT_PATH}.lock")
+RELOAD_INTERVAL = float(os.getenv("DOCTORS_RELOAD_INTERVAL", "60"))
+SYNC_PAGE_SIZE = int(os.getenv("DOCTORS_SYNC_PAGE_SIZE", "200"))
+REQUEST_TIMEOUT = float(os.getenv("DOCTORS_REQUEST_TIMEOUT", "30"))
+# Safety stop for a paging API that never returns an empty page
+MAX_PAGES = int(os.getenv("DOCTORS_MAX_PAGES", "500"))
+
+HEADERS = {"language": "uz", "Content-Type": "application/json"}
+
+_client: httpx.AsyncClient | None = None
+_task: asyncio.Task | None = None
+_synced_at: Optional[datetime] = None
+_last_error: Optional[str] = None
+_lock_fd: Optional[int] = None
+# mtime of the snapshot the current index was built from
+_snapshot_mtime: Optional[float] = None
+_counters = {"queries": 0, "local_queries": 0, "hits": 0, "remote": 0, "remote_errors": 0, "syncs": 0, "reloads": 0, "total_us": 0.0}
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT, headers=HEADERS)
+    return _client
+
+# --- Record fields (the API's field names vary between endpoints and versions) ---
+def _first(doctor: Dict[str, Any], *keys: str) -> Any:
+    for key in keys:
+        value = doctor.get(key)
+        if value not in (None, "", []):
+            return value
+    return None
+
+def _number(value: Any) -> float:
+    try:
+        return float(str(value).replace(",", "."))
+    except (TypeError, ValueError):
+        m = re.search(r"\d+(?:[.,]\d+)?", str(value or ""))
+        return float(m.group(0).replace(",", ".")) if m else 0.0
+
+def doctor_name(doctor: Dict[str, Any]) -> str:
+    name = _first(doctor, "fullName", "full_name", "name", "fio")
+    if name is None:
+        name = " ".join(str(doctor.get(k) or "") for k in ("lastName", "firstName", "middleName"))
+    return " ".join(str(name).split())
+
+def doctor_specialities(doctor: Dict[str, Any]) -> List[str]:
+    value = _first(doctor, "speciality", "specialities", "specialty", "specialties", "specializations")
+    items = value if isinstance(value, list) else [value] if value is not None else []
+    slugs = []
+    for item in items:
+        if isinstance(item, dict):
+            item = _first(item, "slug", "code", "key", "name")
+        if item:
+            slugs.append(str(item).strip().lower())
+    return slugs
+
+def extract_doctors(data: Any) -> List[Dict[str, Any]]:
+    """The list of doctor objects in an API response, wherever it is nested."""
+    if isinstance(data, list):
+        return [d for d in data if isinstance(d, dict)]
+    if isinstance(data, dict):
+        for key in ("results", "data", "items", "content", "doctors", "list", "rows"):
+            if key in data:
+                found = extract_doctors(data[key])
+                if found:
+                    return found
+    return []
+
+# --- Index ---
+def normalize_name(text: Any) -> str:
+    """Lowercase letters and spaces; apostrophe variants and punctuation removed."""
+    text = str(text or "").lower()
+    text = re.sub(f"[{translit.APOSTROPHES}]", "", text)
+    return " ".join(re.findall(r"\w+", text))
+
+def trigrams(text: str) -> Set[str]:
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class DoctorIndex:
+    """Doctors ranked once (rating, then experience), with postings by speciality slug,
+    by name trigram and by name-word prefix (for 1-2 letter queries)."""
+
+    def __init__(self, doctors: List[Dict[str, Any]]):
+        ranked = sorted(
+            doctors,
+            key=lambda d: (-_number(_first(d, "rating", "rate", "avgRating")), -_number(_first(d, "experience", "workExperience", "experienceYears"))),
+        )
+        self.doctors = ranked
+        self.names: List[str] = []
+        self.by_speciality: Dict[str, Set[int]] = {}
+        self.by_trigram: Dict[str, Set[int]] = {}
+        self.by_prefix: Dict[str, Set[int]] = {}
+        for i, doctor in enumerate(ranked):
+            name = normalize_name(doctor_name(doctor))
+            # Latin and Cyrillic spellings both match
+            cyrillic = normalize_name(translit.to_cyrillic(name))
+            searchable = name if cyrillic == name else f"{name} {cyrillic}"
+            self.names.append(searchable)
+            for slug in doctor_specialities(doctor):
+                self.by_speciality.setdefault(slug, set()).add(i)
+            for gram in trigrams(searchable):
+                self.by_trigram.setdefault(gram, set()).add(i)
+            for word in searchable.split():
+                for n in (1, 2):
+                    self.by_prefix.setdefault(word[:n], set()).add(i)
+
+    def __len__(self) -> int:
+        return len(self.doctors)
+
+    def _by_name(self, name: str, within: Optional[Set[int]] = None) -> Optional[Set[int]]:
+        words = normalize_name(name).split()
+        if not words:
+            return within
+        candidates = within
+        for word in words:
+            if len(word) < 3:
+                posting = self.by_prefix.get(word, set())
+            else:
+                grams = trigrams(word) - {f" {word[:2]}", f"{word[-2:]} "}
+                postings = sorted((self.by_trigram.get(g, set()) for g in grams), key=len)
+                posting = set.intersection(*postings) if postings else set()
+            candidates = posting if candidates is None else candidates & posting
+            if not candidates:
+                return set()
+        # Trigrams can match out of order: confirm every word is really in the name
+        names = self.names
+        for word in words:
+            candidates = {i for i in candidates if word in names[i]}
+        return candidates
+
+    def search(self, name: str = "", specialities: Iterable[str] = (), page: int = 1, page_size: int = 3) -> Optional[Dict[str, Any]]:
+        """A page of matching doctors in rank order, or None when the mirror can't answer."""
+        slugs = [s.strip().lower() for s in specialities or [] if s and s.strip()]
+        if any(s not in self.by_speciality for s in slugs):
+            return None
+        matches: Optional[Set[int]] = None
+        if slugs:
+            matches = self.by_speciality[slugs[0]] if len(slugs) == 1 else set().union(*(self.by_speciality[s] for s in slugs))
+        # Speciality narrows the candidates before the (slower) name check
+        matches = self._by_name(name or "", matches)
+        if matches is None:
+            ordered = range(len(self.doctors))
+            total = len(self.doctors)
+        else:
+            ordered = sorted(matches)
+            total = len(ordered)
+        if total == 0:
+            return None
+        start = (max(page, 1) - 1) * page_size
+        return {
+            "results": [self.doctors[i] for i in ordered[start:start + page_size]],
+            "total": total,
+            "page": page,
+            "pageSize": page_size,
+        }
+
+_index: Optional[DoctorIndex] = None
+
+# --- Sync ---
+def _read_snapshot() -> List[Dict[str, Any]]:
+    try:
+        with open(SNAPSHOT_PATH, encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return []
+
+def _write_snapshot(doctors: List[Dict[str, Any]]) -> None:
+    try:
+        os.makedirs(os.path.dirname(SNAPSHOT_PATH) or ".", exist_ok=True)
+        tmp = f"{SNAPSHOT_PATH}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(doctors, fh, ensure_ascii=False)
+        os.replace(tmp, SNAPSHOT_PATH)
+    except OSError as e:
+        print(f"Error writing doctor snapshot: {e}")
+
+async def remote_search(page: Any = "1", page_size: Any = "3", name: str = "", speciality: Optional[List[str]] = None) -> Any:
+    payload = {"page": str(page), "pageSize": str(page_size), "name": name, "speciality": speciality or []}
+    response = await _get_client().post(API_URL, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+async def sync() -> bool:
+    """Downloads the whole catalog page by page and swaps in a new index."""
+    global _index, _synced_at, _last_error, _snapshot_mtime
+    doctors: List[Dict[str, Any]] = []
+    seen: Set[Any] = set()
+    try:
+        for page in range(1, MAX_PAGES + 1):
+            batch = extract_doctors(await remote_search(page, SYNC_PAGE_SIZE))
+            fresh = [d for d in batch if d.get("id") not in seen]
+            if not fresh:
+                break
+            seen.update(d.get("id") for d in fresh)
+            doctors.extend(fresh)
+            if len(batch) < SYNC_PAGE_SIZE:
+                break
+        if not doctors:
+            raise ValueError("empty doctor catalog")
+    except Exception as e:
+        _last_error = str(e)
+        print(f"Error syncing doctor catalog: {e}")
+        return False
+
+    _index = await asyncio.to_thread(DoctorIndex, doctors)
+    _synced_at = datetime.now()
+    _last_error = None
+    _counters["syncs"] += 1
+    await asyncio.to_thread(_write_snapshot, doctors)
+    _snapshot_mtime = _mtime()
+    print(f"Doctors: synced {len(doctors)} doctors")
+    return True
+
+def _mtime() -> Optional[float]:
+    try:
+        return os.path.getmtime(SNAPSHOT_PATH)
+    except OSError:
+        return None
+
+async def reload() -> bool:
+    """Swaps in an index built from the snapshot when it changed since the last load."""
+    global _index, _synced_at, _snapshot_mtime
+    mtime = _mtime()
+    if mtime is None or mtime == _snapshot_mtime:
+        return False
+    doctors = await asyncio.to_thread(_read_snapshot)
+    if not doctors:
+        return False
+    _index = await asyncio.to_thread(DoctorIndex, doctors)
+    _synced_at = datetime.fromtimestamp(mtime)
+    _snapshot_mtime = mtime
+    _counters["reloads"] += 1
+    return True
+
+def _acquire_sync_lock() -> bool:
+    """True when this worker holds the sync lock (held until stop() or the process exits)."""
+    global _lock_fd
+    if _lock_fd is not None:
+        return True
+    try:
+        os.makedirs(os.path.dirname(LOCK_PATH) or ".", exist_ok=True)
+        fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        print(f"Error opening doctor sync lock: {e}")
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _lock_fd = fd
+    return True
+
+def _release_sync_lock() -> None:
+    global _lock_fd
+    if _lock_fd is not None:
+        # Closing the descriptor releases the lock
+        os.close(_lock_fd)
+        _lock_fd = None
+
+async def _sync_loop() -> None:
+    while True:
+        # The lock is retried every round, so another worker takes over when the holder exits
+        if _acquire_sync_lock():
+            # A snapshot fresher than SYNC_INTERVAL (from a restart or the previous holder) is kept
+            age = time.time() - _snapshot_mtime if _snapshot_mtime is not None else None
+            if age is None or age >= SYNC_INTERVAL:
+                await sync()
+                wait = SYNC_INTERVAL
+            else:
+                wait = SYNC_INTERVAL - age
+        else:
+            await reload()
+            wait = RELOAD_INTERVAL
+        await asyncio.sleep(wait)
+
+async def start() -> None:
+    """Serves the last snapshot right away; syncing (or following the syncing worker) runs in the background."""
+    global _task
+    await reload()
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_sync_loop())
+
+async def stop() -> None:
+    global _task, _client
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    _release_sync_lock()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# --- Lookups ---
+def _int(value: Any, default: int) -> int:
+    try:
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return default
+
+async def search(page: Any = "1", page_size: Any = "3", name: str = "", speciality: Optional[List[str]] = None) -> Any:
+    """Local index first, the plusmed API on a miss."""
+    _counters["queries"] += 1
+    if _index is not None:
+        start = time.perf_counter()
+        found = _index.search(name, speciality or [], _int(page, 1), _int(page_size, 3))
+        _counters["local_queries"] += 1
+        _counters["total_us"] += (time.perf_counter() - start) * 1e6
+        if found is not None:
+            _counters["hits"] += 1
+            return found
+
+    _counters["remote"] += 1
+    try:
+        return await remote_search(page, page_size, name, speciality)
+    except Exception as e:
+        _counters["remote_errors"] += 1
+        return {"error": str(e), "results": []}
+
+def doctors_stats() -> Dict[str, Any]:
+    c = _counters
+    return {
+        "doctors": len(_index) if _index is not None else None,
+        "specialities": len(_index.by_speciality) if _index is not None else None,
+        "synced_at": _synced_at.isoformat() if _synced_at else None,
+        "last_error": _last_error,
+        "queries": c["queries"],
+        "local_hits": c["hits"],
+        "remote_calls": c["remote"],
+        "remote_errors": c["remote_errors"],
+        "syncs": c["syncs"],
+        "reloads": c["reloads"],
+        "sync_owner": _lock_fd is not None,
+        "avg_local_us": round(c["total_us"] / c["local_queries"], 1) if c["local_queries"] else None,
+    }
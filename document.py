@@ -2,13 +2,23 @@ import os
 import json
 import re
 import math
-from typing import Any, Dict, List
+import time
+import hashlib
+import tempfile
+import asyncio
+from typing import Any, AsyncIterator, Dict, List
 from dotenv import load_dotenv
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import StreamingResponse
 from pydantic import RootModel
-from langchain_openai import ChatOpenAI
 from langchain.agents import create_agent
+from langchain_core.messages import HumanMessage
+from langchain_core.messages.ai import add_usage
+
+import pipeline
+import prompts
+import translit
+from llm_clients import get_llm
 
 router = APIRouter()
 
@@ -92,9 +102,42 @@ def full_name(p: Any) -> str:
     parts = [x for x in parts if x != "---"]
     return " ".join(parts) if parts else "---"
 
+def to_number(x: Any) -> float | None:
+    if is_nil(x) or isinstance(x, bool):
+        return None
+    if isinstance(x, str):
+        s = re.sub(r"\s+", "", x).replace(",", ".")
+        try:
+            x = float(s)
+        except ValueError:
+            return None
+    if not isinstance(x, (int, float)) or not math.isfinite(float(x)):
+        return None
+    return float(x)
+
+def index_rows(rows: Any, wanted: Any = None) -> Dict[str, Dict[str, Any]]:
+    """row_no -> row in a single pass; the first row wins, as with a linear scan.
+    With `wanted`, only those codes are kept and the pass stops once all are found."""
+    index: Dict[str, Dict[str, Any]] = {}
+    remaining = set(wanted) if wanted is not None else None
+    for r in safe_arr(rows):
+        if not isinstance(r, dict):
+            continue
+        key = str(r.get("row_no", "")).strip()
+        if key in index:
+            continue
+        if remaining is None:
+            index[key] = r
+        elif key in remaining:
+            index[key] = r
+            remaining.discard(key)
+            if not remaining:
+                break
+    return index
+
 def find_row(rows: Any, row_no: str, field: str) -> str:
-    rows_list = safe_arr(rows)
-    r = next((x for x in rows_list if str((x or {}).get("row_no", "")) == str(row_no)), None)
+    index = rows if isinstance(rows, dict) else index_rows(rows)
+    r = index.get(str(row_no))
     if not r:
         return "---"
     v = r.get(field)
@@ -102,6 +145,46 @@ def find_row(rows: Any, row_no: str, field: str) -> str:
         return "---"
     return num_format(v)
 
+# Section 7 lines: label key, displayed row, value fields, and the rows the label
+# says the figure is made of (sign, row_no); the displayed row is used unless all of them are present
+BALANCE_FIELDS = ("sum_begin_period", "sum_end_period")
+RESULT_FIELDS = ("sum_period_doxod", "sum_period_rasxod")
+FINANCIAL_LINES = [
+    ("a", "forma1", "010", BALANCE_FIELDS, ((1, "010"), (-1, "011"))),
+    ("b", "forma1", "140", BALANCE_FIELDS, ()),
+    ("c", "forma1", "210", BALANCE_FIELDS, ()),
+    ("d", "forma1", "400", BALANCE_FIELDS, ((1, "130"), (1, "390"))),
+    ("e", "forma1", "601", BALANCE_FIELDS, ()),
+    ("f", "forma1", "570", BALANCE_FIELDS, ()),
+    ("g", "forma1", "730", BALANCE_FIELDS, ()),
+    ("h", "forma1", "780", BALANCE_FIELDS, ((1, "480"), (1, "770"))),
+    ("i", "forma2", "010", RESULT_FIELDS, ()),
+    ("j", "forma2", "270", RESULT_FIELDS, ()),
+]
+
+# Row codes each form has to provide for Section 7
+FINANCIAL_ROWS = {
+    form: {code for _, f, row_no, _, parts in FINANCIAL_LINES if f == form for code in (row_no, *(p for _, p in parts))}
+    for form in ("forma1", "forma2")
+}
+
+def financial_block(forma1: Any, forma2: Any) -> Dict[str, List[str]]:
+    """Formatted cells for every Section 7 line, computed in one pass over indexed rows."""
+    indexes = {"forma1": index_rows(forma1, FINANCIAL_ROWS["forma1"]), "forma2": index_rows(forma2, FINANCIAL_ROWS["forma2"])}
+    block: Dict[str, List[str]] = {}
+    for key, form, row_no, fields, parts in FINANCIAL_LINES:
+        index = indexes[form]
+        cells = []
+        for field in fields:
+            values = [(sign, to_number((index.get(part) or {}).get(field))) for sign, part in parts]
+            # A partial sum (011 alone, 130 without 390) would misstate the line
+            if values and all(v is not None for _, v in values):
+                cells.append(num_format(sum(sign * v for sign, v in values if v is not None)))
+            else:
+                cells.append(find_row(index, row_no, field))
+        block[key] = cells
+    return block
+
 def get_in(d: Any, path: List[Any], default=None):
     cur = d
     for key in path:
@@ -194,6 +277,7 @@ DICT = {
         "hDivision": "Diviziya",
         "hOwner": "Egalik qiluvchi",
         "unitArea": "kv.m.",
+        "conclusionFailed": "Ekspert xulosasini yaratib bo‘lmadi. Iltimos, hujjatni qayta shakllantiring.",
     },
     "cyrl": {
         "expertConclusionTitle": "Якуний кредит бўйича эксперт хулосаси",
@@ -271,6 +355,7 @@ DICT = {
         "hDivision": "Дивизия",
         "hOwner": "Эгалик қилувчи",
         "unitArea": "кв.м.",
+        "conclusionFailed": "Эксперт хулосасини яратиб бўлмади. Илтимос, ҳужжатни қайта шакллантиринг.",
     },
     "en": {
         "expertConclusionTitle": "Final credit expert conclusion",
@@ -348,6 +433,7 @@ DICT = {
         "hDivision": "Division",
         "hOwner": "Owner",
         "unitArea": "sq.m.",
+        "conclusionFailed": "The expert conclusion could not be generated. Please generate the document again.",
     },
     "ru": {
         "expertConclusionTitle": "Итоговое экспертное заключение по кредиту",
@@ -425,191 +511,15 @@ DICT = {
         "hDivision": "Подразделение",
         "hOwner": "Собственник",
         "unitArea": "кв.м.",
+        "conclusionFailed": "Не удалось сформировать экспертное заключение. Пожалуйста, сформируйте документ повторно.",
     },
 }
 
 # ---------------- main builder (adapted from code.py) ----------------
 
-def build_html(payload: Any, ai_conclusion: str) -> str:
-    # If payload is a list, try using the first element or treat it as the body
-    if isinstance(payload, list):
-        body = payload[0] if payload else {}
-    else:
-        body = payload.get("body") if isinstance(payload.get("body"), dict) else payload
-        
-    language = str(body.get("language", "uz")).lower()
-
-    L = DICT.get(language) or DICT["uz"]
-
-    company = get_in(body, ["company_info", "data"], {}) or {}
-    bank_info = body.get("bankInfo") or {}
-    app_data = get_in(body, ["applicationInfo", "applicationData"], {}) or {}
-    tax_objects = body.get("taxObjects") or {}
-    forma1 = get_in(body, ["forma_1", "data", 0, "rows"], []) or []
-    forma2 = get_in(body, ["forma_2", "data", 0, "rows"], []) or []
-
-    company_name = val(company.get("name"))
-    tin = val(company.get("tin"))
-    oked = val(get_in(company, ["okedDetail", "name"]))
-    category = val(get_in(company, ["businessTypeDetail", "name"]))
-    employee_count = num_format(body.get("employeeCount"))
-
-    legal_address = join_address(
-        get_in(company, ["companyBillingAddress", "region", "name"]),
-        get_in(company, ["companyBillingAddress", "district", "name"]),
-        get_in(company, ["companyBillingAddress", "streetName"]),
-    )
-    business_fund = num_format(company.get("businessFund"))
-    director_name = full_name(company.get("director"))
-
-    reg_date = val(bank_info.get("regDate"))
-
-    def purpose_by_lang() -> str:
-        a = get_in(body, ["applicationInfo", "applicationData"], {}) or {}
-        if language == "cyrl":
-            return val(a.get("purposeCyrl"))
-        if language == "ru":
-            return val(a.get("purposeRu"))
-        if language == "en":
-            return val(a.get("purposeEn"))
-        return val(a.get("purposeUz"))
-
-    purpose = purpose_by_lang()
-    requested_amount = num_format(app_data.get("requestedAmount"))
-    currency = val(app_data.get("currency"))
-    loan_term_months = val(app_data.get("loanTermMonths"))
-    down_payment_percent = val(app_data.get("downPaymentPercent"))
-
-    first_tax_obj = (safe_arr(tax_objects.get("dataObject"))[0] if safe_arr(tax_objects.get("dataObject")) else {}) or {}
-    main_obj_addr = val(first_tax_obj.get("address"))
-    main_obj_total = num_format(first_tax_obj.get("total_area"))
-    main_obj_land = num_format(first_tax_obj.get("land_area"))
-    main_obj_cad = val(first_tax_obj.get("obj_code"))
-    main_obj_extra = num_format(first_tax_obj.get("land_extra_area"))
-
-    foundation_year = reg_date[:4] if reg_date != "---" and re.match(r"^\d{4}", reg_date) else "---"
-    buildings = str(len(safe_arr(tax_objects.get("dataObject"))) or "---")
-
-    def land_area_sum() -> str:
-        s = 0.0
-        for o in safe_arr(tax_objects.get("dataObject")):
-            v = (o or {}).get("land_area")
-            try:
-                n = float(str(v or "").replace(" ", "").replace(",", "."))
-            except ValueError:
-                n = 0.0
-            if math.isfinite(n):
-                s += n
-        return num_format(s) if s > 0 else "---"
-
-    land_area = land_area_sum()
-    ua = L.get("unitArea")
-
-    # founders
-    founders_html = ""
-    for f in safe_arr(company.get("founders")):
-        is_individual = bool(get_in(f, ["founderIndividual"]))
-        is_legal = bool(get_in(f, ["founderLegal"]))
-
-        if is_individual:
-            fi = get_in(f, ["founderIndividual"], {}) or {}
-            name_parts = [fi.get("lastName"), fi.get("firstName"), fi.get("middleName")]
-            name_parts = [val(x) for x in name_parts if x]
-            name_parts = [x for x in name_parts if x != "---"]
-            name = " ".join(name_parts) if name_parts else "---"
-        else:
-            name = val(get_in(f, ["founderLegal", "name"]))
-
-        type_ = L.get("ind") if is_individual else (L.get("leg") if is_legal else "---")
-        share = val(f.get("sharePercent"))
-
-        founders_html += f"<tr><td>{esc(name)}</td><td>{esc(type_)}</td><td>{esc(share)}</td><td>---</td></tr>"
-
-    # collateral
-    collateral = safe_arr(get_in(body, ["applicationInfo", "collateralData"]))
-
-    collateral_real_estate = ""
-    for i in collateral:
-        if (i or {}).get("yurTaxObjectData") is not None or (i or {}).get("collateralType") == "REAL_ESTATE":
-            y = (i or {}).get("yurTaxObjectData") or {}
-            collateral_real_estate += f"""
-<tr>
-<td>{esc(val(y.get("tin")))}</td>
-<td>{esc(val(y.get("name")))}</td>
-<td>{esc(val(y.get("type")))}</td>
-<td>{esc(val(y.get("obj_code") or (i or {}).get("cadastreOrCarKuzov")))}</td>
-<td>{esc(val(y.get("obj_name")))}</td>
-<td>{esc(val(y.get("address") or (i or {}).get("address")))}</td>
-<td>{esc(val(y.get("percentage")))}</td>
-<td>{esc(num_format(y.get("inv_cost")))}</td>
-<td>{esc(num_format(y.get("total_area")))}</td>
-<td>{esc(num_format(y.get("land_area")))}</td>
-<td>{esc(num_format(y.get("land_extra_area")))}</td>
-<td>{esc(num_format((i or {}).get("estimatedValue")))}</td>
-</tr>
-""".strip()
-
-    collateral_cars = ""
-    for i in collateral:
-        if (i or {}).get("yurCarData") is not None or (i or {}).get("collateralType") == "VEHICLE":
-            c = (i or {}).get("yurCarData") or {}
-            collateral_cars += f"""
-<tr>
-<td>{esc(val(c.get("model")))}</td>
-<td>{esc(val(c.get("color")))}</td>
-<td>{esc(val((i or {}).get("carYear") or c.get("year")))}</td>
-<td>{esc(val((i or {}).get("cadastreOrCarKuzov") or c.get("kuzov")))}</td>
-<td>{esc(val(c.get("motor")))}</td>
-<td>{esc(val(c.get("shassi")))}</td>
-<td>{esc(val((i or {}).get("carLicensePlate") or c.get("gosNumber")))}</td>
-<td>{esc(val(c.get("regDate")))}</td>
-<td>{esc(val(c.get("division")))}</td>
-<td>{esc(val(c.get("owner")))}</td>
-<td>{esc(val(c.get("adres") or (i or {}).get("address")))}</td>
-<td>{esc(num_format((i or {}).get("estimatedValue")))}</td>
-</tr>
-""".strip()
-
-    # company assets
-    tax_obj_rows = ""
-    for item in safe_arr(tax_objects.get("dataObject")):
-        tax_obj_rows += f"""
-<tr>
-<td>{esc(val((item or {}).get("tin")))}</td>
-<td>{esc(val((item or {}).get("name")))}</td>
-<td>{esc(val((item or {}).get("type")))}</td>
-<td>{esc(val((item or {}).get("obj_code")))}</td>
-<td>{esc(val((item or {}).get("obj_name")))}</td>
-<td>{esc(val((item or {}).get("address")))}</td>
-<td>{esc(val((item or {}).get("percentage")))}</td>
-<td>{esc(num_format((item or {}).get("inv_cost")))}</td>
-<td>{esc(num_format((item or {}).get("total_area")))}</td>
-<td>{esc(num_format((item or {}).get("land_area")))}</td>
-<td>{esc(num_format((item or {}).get("land_extra_area")))}</td>
-</tr>
-""".strip()
-
-    car_obj_rows = ""
-    for car in safe_arr(tax_objects.get("carDataObject")):
-        car_obj_rows += f"""
-<tr>
-<td>{esc(val((car or {}).get("model")))}</td>
-<td>{esc(val((car or {}).get("color")))}</td>
-<td>{esc(val((car or {}).get("year")))}</td>
-<td>{esc(val((car or {}).get("kuzov")))}</td>
-<td>{esc(val((car or {}).get("motor")))}</td>
-<td>{esc(val((car or {}).get("shassi")))}</td>
-<td>{esc(val((car or {}).get("gosNumber")))}</td>
-<td>{esc(val((car or {}).get("regDate")))}</td>
-<td>{esc(val((car or {}).get("division")))}</td>
-<td>{esc(val((car or {}).get("owner")))}</td>
-<td>{esc(val((car or {}).get("adres")))}</td>
-</tr>
-""".strip()
-
-    # section 7 labels
+def section7_labels(language: str) -> Dict[str, str]:
     if language == "ru":
-        S7 = {
+        return {
             "a": "Остаточная стоимость основных средств (010-011)",
             "b": "Итого запасы (150+160+170+180), в том числе:",
             "c": "Итого дебиторская задолженность (220+240+250+260+270+280+290+300+310)",
@@ -621,8 +531,8 @@ def build_html(payload: Any, ai_conclusion: str) -> str:
             "i": "Чистая выручка от реализации товаров (работ, услуг)",
             "j": "Чистая прибыль (убыток) за отчётный период (240-250-260)",
         }
-    elif language == "en":
-        S7 = {
+    if language == "en":
+        return {
             "a": "Residual value of fixed assets (010-011)",
             "b": "Total inventory (150+160+170+180), including:",
             "c": "Total receivables (220+240+250+260+270+280+290+300+310)",
@@ -634,161 +544,632 @@ def build_html(payload: Any, ai_conclusion: str) -> str:
             "i": "Net revenue from sales of goods (works, services)",
             "j": "Net profit (loss) for the reporting period (240-250-260)",
         }
+    return {
+        "a": "Асосий воситаларнинг қолдиқ қиймати (010-011)" if language == "cyrl" else "Asosiy vositalarning qoldiq qiymati (010-011)",
+        "b": "Жами инвентаризация (150+160+170+180-қаторлар), шу жумладан:" if language == "cyrl" else "Jami inventarizatsiya (150+160+170+180-qatorlar), shu jumladan:",
+        "c": "Жами дебиторлар (220+240+250+260+270+280+290+300+310 қаторлар)" if language == "cyrl" else "Jami debitorlar (220+240+250+260+270+280+290+300+310 qatorlar)",
+        "d": "Баланс активларининг умумий суммаси (130-қатор + 390-қатор)" if language == "cyrl" else "Balans aktivlarining umumiy summasi (130-qator + 390-qator)",
+        "e": "Шу жумладан: жорий кредиторлик қарзлари (610+630+650+670+680+690+700+710+720+760-қаторлар)" if language == "cyrl" else "Shu jumladan: joriy kreditorlik qarzlari (610+630+650+670+680+690+700+710+720+760-qatorlar)",
+        "f": "Узоқ muddatli bank kreditlari (7810)" if language == "cyrl" else "Uzoq muddatli bank kreditlari (7810)",
+        "g": "Қисқа muddatli bank kreditlari (6810)" if language == "cyrl" else "Qisqa muddatli bank kreditlari (6810)",
+        "h": "Жами мажбуриятлар (480+770-қаторлар)" if language == "cyrl" else "Jami majburiyatlar (480+770-qatorlar)",
+        "i": "Маҳсулотлар (товарлар, ишлар ва хизматлар) сотишдан олинган соф даромад" if language == "cyrl" else "Mahsulotlar (tovarlar, ishlar va xizmatlar) sotishdan olingan sof daromad",
+        "j": "Ҳисобот даври учун соф фойда (зарар) (240-250-260-қаторлар)" if language == "cyrl" else "Hisobot davri uchun sof foyda (zarar) (240-250-260-qatorlar)",
+    }
+
+# Row fragments, filled with already-escaped cells
+FOUNDER_ROW = "<tr><td>{}</td><td>{}</td><td>{}</td><td>---</td></tr>"
+ROW_11 = "<tr>\n" + "\n".join(["<td>{}</td>"] * 11) + "\n</tr>"
+ROW_12 = "<tr>\n" + "\n".join(["<td>{}</td>"] * 12) + "\n</tr>"
+
+def _static(text: Any) -> str:
+    """Label text baked into a template; braces are escaped so str.format leaves them alone."""
+    return str(text).replace("{", "{{").replace("}", "}}")
+
+def compile_template(language: str) -> str:
+    """Renders the static chrome for one language once; only {slot} cells are left for build_html."""
+    L = {k: _static(v) for k, v in (DICT.get(language) or DICT["uz"]).items()}
+    S7 = {k: _static(v) for k, v in section7_labels(language).items()}
+    ua = L.get("unitArea")
+    table = """<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">"""
+
+    if language == "ru":
+        applied = f"{L.get('applied3')}: {{requested_amount}} {{currency}}; {L.get('term')}: {{loan_term_months}}."
+    elif language == "en":
+        applied = f"{L.get('applied3')}: {{requested_amount}} {{currency}}; {L.get('term')}: {{loan_term_months}} months."
     else:
-        S7 = {
-            "a": "Асосий воситаларнинг қолдиқ қиймати (010-011)" if language == "cyrl" else "Asosiy vositalarning qoldiq qiymati (010-011)",
-            "b": "Жами инвентаризация (150+160+170+180-қаторлар), шу жумладан:" if language == "cyrl" else "Jami inventarizatsiya (150+160+170+180-qatorlar), shu jumladan:",
-            "c": "Жами дебиторлар (220+240+250+260+270+280+290+300+310 қаторлар)" if language == "cyrl" else "Jami debitorlar (220+240+250+260+270+280+290+300+310 qatorlar)",
-            "d": "Баланс активларининг умумий суммаси (130-қатор + 390-қатор)" if language == "cyrl" else "Balans aktivlarining umumiy summasi (130-qator + 390-qator)",
-            "e": "Шу жумладан: жорий кредиторлик қарзлари (610+630+650+670+680+690+700+710+720+760-қаторлар)" if language == "cyrl" else "Shu jumladan: joriy kreditorlik qarzlari (610+630+650+670+680+690+700+710+720+760-qatorlar)",
-            "f": "Узоқ muddatli bank kreditlari (7810)" if language == "cyrl" else "Uzoq muddatli bank kreditlari (7810)",
-            "g": "Қисқа muddatli bank kreditlari (6810)" if language == "cyrl" else "Qisqa muddatli bank kreditlari (6810)",
-            "h": "Жами мажбуриятлар (480+770-қаторлар)" if language == "cyrl" else "Jami majburiyatlar (480+770-qatorlar)",
-            "i": "Маҳсулотлар (товарлар, ишлар ва хизматлар) сотишдан олинган соф даромад" if language == "cyrl" else "Mahsulotlar (tovarlar, ishlar va xizmatlar) sotishdan olingan sof daromad",
-            "j": "Ҳисобот даври учун соф фойда (зарар) (240-250-260-қаторлар)" if language == "cyrl" else "Hisobot davri uchun sof foyda (zarar) (240-250-260-qatorlar)",
-        }
+        applied = f"{L.get('applied3')} {{requested_amount}} {{currency}}, {{loan_term_months}} {L.get('term')}"
+
+    if language == "uz":
+        short_about = (
+            "Test Company LLC korxonasi {foundation_year} yildan beri faoliyat yuritib, asosan {oked} sohasida xizmat ko‘rsatib keladi.</br>"
+            "Korxona yuridik manzili: {legal_address}.</br>"
+            f"Korxona balansida {{buildings}} dona bino va {{land_area}} {ua} yer maydoni mavjud bo‘lib, hudud zarur infratuzilma va kommunikatsiyalar bilan ta’minlangan.</br>"
+            "Tashkilotda {employee_count} nafar xodim ishlaydi va ishlab chiqarish quvvati yil sayin oshmoqda.</br>"
+            "Moliyaviy ko‘rsatkichlar va bozordagi obro‘-e’tibori, shuningdek, aktivlarning likvidligi korxonaga yuqori ishonch beradi."
+        )
+    elif language == "cyrl":
+        short_about = (
+            "Test Company LLC корхонаси {foundation_year} йилдан бери фаолият юритиб, асосан {oked} соҳасида хизмат кўрсатиб келади.</br>"
+            "Корхона юридик манзили: {legal_address}.</br>"
+            f"Корхона балансида {{buildings}} дона бино ва {{land_area}} {ua} ер майдони мавжуд бўлиб, ҳудуд зарур инфратузилма ва коммуникациялар билан таъминланган.</br>"
+            "Ташкилотда {employee_count} нафар ходим ишлайди ва ишлаб чиқариш қуввати йил сайин ошмоқда.</br>"
+            "Молиявий кўрсаткичлар ва бозордаги обрў-эътибори, шунингдек, активларнинг ликвидлиги корхонага юқори ишонч беради."
+        )
+    else:
+        short_about = "---"
+
+    fin_rows = "\n".join(
+        f'<tr><td>{S7[key]}</td><td>{row_no}</td><td>{{fin_{key}_0}}</td><td>{{fin_{key}_1}}</td></tr>'
+        + (f'\n<tr><td>{L.get("finTitle")}</td><td></td><td></td><td></td></tr>' if key == "h" else "")
+        for key, _, row_no, _, _ in FINANCIAL_LINES
+    )
 
-    # build html
-    html = f"""
+    return f"""
 <div style="font-family:'Times New Roman'; font-size:11pt;">
 
-<h2>{L.get("hProject")}: {esc(company_name)}</h2>
+<h2>{L.get("hProject")}: {{company_name}}</h2>
 <h3>{L.get("hCompany")}</h3>
-<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">
-<tr><td>{L.get("orgFull")}</td><td>{esc(company_name)}</td></tr>
-<tr><td>{L.get("inn")}</td><td>{esc(tin)}</td></tr>
-<tr><td>{L.get("oked")}</td><td>{esc(oked)}</td></tr>
-<tr><td>{L.get("cat")}</td><td>{esc(category)}</td></tr>
-<tr><td>{L.get("emp")}</td><td>{esc(employee_count)}</td></tr>
-<tr><td>{L.get("addr")}</td><td>{esc(legal_address)}</td></tr>
-<tr><td>{L.get("fund")}</td><td>{esc(business_fund)}</td></tr>
+{table}
+<tr><td>{L.get("orgFull")}</td><td>{{company_name}}</td></tr>
+<tr><td>{L.get("inn")}</td><td>{{tin}}</td></tr>
+<tr><td>{L.get("oked")}</td><td>{{oked}}</td></tr>
+<tr><td>{L.get("cat")}</td><td>{{category}}</td></tr>
+<tr><td>{L.get("emp")}</td><td>{{employee_count}}</td></tr>
+<tr><td>{L.get("addr")}</td><td>{{legal_address}}</td></tr>
+<tr><td>{L.get("fund")}</td><td>{{business_fund}}</td></tr>
 </table>
 
 <h2>{L.get("foundersTitle")}</h2>
-<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">
+{table}
 <tr><th>{L.get("fio")}</th><th>{L.get("who")}</th><th>{L.get("share")}</th><th>{L.get("other")}</th></tr>
-{founders_html or "<tr><td>---</td><td>---</td><td>---</td><td>---</td></tr>"}
-<tr><td><b>{L.get("director")}</b></td><td colspan="3">{esc(director_name)}</td></tr>
+{{founders_rows}}
+<tr><td><b>{L.get("director")}</b></td><td colspan="3">{{director_name}}</td></tr>
 </table>
 
 <p><em><u>{L.get("bankReq")}</u></em></p>
 <p><strong>{L.get("mainAcc")}</strong></p>
-<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">
-<tr><td><b>{L.get("bankName")}</b></td><td>{esc(val(bank_info.get("ns2Name")))}</td></tr>
-<tr><td><b>{L.get("acc")}</b></td><td>{esc(bank_acc_format(bank_info.get("account")))}</td></tr>
-<tr><td><b>{L.get("mfo")}</b></td><td>{esc(val(bank_info.get("ns2Code")))}</td></tr>
+{table}
+<tr><td><b>{L.get("bankName")}</b></td><td>{{bank_name}}</td></tr>
+<tr><td><b>{L.get("acc")}</b></td><td>{{bank_account}}</td></tr>
+<tr><td><b>{L.get("mfo")}</b></td><td>{{bank_mfo}}</td></tr>
 </table>
 
 <p><strong><u>{L.get("appShort")}</u></strong></br>
 <strong><u>{L.get("appDesc")}</u></strong></br>
-<strong><u>{esc(company_name)} {esc(reg_date)} {L.get("started")}</u></strong></br></br>
-{L.get("mainAct")} {esc(oked)}.</br>
-<strong><u>{esc(company_name)}</u></strong> {L.get("applied2")} {esc(purpose)}</br>
-{"{0}: {1} {2}; {3}: {4}.".format(L.get("applied3"), esc(requested_amount), esc(currency), L.get("term"), esc(loan_term_months))
-   if language == "ru"
-   else "{0}: {1} {2}; {3}: {4} months.".format(L.get("applied3"), esc(requested_amount), esc(currency), L.get("term"), esc(loan_term_months))
-   if language == "en"
-   else "{0} {1} {2}, {3} {4}".format(L.get("applied3"), esc(requested_amount), esc(currency), esc(loan_term_months), L.get("term"))
-}</br>
-{L.get("rates")} {esc(num_format(down_payment_percent))}%.</br></br>
+<strong><u>{{company_name}} {{reg_date}} {L.get("started")}</u></strong></br></br>
+{L.get("mainAct")} {{oked}}.</br>
+<strong><u>{{company_name}}</u></strong> {L.get("applied2")} {{purpose}}</br>
+{applied}</br>
+{L.get("rates")} {{down_payment_percent}}%.</br></br>
 <strong><u>{L.get("sourcePay")}</u></strong></p>
 
 <p><strong>{L.get("bankFill")}</strong></br></br>
-<strong>{L.get("mainObj")}</strong> {esc(main_obj_addr)}, {L.get("totalArea")} {esc(main_obj_total)} {ua}, {L.get("buildArea")} {esc(main_obj_land)} {ua}, {L.get("cad")} {esc(main_obj_cad)}.</br>
-{L.get("belongs")} {esc(company_name)}{L.get("belongs2")}</br>
+<strong>{L.get("mainObj")}</strong> {{main_obj_addr}}, {L.get("totalArea")} {{main_obj_total}} {ua}, {L.get("buildArea")} {{main_obj_land}} {ua}, {L.get("cad")} {{main_obj_cad}}.</br>
+{L.get("belongs")} {{company_name}}{L.get("belongs2")}</br>
 {L.get("infra")}</br>
-{L.get("built")} {esc(main_obj_extra)} {ua} {L.get("built2") if language in ("uz","cyrl") else ""}</p>
+{L.get("built")} {{main_obj_extra}} {ua} {L.get("built2") if language in ("uz","cyrl") else ""}</p>
 
 <h3>{L.get("collateralTitle")}</h3>
 <p><em><u>{L.get("reTitle")}</u></em></p>
-<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">
+{table}
 <tr>
 <th>{L.get("hTin")}</th><th>{L.get("hName")}</th><th>{L.get("hType")}</th>
 <th>{L.get("hCad")}</th><th>{L.get("hObjName")}</th><th>{L.get("hAddr")}</th><th>{L.get("hShare")}</th><th>{L.get("hInvCost")}</th><th>{L.get("hTotalArea")}</th><th>{L.get("hBuildArea")}</th><th>{L.get("hExtraArea")}</th><th>{L.get("hEstValue")}</th>
 </tr>
-{collateral_real_estate or f"<tr><td colspan='12'>---</td></tr>"}
+{{collateral_real_estate}}
 </table>
 
 </br>
 <p><em><u>{L.get("carTitle")}</u></em></p>
-<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">
+{table}
 <tr>
 <th>{L.get("hModel")}</th><th>{L.get("hColor")}</th><th>{L.get("hYear")}</th><th>{L.get("hKuzov")}</th><th>{L.get("hMotor")}</th><th>{L.get("hShassi")}</th><th>{L.get("hGosNumber")}</th><th>{L.get("hRegDate")}</th><th>{L.get("hDivision")}</th><th>{L.get("hOwner")}</th><th>{L.get("hAddr")}</th><th>{L.get("hEstValue")}</th>
 </tr>
-{collateral_cars or f"<tr><td colspan='12'>---</td></tr>"}
+{{collateral_cars}}
 </table>
 
 <p><i><u>{L.get("balanceTitle")}</u></i></p>
 <table border="1" cellspacing="0" cellpadding="5">
-<tr><th>{L.get("metric")}</th><th>{L.get("row")}</th><th colspan="2">{esc(company_name)}</th></tr>
+<tr><th>{L.get("metric")}</th><th>{L.get("row")}</th><th colspan="2">{{company_name}}</th></tr>
 <tr><th></th><th></th><th></th><th></th></tr>
-<tr><td>{S7["a"]}</td><td>010</td><td>{esc(find_row(forma1,"010","sum_begin_period"))}</td><td>{esc(find_row(forma1,"010","sum_end_period"))}</td></tr>
-<tr><td>{S7["b"]}</td><td>140</td><td>{esc(find_row(forma1,"140","sum_begin_period"))}</td><td>{esc(find_row(forma1,"140","sum_end_period"))}</td></tr>
-<tr><td>{S7["c"]}</td><td>210</td><td>{esc(find_row(forma1,"210","sum_begin_period"))}</td><td>{esc(find_row(forma1,"210","sum_end_period"))}</td></tr>
-<tr><td>{S7["d"]}</td><td>400</td><td>{esc(find_row(forma1,"400","sum_begin_period"))}</td><td>{esc(find_row(forma1,"400","sum_end_period"))}</td></tr>
-<tr><td>{S7["e"]}</td><td>601</td><td>{esc(find_row(forma1,"601","sum_begin_period"))}</td><td>{esc(find_row(forma1,"601","sum_end_period"))}</td></tr>
-<tr><td>{S7["f"]}</td><td>570</td><td>{esc(find_row(forma1,"570","sum_begin_period"))}</td><td>{esc(find_row(forma1,"570","sum_end_period"))}</td></tr>
-<tr><td>{S7["g"]}</td><td>730</td><td>{esc(find_row(forma1,"730","sum_begin_period"))}</td><td>{esc(find_row(forma1,"730","sum_end_period"))}</td></tr>
-<tr><td>{S7["h"]}</td><td>780</td><td>{esc(find_row(forma1,"780","sum_begin_period"))}</td><td>{esc(find_row(forma1,"780","sum_end_period"))}</td></tr>
-<tr><td>{L.get("finTitle")}</td><td></td><td></td><td></td></tr>
-<tr><td>{S7["i"]}</td><td>010</td><td>{esc(find_row(forma2,"010","sum_period_doxod"))}</td><td>{esc(find_row(forma2,"010","sum_period_rasxod"))}</td></tr>
-<tr><td>{S7["j"]}</td><td>270</td><td>{esc(find_row(forma2,"270","sum_period_doxod"))}</td><td>{esc(find_row(forma2,"270","sum_period_rasxod"))}</td></tr>
+{fin_rows}
 </table>
 
 <p><strong>{L.get("shortAbout")}</strong></br>
-{(
-    f"Test Company LLC korxonasi {esc(foundation_year)} yildan beri faoliyat yuritib, asosan {esc(oked)} sohasida xizmat ko‘rsatib keladi.</br>"
-    f"Korxona yuridik manzili: {esc(legal_address)}.</br>"
-    f"Korxona balansida {esc(buildings)} dona bino va {esc(land_area)} {ua} yer maydoni mavjud bo‘lib, hudud zarur infratuzilma va kommunikatsiyalar bilan ta’minlangan.</br>"
-    f"Tashkilotda {esc(employee_count)} nafar xodim ishlaydi va ishlab chiqarish quvvati yil sayin oshmoqda.</br>"
-    f"Moliyaviy ko‘rsatkichlar va bozordagi obro‘-e’tibori, shuningdek, aktivlarning likvidligi korxonaga yuqori ishonch beradi."
-) if language == "uz" else (
-    f"Test Company LLC корхонаси {esc(foundation_year)} йилдан бери фаолият юритиб, асосан {esc(oked)} соҳасида хизмат кўрсатиб келади.</br>"
-    f"Корхона юридик манзили: {esc(legal_address)}.</br>"
-    f"Корхона балансида {esc(buildings)} дона бино ва {esc(land_area)} {ua} ер майдони мавжуд бўлиб, ҳудуд зарур инфратузилма ва коммуникациялар билан таъминланган.</br>"
-    f"Ташкилотда {esc(employee_count)} нафар ходим ишлайди ва ишлаб чиқариш қуввати йил сайин ошмоқда.</br>"
-    f"Молиявий кўрсаткичлар ва бозордаги обрў-эътибори, шунингдек, активларнинг ликвидлиги корхонага юқори ишонч беради."
-) if language == "cyrl" else "---"}
+{short_about}
 </p>
 
 <p><em><u>{L.get("objs")}</u></em></p>
-<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">
+{table}
 <tr>
 <th>{L.get("hTin")}</th><th>{L.get("hName")}</th><th>{L.get("hType")}</th><th>{L.get("hCad")}</th><th>{L.get("hObjName")}</th><th>{L.get("hAddr")}</th><th>{L.get("hShare")}</th><th>{L.get("hInvCost")}</th><th>{L.get("hTotalArea")}</th><th>{L.get("hBuildArea")}</th><th>{L.get("hExtraArea")}</th>
 </tr>
-{tax_obj_rows or f"<tr><td colspan='11'>---</td></tr>"}
+{{tax_obj_rows}}
 </table>
 
 </br>
 <p><em><u>{L.get("cars")}</u></em></p>
-<table border="1" cellspacing="0" cellpadding="4" width="100%" style="font-family:'Times New Roman'; font-size:11pt;">
+{table}
 <tr>
 <th>{L.get("hModel")}</th><th>{L.get("hColor")}</th><th>{L.get("hYear")}</th><th>{L.get("hKuzov")}</th><th>{L.get("hMotor")}</th><th>{L.get("hShassi")}</th><th>{L.get("hGosNumber")}</th><th>{L.get("hRegDate")}</th><th>{L.get("hDivision")}</th><th>{L.get("hOwner")}</th><th>{L.get("hAddr")}</th>
 </tr>
-{car_obj_rows or f"<tr><td colspan='11'>---</td></tr>"}
+{{car_obj_rows}}
 </table>
 
 </div>
 <br><h2>{esc(L.get("expertConclusionTitle"))}</h2><br>
-{ai_conclusion}
-""".strip()
+""".lstrip()
+
+# Compiled once at import; any other language value renders like the original fallback
+# (uz labels without the uz-only sentences)
+TEMPLATE_LANGUAGES = ("uz", "cyrl", "ru", "en")
+TEMPLATES = {language: compile_template(language) for language in TEMPLATE_LANGUAGES}
+FALLBACK_TEMPLATE = compile_template("")
+
+def request_body(payload: Any) -> Dict[str, Any]:
+    # If payload is a list, try using the first element or treat it as the body
+    if isinstance(payload, list):
+        return payload[0] if payload else {}
+    return payload.get("body") if isinstance(payload.get("body"), dict) else payload
+
+def render_sections(payload: Any) -> str:
+    """Everything deterministic in the document, up to the expert conclusion heading."""
+    body = request_body(payload)
+    language = str(body.get("language", "uz")).lower()
+
+    L = DICT.get(language) or DICT["uz"]
+    template = TEMPLATES.get(language, FALLBACK_TEMPLATE)
+
+    company = get_in(body, ["company_info", "data"], {}) or {}
+    bank_info = body.get("bankInfo") or {}
+    app_data = get_in(body, ["applicationInfo", "applicationData"], {}) or {}
+    tax_objects = body.get("taxObjects") or {}
+    forma1 = get_in(body, ["forma_1", "data", 0, "rows"], []) or []
+    forma2 = get_in(body, ["forma_2", "data", 0, "rows"], []) or []
+    data_objects = safe_arr(tax_objects.get("dataObject"))
+
+    reg_date = val(bank_info.get("regDate"))
+
+    if language == "cyrl":
+        purpose = val(app_data.get("purposeCyrl"))
+    elif language == "ru":
+        purpose = val(app_data.get("purposeRu"))
+    elif language == "en":
+        purpose = val(app_data.get("purposeEn"))
+    else:
+        purpose = val(app_data.get("purposeUz"))
+
+    first_tax_obj = (data_objects[0] if data_objects else {}) or {}
+
+    land_sum = 0.0
+    for o in data_objects:
+        v = (o or {}).get("land_area")
+        try:
+            n = float(str(v or "").replace(" ", "").replace(",", "."))
+        except ValueError:
+            n = 0.0
+        if math.isfinite(n):
+            land_sum += n
+
+    # founders
+    founders_rows = []
+    for f in safe_arr(company.get("founders")):
+        is_individual = bool(get_in(f, ["founderIndividual"]))
+        is_legal = bool(get_in(f, ["founderLegal"]))
+        name = full_name(get_in(f, ["founderIndividual"], {}) or {}) if is_individual else val(get_in(f, ["founderLegal", "name"]))
+        type_ = L.get("ind") if is_individual else (L.get("leg") if is_legal else "---")
+        founders_rows.append(FOUNDER_ROW.format(esc(name), esc(type_), esc(val(f.get("sharePercent")))))
+
+    # collateral
+    collateral_real_estate = []
+    collateral_cars = []
+    for i in safe_arr(get_in(body, ["applicationInfo", "collateralData"])):
+        i = i or {}
+        if i.get("yurTaxObjectData") is not None or i.get("collateralType") == "REAL_ESTATE":
+            y = i.get("yurTaxObjectData") or {}
+            collateral_real_estate.append(ROW_12.format(
+                esc(val(y.get("tin"))),
+                esc(val(y.get("name"))),
+                esc(val(y.get("type"))),
+                esc(val(y.get("obj_code") or i.get("cadastreOrCarKuzov"))),
+                esc(val(y.get("obj_name"))),
+                esc(val(y.get("address") or i.get("address"))),
+                esc(val(y.get("percentage"))),
+                esc(num_format(y.get("inv_cost"))),
+                esc(num_format(y.get("total_area"))),
+                esc(num_format(y.get("land_area"))),
+                esc(num_format(y.get("land_extra_area"))),
+                esc(num_format(i.get("estimatedValue"))),
+            ))
+        if i.get("yurCarData") is not None or i.get("collateralType") == "VEHICLE":
+            c = i.get("yurCarData") or {}
+            collateral_cars.append(ROW_12.format(
+                esc(val(c.get("model"))),
+                esc(val(c.get("color"))),
+                esc(val(i.get("carYear") or c.get("year"))),
+                esc(val(i.get("cadastreOrCarKuzov") or c.get("kuzov"))),
+                esc(val(c.get("motor"))),
+                esc(val(c.get("shassi"))),
+                esc(val(i.get("carLicensePlate") or c.get("gosNumber"))),
+                esc(val(c.get("regDate"))),
+                esc(val(c.get("division"))),
+                esc(val(c.get("owner"))),
+                esc(val(c.get("adres") or i.get("address"))),
+                esc(num_format(i.get("estimatedValue"))),
+            ))
+
+    # company assets
+    tax_obj_rows = []
+    for item in data_objects:
+        item = item or {}
+        tax_obj_rows.append(ROW_11.format(
+            esc(val(item.get("tin"))),
+            esc(val(item.get("name"))),
+            esc(val(item.get("type"))),
+            esc(val(item.get("obj_code"))),
+            esc(val(item.get("obj_name"))),
+            esc(val(item.get("address"))),
+            esc(val(item.get("percentage"))),
+            esc(num_format(item.get("inv_cost"))),
+            esc(num_format(item.get("total_area"))),
+            esc(num_format(item.get("land_area"))),
+            esc(num_format(item.get("land_extra_area"))),
+        ))
+
+    car_obj_rows = []
+    for car in safe_arr(tax_objects.get("carDataObject")):
+        car = car or {}
+        car_obj_rows.append(ROW_11.format(
+            esc(val(car.get("model"))),
+            esc(val(car.get("color"))),
+            esc(val(car.get("year"))),
+            esc(val(car.get("kuzov"))),
+            esc(val(car.get("motor"))),
+            esc(val(car.get("shassi"))),
+            esc(val(car.get("gosNumber"))),
+            esc(val(car.get("regDate"))),
+            esc(val(car.get("division"))),
+            esc(val(car.get("owner"))),
+            esc(val(car.get("adres"))),
+        ))
+
+    cells = {
+        "company_name": esc(val(company.get("name"))),
+        "tin": esc(val(company.get("tin"))),
+        "oked": esc(val(get_in(company, ["okedDetail", "name"]))),
+        "category": esc(val(get_in(company, ["businessTypeDetail", "name"]))),
+        "employee_count": esc(num_format(body.get("employeeCount"))),
+        "legal_address": esc(join_address(
+            get_in(company, ["companyBillingAddress", "region", "name"]),
+            get_in(company, ["companyBillingAddress", "district", "name"]),
+            get_in(company, ["companyBillingAddress", "streetName"]),
+        )),
+        "business_fund": esc(num_format(company.get("businessFund"))),
+        "director_name": esc(full_name(company.get("director"))),
+        "founders_rows": "".join(founders_rows) or "<tr><td>---</td><td>---</td><td>---</td><td>---</td></tr>",
+        "bank_name": esc(val(bank_info.get("ns2Name"))),
+        "bank_account": esc(bank_acc_format(bank_info.get("account"))),
+        "bank_mfo": esc(val(bank_info.get("ns2Code"))),
+        "reg_date": esc(reg_date),
+        "purpose": esc(purpose),
+        "requested_amount": esc(num_format(app_data.get("requestedAmount"))),
+        "currency": esc(val(app_data.get("currency"))),
+        "loan_term_months": esc(val(app_data.get("loanTermMonths"))),
+        "down_payment_percent": esc(num_format(val(app_data.get("downPaymentPercent")))),
+        "main_obj_addr": esc(val(first_tax_obj.get("address"))),
+        "main_obj_total": esc(num_format(first_tax_obj.get("total_area"))),
+        "main_obj_land": esc(num_format(first_tax_obj.get("land_area"))),
+        "main_obj_cad": esc(val(first_tax_obj.get("obj_code"))),
+        "main_obj_extra": esc(num_format(first_tax_obj.get("land_extra_area"))),
+        "collateral_real_estate": "".join(collateral_real_estate) or "<tr><td colspan='12'>---</td></tr>",
+        "collateral_cars": "".join(collateral_cars) or "<tr><td colspan='12'>---</td></tr>",
+        "foundation_year": esc(reg_date[:4] if reg_date != "---" and re.match(r"^\d{4}", reg_date) else "---"),
+        "buildings": esc(str(len(data_objects) or "---")),
+        "land_area": esc(num_format(land_sum) if land_sum > 0 else "---"),
+        "tax_obj_rows": "".join(tax_obj_rows) or "<tr><td colspan='11'>---</td></tr>",
+        "car_obj_rows": "".join(car_obj_rows) or "<tr><td colspan='11'>---</td></tr>",
+    }
+    for key, (begin, end) in financial_block(forma1, forma2).items():
+        cells[f"fin_{key}_0"] = esc(begin)
+        cells[f"fin_{key}_1"] = esc(end)
+
+    return template.format_map(cells)
+
+def build_html(payload: Any, ai_conclusion: str) -> str:
+    return (render_sections(payload) + ai_conclusion).strip()
+
+# ---------------- prompt features ----------------
+
+# Section 7 lines under the names the model sees
+FINANCIAL_NAMES = {
+    "a": "fixed_assets_net",
+    "b": "inventory",
+    "c": "receivables",
+    "d": "total_assets",
+    "e": "current_payables",
+    "f": "long_term_bank_loans",
+    "g": "short_term_bank_loans",
+    "h": "total_liabilities",
+    "i": "net_revenue",
+    "j": "net_profit",
+}
+
+PURPOSE_FIELDS = {"uz": "purposeUz", "cyrl": "purposeCyrl", "ru": "purposeRu", "en": "purposeEn"}
+
+# Collateral items listed one by one; the rest only go into the totals
+TOP_COLLATERAL = int(os.getenv("DOCUMENT_TOP_COLLATERAL", "5"))
+# The raw-vs-features token saving is measured on one request in N (0 turns it off)
+PROMPT_SAMPLE_EVERY = int(os.getenv("DOCUMENT_PROMPT_SAMPLE_EVERY", "50"))
+
+TIKTOKEN_URL = "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken"
+
+_prompt_counters = {"requests": 0, "sampled": 0, "raw_tokens": 0, "feature_tokens": 0, "fallbacks": 0, "conclusion_errors": 0}
+_encoding: Any = None
+
+def feature_number(x: Any) -> float | int | None:
+    n = to_number(x)
+    if n is None:
+        return None
+    return int(n) if n.is_integer() else round(n, 2)
+
+def ratio(a: Any, b: Any, percent: bool = False) -> float | None:
+    a, b = to_number(a), to_number(b)
+    if a is None or not b:
+        return None
+    return round(a / b * (100 if percent else 1), 2 if percent else 3)
+
+def collateral_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    if item.get("yurCarData") is not None or item.get("collateralType") == "VEHICLE":
+        c = item.get("yurCarData") or {}
+        return {
+            "type": "vehicle",
+            "model": c.get("model"),
+            "year": item.get("carYear") or c.get("year"),
+            "plate": item.get("carLicensePlate") or c.get("gosNumber"),
+            "estimated_value": feature_number(item.get("estimatedValue")),
+        }
+    y = item.get("yurTaxObjectData") or {}
+    return {
+        "type": "real_estate",
+        "name": y.get("obj_name") or y.get("name"),
+        "address": y.get("address") or item.get("address"),
+        "total_area": feature_number(y.get("total_area")),
+        "land_area": feature_number(y.get("land_area")),
+        "estimated_value": feature_number(item.get("estimatedValue")),
+    }
+
+def prompt_features(payload: Any, top_n: int = TOP_COLLATERAL) -> Dict[str, Any]:
+    """What the conclusion is based on: profile, aggregates and ratios instead of every record."""
+    body = request_body(payload)
+    language = str(body.get("language", "uz")).lower()
+    company = get_in(body, ["company_info", "data"], {}) or {}
+    app_data = get_in(body, ["applicationInfo", "applicationData"], {}) or {}
+    tax_objects = body.get("taxObjects") or {}
+    data_objects = [o or {} for o in safe_arr(tax_objects.get("dataObject"))]
+    cars = [c or {} for c in safe_arr(tax_objects.get("carDataObject"))]
+    collateral = [i or {} for i in safe_arr(get_in(body, ["applicationInfo", "collateralData"]))]
 
-    return html
+    fin = financial_block(
+        get_in(body, ["forma_1", "data", 0, "rows"], []) or [],
+        get_in(body, ["forma_2", "data", 0, "rows"], []) or [],
+    )
+    financials = {FINANCIAL_NAMES[key]: [feature_number(v) for v in cells] for key, cells in fin.items()}
+    # Form 2 lines: income column first, expense (loss) column second
+    revenue = financials["net_revenue"][0]
+    profit_cells = financials["net_profit"]
+    net_profit = None if all(v is None for v in profit_cells) else (profit_cells[0] or 0) - (profit_cells[1] or 0)
+    total_assets = financials["total_assets"][1]
+
+    requested = feature_number(app_data.get("requestedAmount"))
+    items = sorted((collateral_item(i) for i in collateral), key=lambda c: c["estimated_value"] or 0, reverse=True)
+    collateral_total = sum(c["estimated_value"] or 0 for c in items)
+    first_value = feature_number(collateral[0].get("estimatedValue")) if collateral else None
+
+    def area_sum(field: str) -> float | int:
+        return feature_number(sum(to_number(o.get(field)) or 0 for o in data_objects)) or 0
+
+    years = [y for y in (feature_number(c.get("year")) for c in cars) if y]
+
+    return {
+        "language": language,
+        "company": {
+            "name": company.get("name"),
+            "tin": company.get("tin"),
+            "oked": get_in(company, ["okedDetail", "name"]),
+            "category": get_in(company, ["businessTypeDetail", "name"]),
+            "registered": get_in(body, ["bankInfo", "regDate"]),
+            "employees": feature_number(body.get("employeeCount")),
+            "business_fund": feature_number(company.get("businessFund")),
+            "founders": len(safe_arr(company.get("founders"))),
+        },
+        "application": {
+            "requested_amount": requested,
+            "currency": app_data.get("currency"),
+            "term_months": feature_number(app_data.get("loanTermMonths")),
+            "down_payment_percent": feature_number(app_data.get("downPaymentPercent")),
+            "purpose": app_data.get(PURPOSE_FIELDS.get(language, "purposeUz")) or app_data.get("purposeUz"),
+        },
+        "financials_begin_end": financials,
+        "ratios": {
+            "liabilities_to_assets": ratio(financials["total_liabilities"][1], total_assets),
+            "bank_loans_to_assets": ratio(
+                (financials["long_term_bank_loans"][1] or 0) + (financials["short_term_bank_loans"][1] or 0), total_assets
+            ),
+            "net_margin_percent": ratio(net_profit, revenue, percent=True),
+            "requested_to_revenue": ratio(requested, revenue),
+            "ltv_percent": ratio(requested, collateral_total, percent=True),
+            "ltv_first_collateral_percent": ratio(requested, first_value, percent=True),
+        },
+        "collateral": {
+            "count": len(items),
+            "total_estimated_value": feature_number(collateral_total),
+            "real_estate": sum(1 for c in items if c["type"] == "real_estate"),
+            "vehicles": sum(1 for c in items if c["type"] == "vehicle"),
+            "top": items[:top_n],
+        },
+        "assets": {
+            "real_estate_objects": len(data_objects),
+            "total_area": area_sum("total_area"),
+            "land_area": area_sum("land_area"),
+            "inventory_cost": area_sum("inv_cost"),
+            "vehicles": len(cars),
+            "vehicle_years": [min(years), max(years)] if years else None,
+        },
+    }
+
+def tiktoken_cached() -> bool:
+    # Same cache location as tiktoken.load.read_file_cached; get_encoding downloads the file otherwise
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR", os.environ.get("DATA_GYM_CACHE_DIR"))
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    return bool(cache_dir) and os.path.exists(os.path.join(cache_dir, hashlib.sha1(TIKTOKEN_URL.encode()).hexdigest()))
+
+def count_tokens(text: str) -> int:
+    """tiktoken count when the encoding is cached locally (never downloaded), otherwise ~4 characters per token."""
+    global _encoding
+    if _encoding is None:
+        _encoding = False
+        if tiktoken_cached():
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                pass
+    if _encoding is False:
+        return (len(text) + 3) // 4
+    return len(_encoding.encode(text))
+
+def sample_prompt_savings() -> bool:
+    return PROMPT_SAMPLE_EVERY > 0 and _prompt_counters["requests"] % PROMPT_SAMPLE_EVERY == 1 % PROMPT_SAMPLE_EVERY
+
+def record_prompt_savings(raw_payload: Any, prompt: str) -> None:
+    # Runs off the event loop on sampled requests: the raw dump is only built to measure what was saved
+    raw_tokens = count_tokens(json.dumps(raw_payload, ensure_ascii=False, indent=2))
+    feature_tokens = count_tokens(prompt)
+    _prompt_counters["sampled"] += 1
+    _prompt_counters["raw_tokens"] += raw_tokens
+    _prompt_counters["feature_tokens"] += feature_tokens
+    print(f"Document prompt: {feature_tokens} tokens instead of {raw_tokens} (saved {raw_tokens - feature_tokens})")
+
+def prompt_stats() -> Dict[str, Any]:
+    raw, sent = _prompt_counters["raw_tokens"], _prompt_counters["feature_tokens"]
+    return {
+        **_prompt_counters,
+        "saved_tokens": raw - sent,
+        "saved_ratio": round(1 - sent / raw, 3) if raw else None,
+        "tokenizer": "estimate" if _encoding is False else "o200k_base",
+    }
 
 # ---------------- FastAPI App ----------------
 
 load_dotenv()
-API_KEY = os.getenv("OPENAI_API_KEY")
 
-if not API_KEY:
-    raise RuntimeError("OPENAI_API_KEY is not set")
+CONCLUSION_PROMPT = prompts.register("document.conclusion", """Siz professional AI yordamchisiz. 
+
+Sizning vazifangiz: Yakuniy kredit bo‘yicha ekspert xulosasi yaratish.
+
+Xulosa qaysi tilda yaratilishi oxirgi xabardagi "language" parametrida aytilgan.
+Tavsif: oxirgi xabardagi "language_description" parametri.
+
+Qat'iy qoida va muhim qoida:
+• HECH QACHON, HECH BIR SO'Z HAM SO'RALGAN TILDAN BOSHQA TILDA CHIQMASIN! HAR BIR SO'Z VA HAR BIR GAP BELGILANGAN TILGAN TARJIMA QILINSIN!
+• Agar 'cyrl' (Kirill) so'ralsa, javobni to'liq KIRILL alifbosida yozing. Lotin harflari aralashtrilmasin!
+• YAXSHILAB UYLAB BIRNECHA MARTA TEKSHIKIB KEYIN RESULT BERILSIN
+
+<h3>Yakuniy kredit bo‘yicha ekspert xulosasi</h3>
+
+Xulosa quyidagilar asosida avtomatik shakllantiriladi:
+✓ Kompaniya faoliyat holati  
+✓ Har doim forma bo‘yicha 
+✓ Pul oqimi  
+✓ Zalog likvidligi  
+✓ Risklar
+✓ Kuchli tomonlar  
+
+Yuqoridagi natijalar hammasi qisqa londa bo'lsin. Hammasi bitta paragraphda yozilsin.
+
+Kredit berish xulosasini tuzish bo'yicha logika:
+- Moliyaviy yuk (Aylanma darajasi). Agar so'ralgan kredit summasi kompaniyaning yillik aylanmasidan oshiq bo'lsa, bunday holatni past kredit havfi va kredit bo'yicha qarzni to'lamaslik ehtimoli sifatida baholashingiz kerak.
+- Garov (LTV - Kreditning qiymatga nisbati):
+Agar taqdim etilgan garov kredit miqdoridan sezilarli darajada ortiq bo'lsa, LTV (Kreditning qiymatga nisbati) 64% gacha bo'lgan nisbat ijobiy hisoblanadi.
+Hozirgi holatda hisob-kitob natijasi: oxirgi xabardagi "ltv_status" parametri.
+
+XULOSA QUYIDAGILARDAN BIRI BO‘LISHI SHART, VA ULAR HAM BELGILANGAN TILGA ("language" parametri) TARJIMA QILINISHI SHART:
+
+1) Agar kredit berish tavsiya etilsa: <strong> Kredit berish tavsiya qilinadi </strong>
+2) Agar kredit berish tavsiya etilmasa: <strong> Kommitet tomonidan ko'rib chiqiladi </strong>
+
+QAT'IY BUYRUQ:
+oxirgi xabardagi "decision" parametri.
+Siz ushbu buyruqni o'zgartirishga haqqingiz yo'q. Faqat shu xulosani tanlab, uning sababini izohlashingiz kerak.
 
-llm = ChatOpenAI(
-    model="gpt-4o",
-    api_key=API_KEY,
-    temperature=0.3,
-)
+Yuqoridagi ikkita holat, hulosa ham albatta belgilangan tilgan tajrima qilish kerak, va o'sha tilda chiqarish kerak, boshqa tildagi qo'shimchalar bo'lmasin! Hech qachon belgilangan tildan boshqasiga tarjima qilmang!
+
+Va albatta izohlar bilan:
+– Nima sababdan berilishi kerak / berilmasligi kerak aynan jadvaldagi qaysi ma'lumot asosida olayapti.
+– Qaysi ko‘rsatkichga asoslanildi aynan jadvaldagi qaysi ma'lumot asosida olayapti.
+– Qaysi risklar mavjud aynan jadvaldagi qaysi ma'lumot asosida olayapti.
+– Qaysi kuchli jihatlar kreditni qo‘llab-quvvatlaydi aynan jadvaldagi qaysi ma'lumot asosida olayapti.
+- Hulosa rasmiy tilda yozilsin. jadval malumotlari korsatishda qavslar ichida emas, tabiiy shaklda yozilsin. Hulosa xar doim 9-bo'lim oxirida bulishi shart.
+====================================================================================
 
+Qat'iy qoidalar:
+• Har doim belgilangan tilgan tarjima qilishinshi shart. 
+• Ovoz ohangi — professional bank ekspertizasi
+• Javob juda ham sifatli va juda ham tez bo'lishi lozim.
+• Chiquvchi text malumotlar ham tartibli kerakli joylar alohida korsatilgan holatda bolishi kerak.
+• "language" fieldida so'ralgan tilda ("language" parametri) javob generatsiya qilish lozim!
+• Kredit tavsiya berish yoki bermaslik tavsiyasi <strong> tag ichida bulishi shard
+""")
+
+def llm_language(language: str) -> str:
+    return "uz" if language == "cyrl" else language
+
+_agent: Any = None
+
+def get_agent():
+    """One agent for every request: the system prompt is static, so its prefix stays cacheable.
+    Rebuilt when llm_clients hands out a new client (after close_clients), never kept on a closed one."""
+    global _agent
+    llm = get_llm("gpt-4o", 0.3)
+    if _agent is None or _agent[0] is not llm:
+        _agent = (llm, create_agent(model=llm, tools=[], system_prompt=prompts.get("document.conclusion")))
+    return _agent[1]
+
+async def conclusion_tokens(agent: Any, user_content: str, context: Dict[str, Any]) -> AsyncIterator[str]:
+    """Text chunks of the agent's answer as the model produces them."""
+    inputs = {"messages": [HumanMessage(content=user_content), prompts.context_message(context)]}
+    usage = None
+    start = time.perf_counter()
+    try:
+        async for chunk, _ in agent.astream(inputs, stream_mode="messages"):
+            if getattr(chunk, "usage_metadata", None):
+                usage = add_usage(usage, chunk.usage_metadata)
+            content = getattr(chunk, "content", None)
+            if isinstance(content, str) and content:
+                yield content
+    finally:
+        prompts.record_usage("document.conclusion", usage, time.perf_counter() - start)
+
+async def stream_document(head: str, tokens: "asyncio.Queue[str | None]", llm_task: "asyncio.Task") -> AsyncIterator[str]:
+    """Sends the rendered sections at once, then the conclusion as it arrives."""
+    try:
+        yield head
+        # build_html strips the document; hold back trailing whitespace until more text follows
+        pending = ""
+        while (token := await tokens.get()) is not None:
+            text = pending + token
+            stripped = text.rstrip()
+            pending = text[len(stripped):]
+            if stripped:
+                yield stripped
+    finally:
+        llm_task.cancel()
+
+def conclusion_failed(language: str) -> str:
+    L = DICT.get(language) or DICT["uz"]
+    return f"<p class='conclusion-error'><strong>{esc(L['conclusionFailed'])}</strong></p>"
 
 class WebhookRequest(RootModel):
     root: dict | list
@@ -832,11 +1213,11 @@ async def webhook(payload: WebhookRequest):
         # Language mapping for LLM understanding
         lang_map = {
             "uz": "O'zbek tili (Lotin alifbosi). Javob faqat Lotin alifbosida bo'lishi shart.",
-            "cyrl": "O'zbek tili (Kirill alifbosi). Javob faqat Kirill alifbosida bo'lishi shart. (Masalan: 'Хулоса...', 'Кредит бериш...'). Lotin alifbosidan foydalanish TAQIQLANADI.",
             "ru": "Rus tili (Kirill alifbosi).",
             "en": "Ingliz tili."
         }
-        lang_desc = lang_map.get(language, language)
+        # Cyrillic Uzbek is transliterated from the Latin answer (translit), not generated
+        lang_desc = lang_map.get(llm_language(language), language)
         
     except Exception as e:
         print(f"Error parsing logic fields: {e}")
@@ -846,76 +1227,74 @@ async def webhook(payload: WebhookRequest):
         ltv_status_text = "Noma'lum (Error in calculation)"
         decision_instruction = "Xatolik yuz berdi, 2-VARIANTni tanlang."
 
-    # Format input for LLM visibility
-    try:
-        input_json_str = json.dumps(raw_payload, ensure_ascii=False, indent=2)
-    except (TypeError, ValueError) as e:
-        raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
-
-    system_prompt = f"""Siz professional AI yordamchisiz. 
-
-Sizning vazifangiz: Yakuniy kredit bo‘yicha ekspert xulosasi yaratish.
-
-Kelgan JSONda "language" fieldida qaysi tilda xulosa yaratish aytilgan: {language}.
-Tavsif: {lang_desc}
-
-Qat'iy qoida va muhim qoida:
-• HECH QACHON, HECH BIR SO'Z HAM SO'RALGAN TILDAN BOSHQA TILDA CHIQMASIN! HAR BIR SO'Z VA HAR BIR GAP BELGILANGAN TILGAN TARJIMA QILINSIN!
-• Agar 'cyrl' (Kirill) so'ralsa, javobni to'liq KIRILL alifbosida yozing. Lotin harflari aralashtrilmasin!
-• YAXSHILAB UYLAB BIRNECHA MARTA TEKSHIKIB KEYIN RESULT BERILSIN
-
-<h3>Yakuniy kredit bo‘yicha ekspert xulosasi</h3>
-
-Xulosa quyidagilar asosida avtomatik shakllantiriladi:
-✓ Kompaniya faoliyat holati  
-✓ Har doim forma bo‘yicha 
-✓ Pul oqimi  
-✓ Zalog likvidligi  
-✓ Risklar
-✓ Kuchli tomonlar  
-
-Yuqoridagi natijalar hammasi qisqa londa bo'lsin. Hammasi bitta paragraphda yozilsin.
+    agent = get_agent()
+    context = {
+        "language": llm_language(language),
+        "language_description": lang_desc,
+        "ltv_status": ltv_status_text,
+        "decision": decision_instruction,
+    }
 
-Kredit berish xulosasini tuzish bo'yicha logika:
-- Moliyaviy yuk (Aylanma darajasi). Agar so'ralgan kredit summasi kompaniyaning yillik aylanmasidan oshiq bo'lsa, bunday holatni past kredit havfi va kredit bo'yicha qarzni to'lamaslik ehtimoli sifatida baholashingiz kerak.
-- Garov (LTV - Kreditning qiymatga nisbati):
-Agar taqdim etilgan garov kredit miqdoridan sezilarli darajada ortiq bo'lsa, LTV (Kreditning qiymatga nisbati) 64% gacha bo'lgan nisbat ijobiy hisoblanadi.
-Hozirgi holatda hisob-kitob natijasi: {ltv_status_text}.
+    tokens: "asyncio.Queue[str | None]" = asyncio.Queue()
 
-XULOSA QUYIDAGILARDAN BIRI BO‘LISHI SHART, VA ULAR HAM BELGILANGAN TILGA ({language}) TARJIMA QILINISHI SHART:
+    cyrillic = translit.CyrillicStream() if language == "cyrl" else None
 
-1) Agar kredit berish tavsiya etilsa: <strong> Kredit berish tavsiya qilinadi </strong>
-2) Agar kredit berish tavsiya etilmasa: <strong> Kommitet tomonidan ko'rib chiqiladi </strong>
-
-QAT'IY BUYRUQ:
-{decision_instruction}
-Siz ushbu buyruqni o'zgartirishga haqqingiz yo'q. Faqat shu xulosani tanlab, uning sababini izohlashingiz kerak.
-
-Yuqoridagi ikkita holat, hulosa ham albatta belgilangan tilgan tajrima qilish kerak, va o'sha tilda chiqarish kerak, boshqa tildagi qo'shimchalar bo'lmasin! Hech qachon belgilangan tildan boshqasiga tarjima qilmang!
-
-Va albatta izohlar bilan:
-– Nima sababdan berilishi kerak / berilmasligi kerak aynan jadvaldagi qaysi ma'lumot asosida olayapti.
-– Qaysi ko‘rsatkichga asoslanildi aynan jadvaldagi qaysi ma'lumot asosida olayapti.
-– Qaysi risklar mavjud aynan jadvaldagi qaysi ma'lumot asosida olayapti.
-– Qaysi kuchli jihatlar kreditni qo‘llab-quvvatlaydi aynan jadvaldagi qaysi ma'lumot asosida olayapti.
-- Hulosa rasmiy tilda yozilsin. jadval malumotlari korsatishda qavslar ichida emas, tabiiy shaklda yozilsin. Hulosa xar doim 9-bo'lim oxirida bulishi shart.
-====================================================================================
-
-Qat'iy qoidalar:
-• Har doim belgilangan tilgan tarjima qilishinshi shart. 
-• Ovoz ohangi — professional bank ekspertizasi
-• Javob juda ham sifatli va juda ham tez bo'lishi lozim.
-• Chiquvchi text malumotlar ham tartibli kerakli joylar alohida korsatilgan holatda bolishi kerak.
-• "language" fieldida so'ralgan tilda ({language}) javob generatsiya qilish lozim!
-• Kredit tavsiya berish yoki bermaslik tavsiyasi <strong> tag ichida bulishi shard
-"""
-
-    agent = create_agent(model=llm, tools=[], system_prompt=system_prompt)
-    
-    result = agent.invoke({"messages": [{"role": "user", "content": input_json_str}]})
-    ai_response_html = result["messages"][-1].content
-    
-    # Combine Code-based HTML Generation with AI Response
-    full_html = build_html(payload.root, ai_response_html)
-    
-    return HTMLResponse(content=full_html, status_code=200)
+    async def run_conclusion(user_content: str) -> None:
+        failed = False
+        try:
+            async for token in conclusion_tokens(agent, user_content, context):
+                if cyrillic is not None:
+                    token = cyrillic.feed(token)
+                if token:
+                    await tokens.put(token)
+        except Exception as e:
+            failed = True
+            _prompt_counters["conclusion_errors"] += 1
+            print(f"Error generating conclusion: {e!r}")
+        finally:
+            if cyrillic is not None:
+                await tokens.put(cyrillic.flush())
+            if failed:
+                # The headers (200) are already sent: the reader sees the failure in the document itself
+                await tokens.put(conclusion_failed(language))
+            await tokens.put(None)
+
+    # Only the figures the conclusion is based on go to the model, not the whole application
+    async def features() -> str:
+        return json.dumps(prompt_features(raw_payload), ensure_ascii=False, separators=(",", ":"))
+
+    def raw_dump(e: Exception) -> str:
+        _prompt_counters["fallbacks"] += 1
+        return json.dumps(raw_payload, ensure_ascii=False, indent=2)
+
+    # Start the conclusion as soon as its input is ready so the model works while the sections are rendered
+    llm_task = None
+
+    async def conclusion(features: str) -> None:
+        nonlocal llm_task
+        llm_task = asyncio.create_task(run_conclusion(features))
+
+    async def render() -> str:
+        return await asyncio.to_thread(render_sections, raw_payload)
+
+    _prompt_counters["requests"] += 1
+    try:
+        results = await pipeline.run("document", [
+            pipeline.Stage("features", features, fallback=raw_dump),
+            pipeline.Stage("conclusion", conclusion, deps=("features",)),
+            pipeline.Stage("render", render),
+        ])
+    except Exception:
+        if llm_task is not None:
+            llm_task.cancel()
+        raise
+    head = results["render"]
+    if sample_prompt_savings():
+        asyncio.get_running_loop().run_in_executor(None, record_prompt_savings, raw_payload, results["features"])
+
+    # Code-based HTML goes out immediately; the AI response is appended token by token
+    return StreamingResponse(
+        stream_document(head, tokens, llm_task),
+        status_code=200,
+        media_type="text/html; charset=utf-8",
+    )
@@ -1,55 +1,22 @@
 import os
 import json
-import io
 from typing import Any, Dict, List
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException, UploadFile, File
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import JSONResponse
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
-import pandas as pd
+
+import forma_cache
+import forma_extract
+import spreadsheet
+from llm_clients import get_llm
 
 router = APIRouter()
 
 # Load environment variables
 load_dotenv()
-API_KEY = os.getenv("OPENAI_API_KEY")
-
-if not API_KEY:
-    raise RuntimeError("OPENAI_API_KEY is not set")
-
-@router.post("/webhook/forma2")
-async def handle_forma2(file: UploadFile = File(...)):
-    """Migrated from forma2.json: Excel/CSV parsing via AI Agent for Forma №2."""
-    
-    # 1. Read file content based on type
-    content = await file.read()
-    filename = file.filename.lower()
-    
-    try:
-        if filename.endswith(".csv"):
-            df = pd.read_csv(io.BytesIO(content))
-        elif filename.endswith((".xls", ".xlsx")):
-            df = pd.read_excel(io.BytesIO(content))
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported file format. Use CSV, XLS, or XLSX.")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error reading Excel/CSV: {str(e)}")
-
-    # 2. Convert to generic text representation
-    lines = []
-    for i, row in df.iterrows():
-        # filter out empty values
-        values = [str(v).strip() for v in row if pd.notna(v) and str(v).strip() not in ("", "-", "null", "None")]
-        if values:
-            lines.append(" | ".join(values))
-    
-    cleaned_data = "\n".join(lines)
 
-    # 3. AI Agent Parsing (GPT-4o)
-    llm = ChatOpenAI(model="gpt-4o", api_key=API_KEY, temperature=0)
-    
-    system_prompt = """Siz moliyaviy natijalar to'g'risidagi hisobotlarni (Forma №2) tahlil qilish bo'yicha professional agentsiz.
+SYSTEM_PROMPT = """Siz moliyaviy natijalar to'g'risidagi hisobotlarni (Forma №2) tahlil qilish bo'yicha professional agentsiz.
 Sizga Excel faylidan olingan matn beriladi. Matndagi har bir qator " | " belgisi bilan ajratilgan ustunlardan iborat.
 
 VAZIFA:
@@ -94,9 +61,41 @@ DIQQAT (MUHIM QOIDALAR):
 - "rows_payments_to_budget" ichiga "BYUDJETGA TO'LOVLAR TO'G'RISIDA MA'LUMOT" nomli jadvaldagi ma'lumotlarni kiriting.
 """
 
+PROMPT_VERSION = forma_cache.prompt_version(SYSTEM_PROMPT + forma_extract.VERSION)
+
+@router.post("/webhook/forma2", openapi_extra=spreadsheet.UPLOAD_OPENAPI)
+async def handle_forma2(request: Request):
+    """Migrated from forma2.json: Excel/CSV parsing via AI Agent for Forma №2."""
+    
+    # 1. Read and decode the file (off the event loop)
+    with await spreadsheet.receive_upload(request) as upload:
+        # Re-uploads of the same workbook are served from the cache
+        cache_key = forma_cache.make_key("forma2", PROMPT_VERSION, upload.sha256)
+        cached = await forma_cache.get(cache_key)
+        if cached is not None:
+            return JSONResponse(content=cached)
+        df, cleaned_data = await spreadsheet.parse_upload(upload)
+
+    llm = get_llm("gpt-4o", 0)
+
+    # 2. Rule-based extraction; the LLM only fills header fields and rows the rules can't read
+    extracted = forma_extract.extract_forma2(df)
+    if extracted is not None:
+        try:
+            result = await forma_extract.resolve_with_llm(llm, SYSTEM_PROMPT, extracted)
+        except Exception as e:
+            print(f"Forma2 fallback parsing error: {e}")
+            if not any(extracted["data"].get(name) for name in forma_extract.FORMA2_SECTIONS):
+                raise HTTPException(status_code=500, detail=f"AI Parsing failed: {str(e)}")
+            # What the rules extracted, flagged as incomplete and not cached
+            return JSONResponse(content=forma_extract.incomplete(extracted))
+        await forma_cache.put(cache_key, result)
+        return JSONResponse(content=result)
+
+    # 3. Layout not recognized: AI Agent Parsing (GPT-4o) of the flattened text
     try:
-        response = llm.invoke([
-            SystemMessage(content=system_prompt),
+        response = await llm.ainvoke([
+            SystemMessage(content=SYSTEM_PROMPT),
             HumanMessage(content=cleaned_data)
         ])
         
@@ -104,6 +103,9 @@ DIQQAT (MUHIM QOIDALAR):
         if "```json" in text:
             text = text.split("```json")[1].split("```")[0].strip()
         
-        return JSONResponse(content=json.loads(text))
+        result = json.loads(text)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI Parsing failed: {str(e)}")
+
+    await forma_cache.put(cache_key, result)
+    return JSONResponse(content=result)
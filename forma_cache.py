@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# In-process tier (per uvicorn worker) and SQLite tier (shared by all workers on the host)
+MEMORY_SIZE = int(os.getenv("FORMA_CACHE_SIZE", "256"))
+DB_PATH = os.getenv("FORMA_CACHE_DB", "data/forma_cache.sqlite3")
+DB_SIZE = int(os.getenv("FORMA_CACHE_DB_SIZE", "5000"))
+
+_memory: "OrderedDict[str, Any]" = OrderedDict()
+_counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "memory_evictions": 0, "disk_evictions": 0}
+_db_ready = False
+
+def prompt_version(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+def make_key(form: str, version: str, content_sha256: str) -> str:
+    """Same bytes, same form and same prompt/extractor version -> same extraction."""
+    return f"{form}:{version}:{content_sha256}"
+
+# --- SQLite tier ---
+@contextmanager
+def _db():
+    global _db_ready
+    if not _db_ready:
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    try:
+        if not _db_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS forma_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS forma_cache_last_used ON forma_cache (last_used)")
+            _db_ready = True
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def _db_get(key: str) -> Optional[str]:
+    with _db() as conn:
+        row = conn.execute("SELECT value FROM forma_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE forma_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+    return row[0] if row else None
+
+def _db_put(key: str, value: str) -> int:
+    with _db() as conn:
+        conn.execute("INSERT OR REPLACE INTO forma_cache (key, value, last_used) VALUES (?, ?, ?)", (key, value, time.time()))
+        # LRU: keep the DB_SIZE most recently used entries
+        cur = conn.execute(
+            "DELETE FROM forma_cache WHERE key IN (SELECT key FROM forma_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (DB_SIZE,),
+        )
+        return cur.rowcount
+
+def _db_count() -> int:
+    with _db() as conn:
+        return conn.execute("SELECT COUNT(*) FROM forma_cache").fetchone()[0]
+
+# --- Public API ---
+def _remember(key: str, value: Any) -> None:
+    _memory[key] = value
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_SIZE:
+        _memory.popitem(last=False)
+        _counters["memory_evictions"] += 1
+
+async def get(key: str) -> Optional[Any]:
+    if key in _memory:
+        _memory.move_to_end(key)
+        _counters["memory_hits"] += 1
+        return _memory[key]
+
+    if DB_PATH:
+        try:
+            raw = await asyncio.to_thread(_db_get, key)
+        except sqlite3.Error as e:
+            print(f"Forma cache read error: {e}")
+            raw = None
+        if raw is not None:
+            value = json.loads(raw)
+            _remember(key, value)
+            _counters["disk_hits"] += 1
+            return value
+
+    _counters["misses"] += 1
+    return None
+
+async def put(key: str, value: Any) -> None:
+    _remember(key, value)
+    _counters["stores"] += 1
+    if DB_PATH:
+        try:
+            _counters["disk_evictions"] += await asyncio.to_thread(_db_put, key, json.dumps(value, ensure_ascii=False))
+        except sqlite3.Error as e:
+            print(f"Forma cache write error: {e}")
+
+async def cache_stats() -> Dict[str, Any]:
+    lookups = _counters["memory_hits"] + _counters["disk_hits"] + _counters["misses"]
+    disk_entries = None
+    if DB_PATH:
+        try:
+            disk_entries = await asyncio.to_thread(_db_count)
+        except sqlite3.Error:
+            pass
+    return {
+        **_counters,
+        "hit_rate": round((lookups - _counters["misses"]) / lookups, 3) if lookups else None,
+        "memory_entries": len(_memory),
+        "memory_size": MEMORY_SIZE,
+        "disk_entries": disk_entries,
+        "disk_size": DB_SIZE if DB_PATH else None,
+    }
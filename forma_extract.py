@@ -0,0 +1,266 @@
+import re
+import json
+import math
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+from langchain_core.messages import SystemMessage, HumanMessage
+
+# Rule-based extraction for the fixed-layout statutory forms. The LLM is only
+# asked for header fields and rows the rules couldn't resolve.
+
+# Bump when extraction rules change so cached results (forma_cache) are not reused
+VERSION = "2"
+
+HEADER_FIELDS = ("date", "company", "network", "inn", "address")
+# Header fields worth an LLM call when the rules miss them; network and address are often
+# absent from the exports and only filled in when the LLM is called for something else
+REQUIRED_HEADER = ("date", "company", "inn")
+
+FORMA1_FIELDS = ("sum_begin_period", "sum_end_period")
+FORMA2_FIELDS = ("sum_old_income", "sum_old_outcome", "sum_period_income", "sum_period_outcome")
+BUDGET_FIELDS = ("sum_begin_period", "sum_end_period")
+
+FORMA1_SECTIONS = {
+    "rows": FORMA1_FIELDS,
+    "rows_out_of_balance": FORMA1_FIELDS,
+}
+FORMA2_SECTIONS = {
+    "rows": FORMA2_FIELDS,
+    "rows_payments_to_budget": BUDGET_FIELDS,
+}
+
+# Titles that open the second table of each form (apostrophes normalized to ')
+SECTION_MARKERS = {
+    "rows_out_of_balance": ("balansdan tashqari", "балансдан ташқари", "забалансов"),
+    "rows_payments_to_budget": ("byudjetga to'lov", "бюджетга тўлов", "платежах в бюджет", "платежи в бюджет"),
+}
+
+EMPTY_VALUES = ("", "-", "null", "None", "nan")
+
+_CODE_RE = re.compile(r"^\d{3,4}$")
+_APOSTROPHES = re.compile(r"[‘’ʻʼ`´]")
+_INN_RE = re.compile(r"(?:INN|STIR|ИНН|СТИР)[^\d]{0,30}(\d{9})\b", re.IGNORECASE)
+
+# Labelled header lines, e.g. "Korxona, tashkilot | OOO Test" or "Адрес: г. Ташкент"
+HEADER_LABELS = {
+    "company": ("korxona, tashkilot", "korxona", "tashkilot", "корхона, ташкилот", "предприятие, организация", "организация"),
+    "network": ("tarmoq", "тармоқ", "отрасль"),
+    "address": ("manzil", "манзил", "адрес"),
+}
+
+_DATE_RE = re.compile(
+    r"\b(\d{1,2}\s+[A-Za-zА-Яа-яЁёЎўҚқҒғҲҳ'‘’ʻ]+\s+\d{4}\s*(?:y\.|г\.|йил|yil)?|\d{2}\.\d{2}\.\d{4})"
+)
+
+# --- Helpers ---
+def _text(v: Any) -> str:
+    if v is None or (isinstance(v, float) and math.isnan(v)):
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+def _row_code(v: Any) -> Optional[str]:
+    """Row codes are usually text ("010") but survive as numbers (10) when Excel typed them."""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        if isinstance(v, float) and (math.isnan(v) or not v.is_integer()):
+            return None
+        n = int(v)
+        return f"{n:03d}" if 10 <= n <= 9999 else None
+    s = _text(v)
+    return s if _CODE_RE.match(s) else None
+
+def parse_number(v: Any) -> Optional[float]:
+    """Reads 1 234 567,89 / (1 234) / 1234.5 style cells; returns None for blanks and non-numbers."""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return None if isinstance(v, float) and math.isnan(v) else float(v)
+    s = _text(v)
+    if s in EMPTY_VALUES:
+        return None
+    negative = s.startswith("(") and s.endswith(")")
+    s = re.sub(r"[\s ()]", "", s).replace(",", ".")
+    try:
+        n = float(s)
+    except ValueError:
+        return None
+    if not math.isfinite(n):
+        return None
+    return -n if negative else n
+
+def _format_number(n: Optional[float]) -> Optional[str]:
+    if n is None:
+        return None
+    return str(int(n)) if float(n).is_integer() else str(round(n, 2))
+
+def _find_code_column(grid: List[List[Any]]) -> Optional[int]:
+    width = max((len(r) for r in grid), default=0)
+    best, best_count = None, 0
+    for col in range(width):
+        count = sum(1 for r in grid if col < len(r) and _row_code(r[col]) is not None)
+        if count > best_count:
+            best, best_count = col, count
+    # A statutory form has dozens of coded rows; a handful of matches is noise
+    return best if best_count >= 5 else None
+
+def _line(row: List[Any]) -> str:
+    return " | ".join(t for t in (_text(v) for v in row) if t not in EMPTY_VALUES)
+
+def _section_for(line: str, sections: Dict[str, Any]) -> Optional[str]:
+    low = _APOSTROPHES.sub("'", line.lower())
+    for name in sections:
+        if any(m in low for m in SECTION_MARKERS.get(name, ())):
+            return name
+    return None
+
+def _header_from_lines(lines: List[str]) -> Dict[str, Any]:
+    header: Dict[str, Any] = {f: None for f in HEADER_FIELDS}
+    text = "\n".join(lines)
+    m = _INN_RE.search(text)
+    if m:
+        header["inn"] = m.group(1)
+    m = _DATE_RE.search(text)
+    if m:
+        header["date"] = m.group(1).strip()
+    for line in lines:
+        parts = [p.strip() for p in re.split(r"\s*\|\s*|:\s+", line, maxsplit=1)]
+        if len(parts) != 2 or not parts[1]:
+            continue
+        label = _APOSTROPHES.sub("'", parts[0].lower())
+        for field, names in HEADER_LABELS.items():
+            if header[field] is None and label.startswith(names):
+                header[field] = parts[1]
+                break
+    return header
+
+# --- Extraction ---
+def _extract(df: pd.DataFrame, sections: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # read_excel promotes the first line to column names; keep it, it may be a header line
+    columns = [None if str(c).startswith("Unnamed:") else c for c in df.columns]
+    grid = [columns] + df.astype(object).values.tolist()
+    code_col = _find_code_column(grid)
+    if code_col is None:
+        return None
+
+    section_names = list(sections)
+    current = section_names[0]
+    prev_code = None
+    header_lines: List[str] = []
+    coded: Dict[str, List[Any]] = {name: [] for name in section_names}
+    titles: Dict[str, str] = {}
+    first = None
+
+    for i, row in enumerate(grid):
+        code = _row_code(row[code_col]) if code_col < len(row) else None
+        if code is None:
+            line = _line(row)
+            marker = _section_for(line, sections)
+            if marker and marker != current:
+                current, prev_code = marker, None
+                titles[marker] = line
+            elif not any(coded.values()) and line:
+                header_lines.append(line)
+            continue
+
+        # Codes only grow inside a table; a restart means we've reached the second table
+        if prev_code is not None and int(code) <= int(prev_code):
+            idx = section_names.index(current)
+            if idx + 1 < len(section_names):
+                current = section_names[idx + 1]
+        prev_code = code
+        first = i if first is None else first
+        coded[current].append((code, row))
+
+    # Value columns: anything right of the code column that is filled in a coded row or in
+    # the column headings just above the first one; fully empty (merged-cell) columns drop out
+    all_coded = [row for name in section_names for _, row in coded[name]]
+    scan = grid[max(0, first - 3):first] + all_coded
+    value_cols = sorted({
+        c for row in scan for c in range(code_col + 1, len(row))
+        if _text(row[c]) not in EMPTY_VALUES
+    })
+
+    result: Dict[str, Any] = {}
+    unresolved: Dict[str, List[str]] = {name: [] for name in section_names}
+    for name, fields in sections.items():
+        rows = coded[name]
+        used = {c for _, row in rows for c in value_cols if c < len(row) and _text(row[c]) not in EMPTY_VALUES}
+        # A narrower table (payments to budget) sits in the leftmost value columns
+        cols = value_cols[:len(fields)]
+        fits = len(value_cols) == len(fields) or (len(value_cols) > len(fields) and used <= set(cols))
+        out = []
+        for code, row in rows:
+            cells = [row[c] if c < len(row) else None for c in cols]
+            stray = [_text(v) for v in cells if _text(v) not in EMPTY_VALUES and parse_number(v) is None]
+            if not fits or stray:
+                unresolved[name].append(_line(row))
+                continue
+            record = {"row_no": code}
+            record.update({f: _format_number(parse_number(v)) for f, v in zip(fields, cells)})
+            out.append(record)
+        result[name] = out
+
+    header = _header_from_lines(header_lines)
+    data = {**header, **result}
+    return {
+        "data": data,
+        "header_lines": header_lines,
+        "titles": titles,
+        "unresolved": {k: v for k, v in unresolved.items() if v},
+        "missing_header": [f for f in HEADER_FIELDS if not header.get(f)],
+    }
+
+def needs_llm(extracted: Dict[str, Any]) -> bool:
+    return bool(extracted["unresolved"]) or any(f in extracted["missing_header"] for f in REQUIRED_HEADER)
+
+def incomplete(extracted: Dict[str, Any]) -> Dict[str, Any]:
+    """What the rules extracted, flagged with what is still missing (when the LLM can't be reached)."""
+    return {
+        **extracted["data"],
+        "incomplete": True,
+        "missing_header": [f for f in REQUIRED_HEADER if f in extracted["missing_header"]],
+        "unresolved_rows": {name: len(rows) for name, rows in extracted["unresolved"].items()},
+    }
+
+def extract_forma1(df: pd.DataFrame) -> Optional[Dict[str, Any]]:
+    """Forma №1 (balance sheet): row code + begin/end of period sums."""
+    return _extract(df, FORMA1_SECTIONS)
+
+def extract_forma2(df: pd.DataFrame) -> Optional[Dict[str, Any]]:
+    """Forma №2 (financial results): row code + last year/period income and outcome, then payments to budget."""
+    return _extract(df, FORMA2_SECTIONS)
+
+def _parse_llm_json(text: str) -> Dict[str, Any]:
+    text = text.strip()
+    if "```json" in text:
+        text = text.split("```json")[1].split("```")[0].strip()
+    return json.loads(text)
+
+async def resolve_with_llm(llm: Any, system_prompt: str, extracted: Dict[str, Any]) -> Dict[str, Any]:
+    """Sends only the header lines and unresolved rows to the LLM and merges its answer in."""
+    data = extracted["data"]
+    if not needs_llm(extracted):
+        return data
+
+    lines = list(extracted["header_lines"])
+    for name, rows in extracted["unresolved"].items():
+        if name in extracted["titles"]:
+            lines.append(extracted["titles"][name])
+        lines.extend(rows)
+
+    response = await llm.ainvoke([
+        SystemMessage(content=system_prompt),
+        HumanMessage(content="\n".join(lines))
+    ])
+    patch = _parse_llm_json(response.content)
+
+    for field in extracted["missing_header"]:
+        if patch.get(field):
+            data[field] = patch[field]
+    for name in extracted["unresolved"]:
+        known = {r["row_no"] for r in data.get(name, [])}
+        for r in patch.get(name) or []:
+            if isinstance(r, dict) and str(r.get("row_no")) not in known:
+                data[name].append(r)
+        data[name].sort(key=lambda r: int(r["row_no"]) if str(r.get("row_no", "")).isdigit() else 0)
+    return data
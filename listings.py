@@ -0,0 +1,339 @@
+import os
+import re
+import math
+import time
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Comparable listings from the periodic marketplace dumps (CSV or Parquet). The file is
+# re-read when it changes, so a new dump only has to be copied over the old one.
+UY_JOY_PATH = os.getenv("LISTINGS_UY_JOY_PATH", "data/listings/uy_joy.csv")
+VEHICLES_PATH = os.getenv("LISTINGS_VEHICLES_PATH", "data/listings/vehicles.csv")
+RELOAD_INTERVAL = float(os.getenv("LISTINGS_RELOAD_INTERVAL", "300"))
+
+# Grid buckets of CELL_DEG x CELL_DEG degrees (~1.1 km north-south)
+CELL_DEG = float(os.getenv("LISTINGS_CELL_DEG", "0.01"))
+MAX_RADIUS_KM = float(os.getenv("LISTINGS_MAX_RADIUS_KM", "15"))
+# Comparable area: within +-AREA_BAND of the subject's area
+AREA_BAND = float(os.getenv("LISTINGS_AREA_BAND", "0.5"))
+DEFAULT_K = int(os.getenv("LISTINGS_K", "8"))
+# Vehicle comparables: same model, model year within +-YEAR_WINDOW
+YEAR_WINDOW = int(os.getenv("LISTINGS_YEAR_WINDOW", "3"))
+MIN_SAME_ENGINE = int(os.getenv("LISTINGS_MIN_SAME_ENGINE", "3"))
+
+UY_JOY_COLUMNS = ("latitude", "longitude", "type", "area_m2", "price_usd")
+VEHICLE_COLUMNS = ("model", "year", "price_usd")
+
+EARTH_RADIUS_KM = 6371.0
+
+def read_table(path: str) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+        # Needs pyarrow or fastparquet
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path)
+    # Rows end up in JSON prompts and responses: dates (e.g. listed_at) as ISO strings
+    for c in df.select_dtypes(include=["datetime", "datetimetz"]).columns:
+        df[c] = pd.Series([v.isoformat() if pd.notna(v) else None for v in df[c]], index=df.index, dtype=object)
+    return df
+
+def haversine_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def normalize_type(value: Any) -> str:
+    return str(value or "").strip().upper()
+
+def normalize_model(value: Any) -> str:
+    """Lowercase words only: "Chevrolet  Cobalt-LTZ" -> "chevrolet cobalt ltz"."""
+    return " ".join(re.findall(r"[0-9a-zа-яёўқғҳ]+", str(value or "").lower()))
+
+def normalize_engine(value: Any) -> Optional[str]:
+    """Engine volume in litres ("1.5", "1,5 L", "1485") or None when the value isn't a volume."""
+    m = re.search(r"\d+(?:[.,]\d+)?", str(value or ""))
+    if not m:
+        return None
+    n = float(m.group(0).replace(",", "."))
+    if 400 <= n <= 9000:
+        n = n / 1000
+    return f"{n:.1f}" if 0.5 <= n <= 9 else None
+
+# A volume written into a model name ("Cobalt 1.5 LTZ"); bare numbers there are generations ("Nexia 3")
+_MODEL_ENGINE_RE = re.compile(r"(?<![\d.,])(\d[.,]\d)(?![\d.,])")
+
+def vehicle_engine(body: Dict[str, Any]) -> Optional[str]:
+    """Engine volume of a webhook body, from ENGINE or the model name. MOTOR is the engine's
+    serial number ("4G15K123456"), never a volume."""
+    engine = normalize_engine(body.get("ENGINE"))
+    if engine is None:
+        m = _MODEL_ENGINE_RE.search(str(body.get("MODEL") or ""))
+        engine = normalize_engine(m.group(1)) if m else None
+    return engine
+
+class GeoIndex:
+    """Listings of one dump, bucketed by property type and grid cell."""
+
+    def __init__(self, df: pd.DataFrame):
+        missing = [c for c in UY_JOY_COLUMNS if c not in df.columns]
+        if missing:
+            raise ValueError(f"Listings dump is missing columns {missing}")
+
+        df = df.copy()
+        for c in ("latitude", "longitude", "area_m2", "price_usd"):
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+        df = df.dropna(subset=["latitude", "longitude", "area_m2", "price_usd"])
+        df = df[(df["area_m2"] > 0) & (df["price_usd"] > 0)].reset_index(drop=True)
+        df["type"] = df["type"].map(normalize_type)
+
+        self.df = df
+        self.lat = df["latitude"].to_numpy(dtype=float)
+        self.lon = df["longitude"].to_numpy(dtype=float)
+        self.area = df["area_m2"].to_numpy(dtype=float)
+        self.types = df["type"].to_numpy(dtype=object)
+
+        cells = pd.DataFrame({
+            "i": np.floor(self.lat / CELL_DEG).astype(np.int64),
+            "j": np.floor(self.lon / CELL_DEG).astype(np.int64),
+        })
+        # (cell_i, cell_j) -> row positions
+        self.cells: Dict[Tuple[int, int], np.ndarray] = {
+            (int(i), int(j)): idx for (i, j), idx in cells.groupby(["i", "j"]).indices.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def _ring(self, ci: int, cj: int, r: int) -> List[np.ndarray]:
+        if r == 0:
+            found = self.cells.get((ci, cj))
+            return [found] if found is not None else []
+        out = []
+        for di in range(-r, r + 1):
+            for dj in ((-r, r) if abs(di) != r else range(-r, r + 1)):
+                found = self.cells.get((ci + di, cj + dj))
+                if found is not None:
+                    out.append(found)
+        return out
+
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        area: Optional[float] = None,
+        property_type: Any = None,
+        k: int = DEFAULT_K,
+    ) -> List[Dict[str, Any]]:
+        """k nearest listings of the same type whose area is within the band, closest first."""
+        ci, cj = math.floor(latitude / CELL_DEG), math.floor(longitude / CELL_DEG)
+        km_per_ring = CELL_DEG * 111.0 * max(math.cos(math.radians(latitude)), 0.1)
+        max_rings = max(1, math.ceil(MAX_RADIUS_KM / km_per_ring))
+        wanted_type = normalize_type(property_type)
+
+        chunks: List[np.ndarray] = []
+        count, extra_ring = 0, None
+        for r in range(max_rings + 1):
+            for idx in self._ring(ci, cj, r):
+                if wanted_type:
+                    idx = idx[self.types[idx] == wanted_type]
+                if area:
+                    a = self.area[idx]
+                    idx = idx[(a >= area * (1 - AREA_BAND)) & (a <= area * (1 + AREA_BAND))]
+                if len(idx):
+                    chunks.append(idx)
+                    count += len(idx)
+            # One more ring after reaching k: a closer listing may sit just across a cell edge
+            if extra_ring is None and count >= k:
+                extra_ring = r + 1
+            if extra_ring is not None and r >= extra_ring:
+                break
+        if not chunks:
+            return []
+
+        idx = np.concatenate(chunks)
+        dist = haversine_km(latitude, longitude, self.lat[idx], self.lon[idx])
+        keep = dist <= MAX_RADIUS_KM
+        idx, dist = idx[keep], dist[keep]
+        if len(idx) > k:
+            top = np.argpartition(dist, k)[:k]
+            idx, dist = idx[top], dist[top]
+        order = np.argsort(dist)
+
+        columns = [c for c in ("title", "price_usd", "area_m2", "type", "address", "link", "listed_at") if c in self.df.columns]
+        rows = self.df.iloc[idx[order]][columns].to_dict("records")
+        for row, d in zip(rows, dist[order]):
+            row["price_per_m2_usd"] = round(row["price_usd"] / row["area_m2"], 2)
+            row["distance_km"] = round(float(d), 3)
+        return rows
+
+class VehicleIndex:
+    """Vehicle listings grouped by normalized model, each group sorted by model year."""
+
+    def __init__(self, df: pd.DataFrame):
+        missing = [c for c in VEHICLE_COLUMNS if c not in df.columns]
+        if missing:
+            raise ValueError(f"Listings dump is missing columns {missing}")
+
+        df = df.copy()
+        df["year"] = pd.to_numeric(df["year"], errors="coerce")
+        df["price_usd"] = pd.to_numeric(df["price_usd"], errors="coerce")
+        df = df.dropna(subset=["year", "price_usd"])
+        df = df[df["price_usd"] > 0]
+        df["model_key"] = df["model"].map(normalize_model)
+        df["engine_key"] = df["engine"].map(normalize_engine) if "engine" in df.columns else None
+        df = df[df["model_key"] != ""].sort_values(["model_key", "year"], kind="stable").reset_index(drop=True)
+
+        self.df = df
+        self.year = df["year"].to_numpy(dtype=float)
+        self.price = df["price_usd"].to_numpy(dtype=float)
+        self.engine = df["engine_key"].to_numpy(dtype=object)
+        # model_key -> (start, stop) row range
+        self.models: Dict[str, Tuple[int, int]] = {
+            key: (int(idx[0]), int(idx[-1]) + 1) for key, idx in df.groupby("model_key").indices.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def comparables(self, model: Any, year: Any, engine: Any = None) -> Optional[Dict[str, Any]]:
+        """Listings of the same model within +-YEAR_WINDOW years, same engine volume when there are enough."""
+        span = self.models.get(normalize_model(model))
+        try:
+            subject_year = float(year)
+        except (TypeError, ValueError):
+            return None
+        if span is None or not math.isfinite(subject_year):
+            return None
+
+        start, stop = span
+        years = self.year[start:stop]
+        # Rows of a model are sorted by year, so the window is a contiguous slice
+        lo = start + int(np.searchsorted(years, subject_year - YEAR_WINDOW, side="left"))
+        hi = start + int(np.searchsorted(years, subject_year + YEAR_WINDOW, side="right"))
+        if lo >= hi:
+            return None
+        idx = np.arange(lo, hi)
+
+        engine_key = normalize_engine(engine)
+        same_engine = False
+        if engine_key is not None:
+            same = idx[self.engine[idx] == engine_key]
+            if len(same) >= MIN_SAME_ENGINE:
+                idx, same_engine = same, True
+
+        # Display rows: closest model years first
+        shown = idx[np.argsort(np.abs(self.year[idx] - subject_year), kind="stable")]
+        columns = [c for c in ("title", "model", "year", "engine", "mileage_km", "price_usd", "link") if c in self.df.columns]
+        return {
+            "years": self.year[idx],
+            "prices_usd": self.price[idx],
+            "same_engine": same_engine,
+            "rows": self.df.iloc[shown][columns],
+        }
+
+# --- Loaded indexes, re-read when the dump changes ---
+class Dump:
+    """One dump file and the index built from it."""
+
+    def __init__(self, name: str, path: str, index_class: Any):
+        self.name = name
+        self.path = path
+        self.index_class = index_class
+        self.index: Any = None
+        self.mtime: Optional[float] = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+        self.counters = {"queries": 0, "hits": 0, "reloads": 0, "load_errors": 0, "total_ms": 0.0}
+
+    def _load(self) -> Tuple[Any, float]:
+        mtime = os.path.getmtime(self.path)
+        return self.index_class(read_table(self.path)), mtime
+
+    async def refresh(self, force: bool = False) -> None:
+        """Loads the dump if it appeared or changed since the last load (checked every RELOAD_INTERVAL)."""
+        now = time.monotonic()
+        if not force and now - self.checked_at < RELOAD_INTERVAL:
+            return
+        async with self.lock:
+            self.checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return
+            if mtime == self.mtime:
+                return
+            try:
+                self.index, self.mtime = await asyncio.to_thread(self._load)
+                self.counters["reloads"] += 1
+                print(f"Listings: loaded {len(self.index)} {self.name} listings from {self.path}")
+            except Exception as e:
+                # Keep serving the previous dump
+                self.counters["load_errors"] += 1
+                print(f"Listings: failed to load {self.path}: {e}")
+
+    def record(self, start: float, hit: bool) -> None:
+        self.counters["queries"] += 1
+        self.counters["total_ms"] += (time.perf_counter() - start) * 1000
+        if hit:
+            self.counters["hits"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        c = self.counters
+        return {
+            "path": self.path,
+            "listings": len(self.index) if self.index is not None else None,
+            "queries": c["queries"],
+            "hits": c["hits"],
+            "reloads": c["reloads"],
+            "load_errors": c["load_errors"],
+            "avg_query_ms": round(c["total_ms"] / c["queries"], 3) if c["queries"] else None,
+        }
+
+uy_joy = Dump("real-estate", UY_JOY_PATH, GeoIndex)
+vehicles = Dump("vehicle", VEHICLES_PATH, VehicleIndex)
+
+async def start() -> None:
+    await uy_joy.refresh(force=True)
+    await vehicles.refresh(force=True)
+
+async def find_comparables(
+    latitude: Any, longitude: Any, area: Any = None, property_type: Any = None, k: int = DEFAULT_K
+) -> Optional[List[Dict[str, Any]]]:
+    """Local real-estate comparables, or None when there is no dump or no usable coordinates."""
+    await uy_joy.refresh()
+    try:
+        lat, lon = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if uy_joy.index is None or not (math.isfinite(lat) and math.isfinite(lon)):
+        return None
+    try:
+        area_value = float(area) if area else None
+    except (TypeError, ValueError):
+        area_value = None
+
+    start = time.perf_counter()
+    rows = uy_joy.index.nearest(lat, lon, area_value, property_type, k)
+    uy_joy.record(start, bool(rows))
+    return rows
+
+async def find_vehicle_comparables(model: Any, year: Any, engine: Any = None) -> Optional[Dict[str, Any]]:
+    """Local vehicle comparables (arrays for pricing plus display rows), or None."""
+    await vehicles.refresh()
+    if vehicles.index is None:
+        return None
+    start = time.perf_counter()
+    found = vehicles.index.comparables(model, year, engine)
+    vehicles.record(start, found is not None)
+    return found
+
+def listings_stats() -> Dict[str, Any]:
+    return {"uy_joy": uy_joy.stats(), "vehicles": vehicles.stats()}
@@ -0,0 +1,116 @@
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+import httpx
+from dotenv import load_dotenv
+from langchain_openai import ChatOpenAI
+
+# Load environment variables
+load_dotenv()
+API_KEY = os.getenv("OPENAI_API_KEY")
+
+if not API_KEY:
+    raise RuntimeError("OPENAI_API_KEY is not set")
+
+# Pool sizing (shared by every ChatOpenAI instance in the process)
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "50"))
+MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "120"))
+
+# --- Shared HTTP clients ---
+_limits = httpx.Limits(
+    max_connections=MAX_CONNECTIONS,
+    max_keepalive_connections=MAX_KEEPALIVE,
+    keepalive_expiry=KEEPALIVE_EXPIRY,
+)
+_timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=10.0)
+
+_counters = {"requests": 0, "responses": 0, "errors": 0}
+
+class _CountingTransport(httpx.AsyncHTTPTransport):
+    # Counts around the send itself, so timeouts and connect errors also end a request
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        _counters["requests"] += 1
+        ok = False
+        try:
+            response = await super().handle_async_request(request)
+            ok = True
+            return response
+        finally:
+            _counters["responses" if ok else "errors"] += 1
+
+_async_client: httpx.AsyncClient | None = None
+_sync_client: httpx.Client | None = None
+
+# (model, temperature) -> ChatOpenAI
+_registry: Dict[Tuple[str, float], ChatOpenAI] = {}
+_lock = threading.Lock()
+
+def _http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    global _async_client, _sync_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(transport=_CountingTransport(limits=_limits), timeout=_timeout)
+    if _sync_client is None or _sync_client.is_closed:
+        _sync_client = httpx.Client(limits=_limits, timeout=_timeout)
+    return _sync_client, _async_client
+
+def get_llm(model: str = "gpt-4o", temperature: float = 0.3) -> ChatOpenAI:
+    """Returns the process-wide ChatOpenAI for (model, temperature), creating it on first use."""
+    key = (model, float(temperature))
+    llm = _registry.get(key)
+    if llm is not None:
+        return llm
+    with _lock:
+        llm = _registry.get(key)
+        if llm is None:
+            sync_client, async_client = _http_clients()
+            llm = ChatOpenAI(
+                model=model,
+                api_key=API_KEY,
+                temperature=temperature,
+                # Streamed calls report usage (incl. cached prompt tokens) in their last chunk
+                stream_usage=True,
+                http_client=sync_client,
+                http_async_client=async_client,
+            )
+            _registry[key] = llm
+    return llm
+
+def init_clients(specs: Any = (("gpt-4o", 0.3), ("gpt-4o", 0))) -> None:
+    """Creates the pooled clients at startup so the first request doesn't pay for it."""
+    for model, temperature in specs:
+        get_llm(model, temperature)
+
+async def close_clients() -> None:
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+    if _sync_client is not None:
+        _sync_client.close()
+    _async_client = None
+    _sync_client = None
+    _registry.clear()
+
+def pool_stats() -> Dict[str, Any]:
+    """Connection pool usage, for sizing LLM_MAX_CONNECTIONS / LLM_MAX_KEEPALIVE."""
+    connections = []
+    if _async_client is not None:
+        # httpx doesn't expose the pool publicly; fall back to an empty list if internals change
+        pool = getattr(getattr(_async_client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+
+    idle = sum(1 for c in connections if getattr(c, "is_idle", lambda: False)())
+    return {
+        "clients": [f"{model}@{temperature}" for model, temperature in _registry],
+        "max_connections": MAX_CONNECTIONS,
+        "max_keepalive_connections": MAX_KEEPALIVE,
+        "open_connections": len(connections),
+        "idle_connections": idle,
+        "active_connections": len(connections) - idle,
+        "requests_sent": _counters["requests"],
+        "responses_received": _counters["responses"],
+        "request_errors": _counters["errors"],
+        "in_flight": _counters["requests"] - _counters["responses"] - _counters["errors"],
+    }
@@ -1,11 +1,26 @@
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
 import uvicorn
 
+import cbu_rates
+import doctors
+import forma_cache
+import listings
+import llm_clients
+import pipeline
+import prompts
+import reasons
+import spreadsheet
+import symptoms
 import document
 import uy_joy
+import valuation_cache
 import avto
+import batch
 import forma1
 import forma2
 import xmed
@@ -14,19 +29,64 @@ import xmed
 # Load environment
 load_dotenv()
 
-app = FastAPI(title="Unified Multi-Agent API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared resources are created once per worker and reused by every router
+    llm_clients.init_clients()
+    await cbu_rates.start()
+    await listings.start()
+    await doctors.start()
+    spreadsheet.start()
+    yield
+    spreadsheet.stop()
+    await doctors.stop()
+    await cbu_rates.stop()
+    await llm_clients.close_clients()
+
+app = FastAPI(title="Unified Multi-Agent API", lifespan=lifespan)
 
 # Register routes from each module
 app.include_router(document.router)
 app.include_router(uy_joy.router)
 app.include_router(avto.router)
+app.include_router(batch.router)
+app.include_router(valuation_cache.router)
 app.include_router(forma1.router)
 app.include_router(forma2.router)
 app.include_router(xmed.router)
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # Oversized forma and batch uploads are refused on Content-Length, before the body is read
+    if request.url.path.startswith("/webhook/forma") or request.url.path.endswith("/batch"):
+        try:
+            spreadsheet.check_content_length(request.headers.get("content-length"))
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+    return await call_next(request)
+
 @app.get("/")
 async def root():
     return {"status": "ok", "message": "Unified API is running"}
 
+@app.get("/stats")
+async def stats():
+    return {
+        "llm_pool": llm_clients.pool_stats(),
+        "cbu_rates": cbu_rates.rates_stats(),
+        "spreadsheet_pool": spreadsheet.pool_stats(),
+        "forma_cache": await forma_cache.cache_stats(),
+        "document_prompt": document.prompt_stats(),
+        "prompt_cache": prompts.usage_stats(),
+        "reason_cache": await reasons.cache_stats(),
+        "pipelines": pipeline.pipeline_stats(),
+        "listings": listings.listings_stats(),
+        "batch": batch.batch_stats(),
+        "valuation_cache": valuation_cache.cache_stats(),
+        "xmed_sessions": await asyncio.to_thread(xmed.checkpointer_stats),
+        "doctors": doctors.doctors_stats(),
+        "symptom_classifier": symptoms.classifier_stats(),
+    }
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,126 @@
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Small stage-graph executor for the agent endpoints: every stage starts as soon as the
+# stages it depends on are done, so independent work (rate lookup, web search,
+# rendering) overlaps instead of running one after another.
+
+# Default stage timeouts (seconds) used by the agent endpoints
+SEARCH_TIMEOUT = float(os.getenv("PIPELINE_SEARCH_TIMEOUT", "60"))
+RATE_TIMEOUT = float(os.getenv("PIPELINE_RATE_TIMEOUT", "15"))
+LLM_TIMEOUT = float(os.getenv("PIPELINE_LLM_TIMEOUT", "120"))
+
+_NO_FALLBACK = object()
+
+# pipeline -> stage -> timings and outcome counters
+_stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+
+class StageTimeout(Exception):
+    pass
+
+class Stage:
+    """A named step. `func` receives the results of `deps` as keyword arguments.
+
+    On error or timeout the stage resolves to `fallback` (a value, or a callable taking the
+    exception) when one is given; otherwise the whole pipeline fails with that error."""
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Awaitable[Any]],
+        deps: Iterable[str] = (),
+        timeout: Optional[float] = None,
+        fallback: Any = _NO_FALLBACK,
+    ):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.fallback = fallback
+
+def _record(pipeline: str, stage: str, elapsed: float, outcome: str) -> None:
+    s = _stats.setdefault(pipeline, {}).setdefault(
+        stage, {"runs": 0, "failures": 0, "timeouts": 0, "fallbacks": 0, "total_ms": 0.0, "max_ms": 0.0}
+    )
+    ms = elapsed * 1000
+    s["runs"] += 1
+    s["total_ms"] += ms
+    s["max_ms"] = max(s["max_ms"], ms)
+    if outcome != "ok":
+        s[outcome] += 1
+
+async def run(pipeline: str, stages: List[Stage]) -> Dict[str, Any]:
+    """Runs the stages and returns {stage name: result}."""
+    by_name = {stage.name: stage for stage in stages}
+    if len(by_name) != len(stages):
+        raise ValueError(f"Duplicate stage names in pipeline '{pipeline}'")
+    for stage in stages:
+        missing = [d for d in stage.deps if d not in by_name]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stages {missing}")
+
+    tasks: Dict[str, "asyncio.Task[Any]"] = {}
+
+    async def execute(stage: Stage) -> Any:
+        inputs = {dep: await tasks[dep] for dep in stage.deps}
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(stage.func(**inputs), stage.timeout)
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = StageTimeout(f"Stage '{stage.name}' timed out after {stage.timeout}s")
+            timed_out = isinstance(e, StageTimeout)
+            if stage.fallback is _NO_FALLBACK:
+                _record(pipeline, stage.name, time.perf_counter() - start, "timeouts" if timed_out else "failures")
+                raise e
+            print(f"Pipeline {pipeline}: stage '{stage.name}' failed ({e}), using fallback")
+            _record(pipeline, stage.name, time.perf_counter() - start, "timeouts" if timed_out else "fallbacks")
+            return stage.fallback(e) if callable(stage.fallback) else stage.fallback
+        _record(pipeline, stage.name, time.perf_counter() - start, "ok")
+        return result
+
+    # Tasks are created in dependency order, so every dep task exists before it is awaited
+    order: List[Stage] = []
+    pending = list(stages)
+    while pending:
+        done = {s.name for s in order}
+        ready = [s for s in pending if all(d in done for d in s.deps)]
+        if not ready:
+            raise ValueError(f"Dependency cycle in pipeline '{pipeline}': {[s.name for s in pending]}")
+        order.extend(ready)
+        pending = [s for s in pending if s not in ready]
+    for stage in order:
+        tasks[stage.name] = asyncio.create_task(execute(stage))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        # Let cancelled stages finish unwinding before the error propagates
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    return {name: task.result() for name, task in tasks.items()}
+
+def pipeline_stats() -> Dict[str, Any]:
+    return {
+        pipeline: {
+            stage: {
+                "runs": int(s["runs"]),
+                "failures": int(s["failures"]),
+                "timeouts": int(s["timeouts"]),
+                "fallbacks": int(s["fallbacks"]),
+                "avg_ms": round(s["total_ms"] / s["runs"], 1) if s["runs"] else None,
+                "max_ms": round(s["max_ms"], 1),
+            }
+            for stage, s in stages.items()
+        }
+        for pipeline, stages in _stats.items()
+    }
@@ -0,0 +1,54 @@
+import os
+import math
+from typing import Any, Dict, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Deterministic vehicle pricing from local comparables: every listing is moved to the
+# subject's model year with a fixed yearly depreciation, and the range is taken from
+# the spread of the adjusted prices.
+DEPRECIATION = float(os.getenv("AVTO_DEPRECIATION", "0.02"))
+LOW_PERCENTILE = float(os.getenv("AVTO_LOW_PERCENTILE", "25"))
+HIGH_PERCENTILE = float(os.getenv("AVTO_HIGH_PERCENTILE", "75"))
+MIN_COMPARABLES = int(os.getenv("AVTO_MIN_COMPARABLES", "3"))
+# Prices are rounded to this many UZS
+ROUND_TO = 100_000
+
+def adjust_to_year(prices_usd: np.ndarray, years: np.ndarray, subject_year: float, rate: float = DEPRECIATION) -> np.ndarray:
+    """A car one year newer than the subject is worth (1 - rate) less once brought to the subject's year."""
+    return prices_usd * (1.0 - rate) ** (years - subject_year)
+
+def price_range(
+    prices_usd: np.ndarray, years: np.ndarray, subject_year: Any, usd_rate: float
+) -> Optional[Dict[str, Any]]:
+    """Min/max market price in UZS from comparables, or None if there are too few of them."""
+    try:
+        subject = float(subject_year)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(subject) or len(prices_usd) < MIN_COMPARABLES or not usd_rate:
+        return None
+
+    adjusted = adjust_to_year(np.asarray(prices_usd, dtype=float), np.asarray(years, dtype=float), subject)
+    # Outlier-resistant: interquartile spread, widened to min/max only when the sample is tiny
+    if len(adjusted) >= 2 * MIN_COMPARABLES:
+        low, high = np.percentile(adjusted, [LOW_PERCENTILE, HIGH_PERCENTILE])
+    else:
+        low, high = adjusted.min(), adjusted.max()
+    median = float(np.median(adjusted))
+
+    def uzs(usd: float) -> int:
+        return int(round(usd * usd_rate / ROUND_TO) * ROUND_TO)
+
+    return {
+        "estimated_min_price": uzs(low),
+        "estimated_max_price": uzs(high),
+        "median_price_usd": round(median, 2),
+        "comparables": int(len(adjusted)),
+        "depreciation_per_year": DEPRECIATION,
+        "usd_rate": usd_rate,
+    }
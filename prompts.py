@@ -0,0 +1,62 @@
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+# Static system prompts by name. The text must not depend on the request: OpenAI caches
+# prompt prefixes (1024+ tokens) only when they are byte-identical between calls, so
+# per-request values (language, rate, decision) go into a trailing message instead.
+_prompts: Dict[str, str] = {}
+
+# name -> usage totals reported by the provider
+_usage: Dict[str, Dict[str, float]] = {}
+
+def register(name: str, text: str) -> str:
+    if name in _prompts and _prompts[name] != text:
+        raise ValueError(f"Prompt '{name}' is already registered with a different text")
+    _prompts[name] = text
+    return text
+
+def get(name: str) -> str:
+    return _prompts[name]
+
+def context_message(context: Dict[str, Any]) -> HumanMessage:
+    """Per-request values, sent after everything that can be cached."""
+    lines = [f"{key}: {value}" for key, value in context.items()]
+    return HumanMessage(content="Parametrlar:\n" + "\n".join(lines))
+
+def messages(name: str, user_content: str, context: Optional[Dict[str, Any]] = None) -> List[BaseMessage]:
+    result: List[BaseMessage] = [SystemMessage(content=_prompts[name]), HumanMessage(content=user_content)]
+    if context:
+        result.append(context_message(context))
+    return result
+
+def record_usage(name: str, usage: Optional[Dict[str, Any]], elapsed: float) -> None:
+    """Adds one call's usage_metadata (input, cached and output tokens) and latency."""
+    stats = _usage.setdefault(name, {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "seconds": 0.0})
+    stats["calls"] += 1
+    stats["seconds"] += elapsed
+    if usage:
+        stats["input_tokens"] += usage.get("input_tokens") or 0
+        stats["output_tokens"] += usage.get("output_tokens") or 0
+        stats["cached_tokens"] += (usage.get("input_token_details") or {}).get("cache_read") or 0
+
+async def ainvoke(llm: Any, name: str, user_content: str, context: Optional[Dict[str, Any]] = None) -> Any:
+    """llm.ainvoke with the registered prompt, recording cache usage under the prompt's name."""
+    start = time.perf_counter()
+    response = await llm.ainvoke(messages(name, user_content, context))
+    record_usage(name, getattr(response, "usage_metadata", None), time.perf_counter() - start)
+    return response
+
+def usage_stats() -> Dict[str, Any]:
+    return {
+        name: {
+            "calls": int(s["calls"]),
+            "input_tokens": int(s["input_tokens"]),
+            "cached_tokens": int(s["cached_tokens"]),
+            "output_tokens": int(s["output_tokens"]),
+            "cache_hit_rate": round(s["cached_tokens"] / s["input_tokens"], 3) if s["input_tokens"] else None,
+            "avg_latency_ms": round(s["seconds"] / s["calls"] * 1000, 1) if s["calls"] else None,
+        }
+        for name, s in _usage.items()
+    }
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+import prompts
+import translit
+from llm_clients import get_llm
+
+# Load environment variables
+load_dotenv()
+
+# Valuation explanations are generated in the language the client asked for; the others
+# are produced on demand (follow-up endpoint) and kept per (valuation_id, language).
+# In-process tier (per uvicorn worker) and SQLite tier shared by all workers on the host, so
+# the follow-up finds a valuation whichever worker served it.
+CACHE_SIZE = int(os.getenv("REASON_CACHE_SIZE", "2000"))
+CACHE_TTL = float(os.getenv("REASON_CACHE_TTL", str(24 * 3600)))
+DB_PATH = os.getenv("REASON_CACHE_DB", "data/reasons.sqlite3")
+DB_SIZE = int(os.getenv("REASON_CACHE_DB_SIZE", "20000"))
+
+# Language descriptions sent to the model ("cyrl" is transliterated from "uz")
+LANGUAGES = {
+    "uz": "O'zbek tili (lotin alifbosi)",
+    "ru": "Rus tili",
+    "en": "Ingliz tili",
+}
+ALL_LANGUAGES = ("uz", "cyrl", "ru", "en")
+
+_ALIASES = {
+    "uz": "uz", "uz_latn": "uz",
+    "cyrl": "cyrl", "uz_cyrl": "cyrl", "uz_kiril": "cyrl", "kiril": "cyrl",
+    "ru": "ru", "en": "en", "all": "all",
+}
+
+REASON_PROMPT = prompts.register("valuation.reason", """Siz O‘zbekiston bozorida baholash bo‘yicha ekspert agentsiz.
+Sizga obyekt ma’lumotlari, web qidiruvdan kelgan e’lonlar va aniqlangan narx oralig‘i beriladi.
+Vazifa: narx oralig‘i nima asosida aniqlanganini qisqa va rasmiy tilda tushuntirish.
+
+Qoidalar:
+- Tushuntirish oxirgi xabardagi "language" parametrida ko‘rsatilgan tilda yozilsin, boshqa tildagi so‘zlar aralashmasin.
+- Narxlarni o‘zgartirmang, faqat berilgan oralig‘ni izohlang.
+- FAQAT HTML qaytaring (<p>, <ul>, <li>, <strong>), JSON yoki markdown emas.""")
+
+# valuation_id -> (expires_at, context) and (valuation_id, language) -> (expires_at, html)
+_valuations: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_reasons: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+_in_flight: Dict[Tuple[str, str], "asyncio.Task[str]"] = {}
+_counters = {"valuations": 0, "hits": 0, "misses": 0, "disk_hits": 0, "generated": 0, "transliterated": 0, "evictions": 0, "disk_evictions": 0}
+_db_ready = False
+
+def normalize_language(value: Any, default: str = "uz") -> str:
+    if value is None or value == "":
+        return default
+    language = _ALIASES.get(str(value).strip().lower())
+    if language is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported language '{value}'. Use uz, cyrl, ru, en or all.")
+    return language
+
+def expand(language: str) -> List[str]:
+    return list(ALL_LANGUAGES) if language == "all" else [language]
+
+def model_language(language: str) -> str:
+    """Language the valuation call writes its reason in ("cyrl" and "all" start from Latin Uzbek)."""
+    return "uz" if language in ("all", "cyrl") else language
+
+# --- SQLite tier ---
+@contextmanager
+def _db():
+    global _db_ready
+    if not _db_ready:
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    try:
+        if not _db_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS reason_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS reason_cache_last_used ON reason_cache (last_used)")
+            conn.execute("CREATE INDEX IF NOT EXISTS reason_cache_expires_at ON reason_cache (expires_at)")
+            _db_ready = True
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def _db_get(key: str) -> Optional[Tuple[str, float]]:
+    now = time.time()
+    with _db() as conn:
+        row = conn.execute("SELECT value, expires_at FROM reason_cache WHERE key = ? AND expires_at >= ?", (key, now)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE reason_cache SET last_used = ? WHERE key = ?", (now, key))
+    return row
+
+def _db_put(key: str, value: str, expires_at: float) -> int:
+    now = time.time()
+    with _db() as conn:
+        conn.execute("INSERT OR REPLACE INTO reason_cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)", (key, value, expires_at, now))
+        # Expired rows, then LRU down to DB_SIZE
+        removed = conn.execute("DELETE FROM reason_cache WHERE expires_at < ?", (now,)).rowcount
+        removed += conn.execute(
+            "DELETE FROM reason_cache WHERE key IN (SELECT key FROM reason_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (DB_SIZE,),
+        ).rowcount
+        return removed
+
+def _db_count() -> int:
+    with _db() as conn:
+        return conn.execute("SELECT COUNT(*) FROM reason_cache").fetchone()[0]
+
+# --- Cache ---
+def _lookup(store: "OrderedDict[Any, Tuple[float, Any]]", key: Any) -> Optional[Any]:
+    item = store.get(key)
+    if item is None:
+        return None
+    if item[0] < time.time():
+        del store[key]
+        return None
+    store.move_to_end(key)
+    return item[1]
+
+def _store(store: "OrderedDict[Any, Tuple[float, Any]]", key: Any, value: Any, expires_at: float) -> None:
+    store[key] = (expires_at, value)
+    store.move_to_end(key)
+    while len(store) > CACHE_SIZE:
+        store.popitem(last=False)
+        _counters["evictions"] += 1
+
+async def _load(store: "OrderedDict[Any, Tuple[float, Any]]", key: Any, db_key: str) -> Optional[Any]:
+    value = _lookup(store, key)
+    if value is not None or not DB_PATH:
+        return value
+    try:
+        row = await asyncio.to_thread(_db_get, db_key)
+    except sqlite3.Error as e:
+        print(f"Reason cache read error: {e}")
+        return None
+    if row is None:
+        return None
+    value = json.loads(row[0])
+    _store(store, key, value, row[1])
+    _counters["disk_hits"] += 1
+    return value
+
+async def _save(store: "OrderedDict[Any, Tuple[float, Any]]", key: Any, db_key: str, value: Any) -> None:
+    expires_at = time.time() + CACHE_TTL
+    _store(store, key, value, expires_at)
+    if DB_PATH:
+        try:
+            _counters["disk_evictions"] += await asyncio.to_thread(_db_put, db_key, json.dumps(value, ensure_ascii=False), expires_at)
+        except sqlite3.Error as e:
+            print(f"Reason cache write error: {e}")
+
+async def new_valuation(kind: str, context: Dict[str, Any], reason: Any = None, language: str = "uz") -> str:
+    """Keeps what a later explanation needs (input, listings, prices) and returns its id."""
+    valuation_id = uuid.uuid4().hex
+    await _save(_valuations, valuation_id, f"v:{valuation_id}", {"kind": kind, **context})
+    _counters["valuations"] += 1
+    if isinstance(reason, str) and reason.strip():
+        await _save(_reasons, (valuation_id, language), f"r:{valuation_id}:{language}", reason)
+    return valuation_id
+
+async def get_valuation(valuation_id: str, kind: str) -> Dict[str, Any]:
+    context = await _load(_valuations, valuation_id, f"v:{valuation_id}")
+    if context is None or context["kind"] != kind:
+        raise HTTPException(status_code=404, detail="Valuation not found or expired.")
+    return context
+
+# --- Generation ---
+async def _generate(context: Dict[str, Any], language: str) -> str:
+    listings = f", Listings: {json.dumps(context['listings'], ensure_ascii=False, default=str)}" if context.get("listings") else ""
+    pricing = f", Pricing: {json.dumps(context['pricing'])}" if context.get("pricing") else ""
+    user_content = (
+        f"{context['input']}{listings}{pricing}\n"
+        f"Natija: estimated_min_price = {context.get('estimated_min_price')} UZS, "
+        f"estimated_max_price = {context.get('estimated_max_price')} UZS"
+    )
+    response = await prompts.ainvoke(
+        get_llm("gpt-4o", 0.3),
+        "valuation.reason",
+        user_content,
+        {"language": LANGUAGES[language], "usd_rate": context.get("usd_rate")},
+    )
+    text = response.content.strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("html").strip()
+    return text
+
+async def _produce(valuation_id: str, kind: str, language: str, context: Dict[str, Any]) -> str:
+    if language == "cyrl":
+        text = translit.to_cyrillic_html(await get_reason(valuation_id, kind, "uz"))
+        _counters["transliterated"] += 1
+    else:
+        text = await _generate(context, language)
+        _counters["generated"] += 1
+    await _save(_reasons, (valuation_id, language), f"r:{valuation_id}:{language}", text)
+    return text
+
+async def get_reason(valuation_id: str, kind: str, language: str) -> str:
+    """Cached explanation in one language; concurrent requests for the same one share a call."""
+    context = await get_valuation(valuation_id, kind)
+    key = (valuation_id, language)
+    cached = await _load(_reasons, key, f"r:{valuation_id}:{language}")
+    if cached is not None:
+        _counters["hits"] += 1
+        return cached
+    _counters["misses"] += 1
+
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(_produce(valuation_id, kind, language, context))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    # A client that disconnects doesn't cancel the generation; the result still lands in the cache
+    return await asyncio.shield(task)
+
+async def get_reasons(valuation_id: str, kind: str, language: str) -> Dict[str, str]:
+    """All requested languages at once: missing ones are generated concurrently, not one after another."""
+    languages = expand(language)
+    texts = await asyncio.gather(*(get_reason(valuation_id, kind, lang) for lang in languages))
+    return dict(zip(languages, texts))
+
+async def cache_stats() -> Dict[str, Any]:
+    lookups = _counters["hits"] + _counters["misses"]
+    disk_entries = None
+    if DB_PATH:
+        try:
+            disk_entries = await asyncio.to_thread(_db_count)
+        except sqlite3.Error:
+            pass
+    return {
+        **_counters,
+        "hit_rate": round(_counters["hits"] / lookups, 3) if lookups else None,
+        "valuations_cached": len(_valuations),
+        "reasons_cached": len(_reasons),
+        "disk_entries": disk_entries,
+        "size": CACHE_SIZE,
+        "disk_size": DB_SIZE if DB_PATH else None,
+        "ttl_seconds": CACHE_TTL,
+    }
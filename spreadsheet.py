@@ -0,0 +1,323 @@
+import io
+import os
+import asyncio
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+# Load environment variables
+load_dotenv()
+
+# Parsing runs in worker processes so openpyxl/xlrd never block the event loop
+WORKERS = int(os.getenv("SPREADSHEET_WORKERS", "2"))
+QUEUE_DEPTH = int(os.getenv("SPREADSHEET_QUEUE_DEPTH", "8"))
+
+# Uploads larger than the threshold are spooled to disk and parsed from there
+MAX_UPLOAD_BYTES = int(os.getenv("FORMA_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+SPOOL_THRESHOLD = int(os.getenv("FORMA_SPOOL_THRESHOLD", str(1024 * 1024)))
+
+SUPPORTED_EXTENSIONS = (".csv", ".xls", ".xlsx")
+
+# Cell values that carry no information in the bank exports
+EMPTY_VALUES = ("", "-", "null", "None")
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_pending = 0
+_rejected = 0
+
+def flatten_frame(df: pd.DataFrame) -> str:
+    """Renders a sheet as one " | "-joined line per non-empty row, dropping blanks and sentinels."""
+    if df.empty:
+        return ""
+
+    present = df.notna()
+    # Through object first so cells print as str(value) does in a row loop (datetime64
+    # columns would otherwise lose their "00:00:00")
+    text = df.astype(object).astype(str).apply(lambda col: col.str.strip())
+    keep = present & ~text.isin(EMPTY_VALUES)
+
+    # Join column by column over whole arrays instead of building a Series per row
+    values = np.where(keep.to_numpy(), text.to_numpy(dtype=object), "")
+    lines = values[:, 0]
+    for j in range(1, values.shape[1]):
+        col = values[:, j]
+        sep = np.where((lines != "") & (col != ""), " | ", "")
+        lines = lines + sep + col
+    return "\n".join(line for line in lines.tolist() if line)
+
+class SpooledUpload:
+    """An upload held in memory (small files) or in a temp file on disk (everything else)."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.size = 0
+        self.sha256 = ""
+        self.content: bytes | None = None
+        self.path: str | None = None
+
+    @property
+    def source(self) -> bytes | str:
+        return self.path if self.path is not None else (self.content or b"")
+
+    def close(self) -> None:
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def __enter__(self) -> "SpooledUpload":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+def too_large() -> HTTPException:
+    """The 413 for a body over MAX_UPLOAD_BYTES (forma uploads and the batch reader)."""
+    return HTTPException(status_code=413, detail=f"File is too large. Maximum size is {MAX_UPLOAD_BYTES} bytes.")
+
+def check_content_length(value: str | None) -> None:
+    """Rejects a request by its Content-Length header before the body is read."""
+    if value and value.isdigit() and int(value) > MAX_UPLOAD_BYTES:
+        raise too_large()
+
+# OpenAPI description of the multipart body read by receive_upload (the handlers take the raw request)
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+async def receive_upload(request: Request, field: str = "file", extensions: Tuple[str, ...] = SUPPORTED_EXTENSIONS) -> SpooledUpload:
+    """Reads the `field` file of a multipart request straight from the request stream.
+
+    The file is hashed as it arrives and kept in memory while it stays under SPOOL_THRESHOLD;
+    past that it is written once, to a temp file the worker parses. Bytes are counted as they
+    are received, so a body without a usable Content-Length stops with 413 at MAX_UPLOAD_BYTES."""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Upload the file as multipart/form-data.")
+
+    upload: SpooledUpload | None = None
+    headers: Dict[bytes, bytes] = {}
+    header = [b"", b""]
+    in_file = False
+    # File data parsed out of the current network chunk
+    parts: List[bytes] = []
+
+    def on_part_begin() -> None:
+        headers.clear()
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header[0] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header[1] += data[start:end]
+
+    def on_header_end() -> None:
+        headers[header[0].lower()] = header[1]
+        header[:] = [b"", b""]
+
+    def on_headers_finished() -> None:
+        nonlocal upload, in_file
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        in_file = upload is None and options.get(b"name") == field.encode() and b"filename" in options
+        if in_file:
+            upload = SpooledUpload(options[b"filename"].decode("utf-8", "replace").lower())
+            if not upload.filename.endswith(extensions):
+                names = ", ".join(e.lstrip(".").upper() for e in extensions)
+                raise HTTPException(status_code=400, detail=f"Unsupported file format. Use {names}.")
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if in_file:
+            parts.append(data[start:end])
+
+    def on_part_end() -> None:
+        nonlocal in_file
+        in_file = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    received = 0
+    out = None
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_UPLOAD_BYTES:
+                raise too_large()
+            parser.write(chunk)
+            if not parts:
+                continue
+            data = b"".join(parts)
+            parts.clear()
+            upload.size += len(data)
+            digest.update(data)
+            if out is None and upload.size <= SPOOL_THRESHOLD:
+                buffer += data
+                continue
+            if out is None:
+                fd, upload.path = tempfile.mkstemp(suffix=os.path.splitext(upload.filename)[1])
+                out = os.fdopen(fd, "wb")
+                data = bytes(buffer) + data
+                buffer = bytearray()
+            await asyncio.to_thread(out.write, data)
+        parser.finalize()
+    except BaseException as e:
+        if out is not None:
+            out.close()
+        if upload is not None:
+            upload.close()
+        if isinstance(e, ValueError):
+            # python-multipart parse errors
+            raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+        raise
+    if out is not None:
+        out.close()
+    if upload is None:
+        raise HTTPException(status_code=400, detail=f"No file in the '{field}' field.")
+    if upload.path is None:
+        upload.content = bytes(buffer)
+    upload.sha256 = digest.hexdigest()
+    return upload
+
+def _read_xlsx(source: bytes | str) -> pd.DataFrame:
+    """First sheet via openpyxl's read-only mode, which streams rows instead of building the whole workbook."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(io.BytesIO(source) if isinstance(source, bytes) else source, read_only=True, data_only=True)
+    try:
+        rows = [list(r) for r in wb.worksheets[0].iter_rows(values_only=True)]
+    finally:
+        wb.close()
+
+    # Drop trailing empty rows/columns that read-only mode reports for formatted cells
+    while rows and all(v is None for v in rows[-1]):
+        rows.pop()
+    width = max((max((i + 1 for i, v in enumerate(r) if v is not None), default=0) for r in rows), default=0)
+    if not rows or width == 0:
+        return pd.DataFrame()
+
+    # Same column naming as pd.read_excel(header=0)
+    header, seen = [], {}
+    for i, name in enumerate((rows[0] + [None] * width)[:width]):
+        name = f"Unnamed: {i}" if name is None else name
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        header.append(name)
+    body = [(r + [None] * width)[:width] for r in rows[1:]]
+    return pd.DataFrame(body, columns=header)
+
+def read_frame(source: bytes | str, filename: str) -> pd.DataFrame:
+    """Decodes CSV/XLS/XLSX from bytes or from a path on disk."""
+    if filename.endswith(".xlsx"):
+        return _read_xlsx(source)
+    data = io.BytesIO(source) if isinstance(source, bytes) else source
+    if filename.endswith(".csv"):
+        return pd.read_csv(data)
+    # Note: pandas uses xlrd for xls
+    return pd.read_excel(data)
+
+def _parse(source: bytes | str, filename: str) -> Tuple[pd.DataFrame, str]:
+    # Runs in a worker process
+    df = read_frame(source, filename)
+    return df, flatten_frame(df)
+
+# --- Pool ---
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: forking a process that already runs the event loop and client threads isn't safe
+            _executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+def _discard(executor: ProcessPoolExecutor) -> None:
+    """Drops a broken pool, unless another request has already replaced it with a healthy one."""
+    global _executor
+    with _executor_lock:
+        if _executor is not executor:
+            return
+        _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def start() -> None:
+    _get_executor()
+
+def stop() -> None:
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+async def parse_upload(upload: SpooledUpload) -> Tuple[pd.DataFrame, str]:
+    """Decodes and flattens a received upload in the process pool; returns (df, text)."""
+    global _pending, _rejected
+
+    # Every worker busy and the queue full: fail fast instead of piling up requests
+    if _pending >= WORKERS + QUEUE_DEPTH:
+        _rejected += 1
+        raise HTTPException(status_code=503, detail="Spreadsheet parser is busy, please retry later.")
+
+    _pending += 1
+    executor = _get_executor()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, _parse, upload.source, upload.filename)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM on a huge file); the next request gets a fresh pool
+        _discard(executor)
+        raise HTTPException(status_code=500, detail="Spreadsheet parser crashed, please retry.")
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        # Not this request being cancelled: its queued job went down with the pool (shutdown)
+        raise HTTPException(status_code=503, detail="Spreadsheet parser restarted, please retry.")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error reading Excel/CSV: {str(e)}")
+    finally:
+        _pending -= 1
+
+def pool_stats() -> Dict[str, Any]:
+    return {
+        "workers": WORKERS,
+        "queue_depth": QUEUE_DEPTH,
+        "max_upload_bytes": MAX_UPLOAD_BYTES,
+        "spool_threshold": SPOOL_THRESHOLD,
+        "pending": _pending,
+        "rejected": _rejected,
+    }
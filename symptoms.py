@@ -0,0 +1,128 @@
+import os
+import re
+import math
+from typing import Any, Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+import translit
+
+# Load environment variables
+load_dotenv()
+
+# Complaint -> speciality slugs (from the xmed SYSTEM_PROMPT list) without a model call.
+# Each rule is a set of word stems that must all appear in the message, each as the start
+# of a word ("bosh og‘ri" matches "boshim og'riyapti"). Uzbek rules are written in Latin
+# and also matched in Cyrillic; Russian rules are written in Russian. Stems stay long enough
+# not to start everyday words ("легк" would catch "легкая", "угр" "угроза", "ko‘rish" the verb
+# "to meet"); where the stem alone is ambiguous the rule names the context ("высок давлен",
+# not "давлен", which also fires on tyre pressure). test_symptoms.py keeps a table of phrases
+# that must and must not match.
+RULES: Dict[str, List[str]] = {
+    "neurologist": [
+        "bosh og‘ri", "bosh aylan", "migren", "qo‘l uvish", "oyoq uvish", "tutqanoq",
+        "голов бол", "голов круж", "мигрен", "онемен", "немеют",
+    ],
+    "dentist": ["tish", "milk qon", "зуб", "десн"],
+    "cardiologist": [
+        "yurak", "qon bosim", "bosim oshi", "ko‘krak og‘ri", "hansira",
+        "сердц", "высок давлен", "низк давлен", "давлени скач", "давлени поднял", "артериальн давлен", "сердцебиен", "бол груд", "одышк",
+    ],
+    "gastroenterologist": [
+        "oshqozon", "qorin og‘ri", "qorn og‘ri", "ich ket", "ich qot", "ko‘ngil ayn", "ko‘ngl ayn", "qusish", "jig‘ildon",
+        "желуд", "живот", "понос", "запор", "тошн", "рвот", "изжог",
+    ],
+    "dermatovenereologist": ["toshma", "qichi", "terimda", "terida", "teri toshma", "husnbuzar", "сып", "зуд", "кож", "прыщ", "угрев", "угри"],
+    "ophthalmologist": ["ko‘z", "ko‘rish qobiliyat", "xira ko‘r", "глаз", "зрени"],
+    "ent": [
+        "quloq", "tomoq og‘ri", "burun", "tumov", "angina",
+        "ухо", "уши", "ушах", "горл", "насморк", "нос заложен", "ангин",
+    ],
+    "pulmonologist": ["yo‘tal", "o‘pka", "nafas qis", "кашл", "кашел", "легки", "легочн", "задыха"],
+    "urologist": ["siydik", "buyrak", "peshob", "моча", "моче", "почк"],
+    "gynecologist": ["hayz", "bachadon", "tuxumdon", "менструац", "месячн", "матк", "яичник"],
+    "obstetrician": ["homilador", "homila", "беремен"],
+    "pediatrician": ["bolam", "chaqaloq", "go‘dak", "ребен", "ребён", "малыш", "младен"],
+    "orthopedist-traumatologist": ["bo‘g‘im", "tizza", "singan", "сустав", "колен", "перелом", "травм", "ушиб"],
+    "vertebrologist": ["bel og‘ri", "umurtqa", "grija", "churra", "спин бол", "поясниц", "позвоноч", "грыж"],
+    "endocrinologist": ["qandli", "diabet", "qalqonsimon", "gormon", "сахар", "диабет", "щитовид", "гормон"],
+    "allergist": ["allergi", "аллерг"],
+    "psychotherapist": ["depress", "xavotir", "asab", "stress", "vahima", "депресс", "тревог", "стресс", "паник"],
+    "somnolog": ["uxlay olmay", "uyqusiz", "бессонниц", "не могу спать", "храп"],
+    "trichologist": ["soch to‘k", "kal bo‘l", "выпаден волос", "облысен"],
+    "therapist": ["isitma", "harorat", "shamolla", "holsiz", "температур", "простуд", "слабост", "грипп"],
+    "hepatologist": ["jigar", "sariq kasal", "печен", "гепатит"],
+    "proctologist": ["bavosil", "gemorroy", "геморро", "прям кишк"],
+    "phlebologist": ["varikoz", "tomir kengay", "вены", "венах", "варикоз"],
+    "urolog-androlog": ["prostata", "erkaklik", "потенц", "простат", "эрекц"],
+    "rheumatologist": ["revmat", "podagra", "ревмат", "подагр"],
+}
+
+# Negations around a matched rule ("нет температуры", "isitma yo‘q") cancel it
+NEGATIONS_BEFORE = {"не", "нет", "без", "ни"}
+NEGATIONS_AFTER = {"нет", "yoq", "emas", "йук", "йўқ", "эмас"}
+
+# A guess below this score is left to the model. A one-word stem unique to a speciality
+# weighs 1.0, so a guess needs a phrase rule or more than one such hit
+MIN_SCORE = float(os.getenv("XMED_CLASSIFIER_MIN_SCORE", "1.5"))
+MAX_SPECIALITIES = int(os.getenv("XMED_CLASSIFIER_MAX_SPECIALITIES", "2"))
+
+_counters = {"messages": 0, "classified": 0}
+
+def normalize(text: Any) -> str:
+    text = str(text or "").lower().replace("ё", "е")
+    text = re.sub(f"[{translit.APOSTROPHES}]", "", text)
+    return " ".join(re.findall(r"\w+", text))
+
+def _compile() -> List[Tuple[str, Tuple[str, ...], float]]:
+    # Latin and Cyrillic variants of every Uzbek rule
+    variants: List[Tuple[str, Tuple[str, ...]]] = []
+    for slug, rules in RULES.items():
+        for rule in rules:
+            forms = {normalize(rule)}
+            if re.search(r"[a-z]", rule):
+                forms.add(normalize(translit.to_cyrillic(rule)))
+            variants.extend((slug, tuple(form.split())) for form in forms)
+    # IDF-style weight: a stem used by many specialities says less about any one of them
+    slugs_by_stem: Dict[str, set] = {}
+    for slug, stems in variants:
+        for stem in stems:
+            slugs_by_stem.setdefault(stem, set()).add(slug)
+    n = len(RULES)
+    return [
+        (slug, stems, sum(math.log(1 + n / len(slugs_by_stem[s])) for s in stems) / math.log(1 + n))
+        for slug, stems in variants
+    ]
+
+_RULES = _compile()
+
+def _matches(words: List[str], stems: Tuple[str, ...]) -> bool:
+    positions = [[i for i, w in enumerate(words) if w.startswith(stem)] for stem in stems]
+    if not all(positions):
+        return False
+    first = [i for i in positions[0] if i == 0 or words[i - 1] not in NEGATIONS_BEFORE]
+    last = [i for i in positions[-1] if i + 1 == len(words) or words[i + 1] not in NEGATIONS_AFTER]
+    return bool(first) and bool(last)
+
+def scores(message: str) -> Dict[str, float]:
+    words = normalize(message).split()
+    result: Dict[str, float] = {}
+    for slug, stems, weight in _RULES:
+        if _matches(words, stems):
+            result[slug] = result.get(slug, 0.0) + weight
+    return result
+
+def classify(message: str) -> List[str]:
+    """Up to MAX_SPECIALITIES slugs for a complaint, best first; [] when unsure."""
+    _counters["messages"] += 1
+    ranked = sorted(scores(message).items(), key=lambda kv: kv[1], reverse=True)
+    if not ranked or ranked[0][1] < MIN_SCORE:
+        return []
+    _counters["classified"] += 1
+    # A runner-up close to the best one is sent along (e.g. stomach + liver complaints)
+    best = ranked[0][1]
+    return [slug for slug, score in ranked[:MAX_SPECIALITIES] if score >= best * 0.75]
+
+def classifier_stats() -> Dict[str, Any]:
+    c = _counters
+    return {**c, "rate": round(c["classified"] / c["messages"], 3) if c["messages"] else None, "rules": len(_RULES)}
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import httpx
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessageChunk
+
+import avto
+import cbu_rates
+import document
+import forma1
+import forma_cache
+import forma2
+import listings
+import main
+import reasons
+import spreadsheet
+import uy_joy
+import valuation_cache
+
+# Fixed stub latency of one LLM call, and requests fired at once per handler
+LLM_SECONDS = 0.3
+CONCURRENT = 10
+
+
+class SlowLLM:
+    """Answers like the search, valuation and forma agents after LLM_SECONDS; a blocking call fails the test."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, messages):
+        self.calls += 1
+        await asyncio.sleep(LLM_SECONDS)
+        text = str(messages)
+        if "Forma" in text:
+            content = {"date": "31.12.2024", "rows": []}
+        elif "estimated_min_price" in text:
+            content = {"estimated_min_price": 100, "estimated_max_price": 120, "reason": "<p>ok</p>"}
+        else:
+            content = {"status": "ok", "listings": []}
+        return SimpleNamespace(content=json.dumps(content), usage_metadata=None)
+
+    def invoke(self, messages):
+        raise AssertionError("blocking invoke() on the event loop")
+
+
+class SlowAgent:
+    """The document conclusion agent: one streamed answer after LLM_SECONDS."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def astream(self, inputs, stream_mode=None):
+        self.calls += 1
+        await asyncio.sleep(LLM_SECONDS)
+        yield AIMessageChunk(content="<p>Xulosa</p>"), {}
+
+
+@pytest.fixture
+def llm(tmp_path, monkeypatch):
+    fake = SlowLLM()
+    for module in (avto, uy_joy, forma1, forma2):
+        monkeypatch.setattr(module, "get_llm", lambda *args: fake)
+    agent = SlowAgent()
+    monkeypatch.setattr(document, "get_agent", lambda: agent)
+    fake.agent = agent
+    monkeypatch.setattr(reasons, "DB_PATH", str(tmp_path / "reasons.sqlite3"))
+    monkeypatch.setattr(reasons, "_db_ready", False)
+    monkeypatch.setattr(valuation_cache, "_entries", OrderedDict())
+    monkeypatch.setattr(forma_cache, "DB_PATH", str(tmp_path / "forma_cache.sqlite3"))
+    monkeypatch.setattr(forma_cache, "_db_ready", False)
+    monkeypatch.setattr(forma_cache, "_memory", OrderedDict())
+
+    async def nothing(*args):
+        return None
+
+    async def usd_rate(on_date=None):
+        return 12800.0
+
+    async def parse_upload(upload):
+        # A sheet the forma rules don't recognize, so the whole text goes to the LLM
+        return pd.DataFrame({"a": ["Hisobot", upload.sha256]}), f"Hisobot | {upload.sha256}"
+
+    monkeypatch.setattr(listings, "find_comparables", nothing)
+    monkeypatch.setattr(listings, "find_vehicle_comparables", nothing)
+    monkeypatch.setattr(cbu_rates, "get_usd_rate", usd_rate)
+    monkeypatch.setattr(spreadsheet, "parse_upload", parse_upload)
+    return fake
+
+
+def client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test", timeout=30)
+
+
+def property_body(n: int) -> dict:
+    return {"address": f"Toshkent, Chilonzor {n}", "area": {"actualLandArea": 400 + n}, "type": "FIRST_LINE", "latitude": 41.28, "longitude": 69.2}
+
+
+def vehicle_body(n: int) -> dict:
+    return {"MODEL": "Cobalt", "YEAR": 2020, "COLOR": "oq", "MOTOR": f"B15D2{n:06d}", "KUZOV": f"XWBJA69V{n:09d}"}
+
+
+# path -> (request n, stub calls one request makes one after another)
+HANDLERS = {
+    "avto": (lambda c, n: c.post("/webhook/avto", json=vehicle_body(n)), 2),
+    "uy_joy": (lambda c, n: c.post("/webhook/uy-joy", json=property_body(n)), 2),
+    "forma1": (lambda c, n: c.post("/webhook/forma1", files={"file": ("f1.csv", f"forma1 {n}".encode())}), 1),
+    "forma2": (lambda c, n: c.post("/webhook/forma2", files={"file": ("f2.csv", f"forma2 {n}".encode())}), 1),
+    "document": (lambda c, n: c.post("/webhook/document", json={"body": {"language": "uz", "company_info": {"data": {"name": f"Firma {n}"}}}}), 1),
+}
+
+
+@pytest.mark.parametrize("handler", list(HANDLERS))
+def test_concurrent_requests_finish_in_about_one_llm_latency(llm, handler):
+    call, serial_calls = HANDLERS[handler]
+    one_request = serial_calls * LLM_SECONDS
+
+    async def scenario():
+        async with client() as c:
+            await c.get("/")
+            start = time.perf_counter()
+            responses = await asyncio.gather(*(call(c, n) for n in range(CONCURRENT)))
+            return responses, time.perf_counter() - start
+
+    responses, elapsed = asyncio.run(scenario())
+    assert [r.status_code for r in responses] == [200] * CONCURRENT, responses[0].text
+    assert llm.calls + llm.agent.calls == CONCURRENT * serial_calls
+    print(f"\n{handler}: {CONCURRENT} requests in {elapsed:.2f} s, {one_request * CONCURRENT:.1f} s if serialized")
+    # Serialized they would take CONCURRENT x one_request; overlapped, about one_request
+    assert elapsed < one_request * CONCURRENT / 3
+
+
+def test_health_check_is_served_while_a_valuation_waits_on_the_llm(llm):
+    async def scenario():
+        async with client() as c:
+            # First request outside the measurement (lazy imports, route setup)
+            await c.get("/")
+            valuation = asyncio.create_task(c.post("/webhook/uy-joy", json=property_body(0)))
+            await asyncio.sleep(LLM_SECONDS / 3)
+            start = time.perf_counter()
+            health = await c.get("/")
+            health_seconds = time.perf_counter() - start
+            pending = not valuation.done()
+            return await valuation, health, health_seconds, pending
+
+    response, health, health_seconds, pending = asyncio.run(scenario())
+    assert pending
+    assert health.status_code == 200
+    assert health_seconds < LLM_SECONDS / 2
+    assert response.status_code == 200, response.text
+    assert response.json()["estimated_min_price"] == 100
@@ -0,0 +1,200 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import avto
+import batch
+import spreadsheet
+
+CONCURRENCY = 2
+
+
+@pytest.fixture(autouse=True)
+def concurrency(monkeypatch):
+    monkeypatch.setattr(batch, "CONCURRENCY", CONCURRENCY)
+    monkeypatch.setattr(batch, "_semaphore", asyncio.Semaphore(CONCURRENCY))
+
+
+class StubValue:
+    """Stands in for avto.value_avto: a price per MODEL after an optional per-model delay."""
+
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+        self.cancelled = 0
+
+    async def __call__(self, body, language):
+        self.calls.append(body["MODEL"])
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delays.get(body["MODEL"], 0.01))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.running -= 1
+        if body["MODEL"] == "missing":
+            raise HTTPException(status_code=404, detail="No listings")
+        if body["MODEL"] == "broken":
+            raise ValueError("bad year")
+        return {"model": body["MODEL"], "language": language}
+
+
+def records(*models):
+    return [({"index": i}, {"MODEL": m, "YEAR": "2020"}, None) for i, m in enumerate(models)]
+
+
+def collect(lines):
+    async def read():
+        return [json.loads(line) async for line in lines]
+    return asyncio.run(read())
+
+
+def run(items, value, language="uz"):
+    return collect(batch.run_batch(items, value, lambda body: body["MODEL"], language))
+
+
+# --- Input ---
+def test_parse_csv_nests_dotted_headers_and_reads_numbers():
+    text = "address,area.actualLandArea,type,latitude\nYunusobod 4,\"85,5\",FIRST_LINE,41.3\nChilonzor,120,,\n"
+    assert batch.parse_csv(text) == [
+        ({"index": 0}, {"address": "Yunusobod 4", "area": {"actualLandArea": "85,5"}, "type": "FIRST_LINE", "latitude": 41.3}, None),
+        ({"index": 1}, {"address": "Chilonzor", "area": {"actualLandArea": 120}}, None),
+    ]
+
+
+def test_parse_ndjson_turns_bad_lines_into_errors():
+    text = '{"MODEL": "Cobalt"}\n\n[1, 2]\n{"MODEL": \n{"MODEL": "Nexia"}\n'
+    parsed = batch.parse_ndjson(text)
+    assert [position for position, _, _ in parsed] == [{"index": i} for i in range(4)]
+    assert parsed[0] == ({"index": 0}, {"MODEL": "Cobalt"}, None)
+    assert parsed[1][1] is None and "expected a JSON object" in parsed[1][2]
+    assert parsed[2][1] is None and parsed[2][2].startswith("Invalid JSON line")
+    assert parsed[3] == ({"index": 3}, {"MODEL": "Nexia"}, None)
+
+
+def test_expand_vehicles_splits_an_application_line():
+    line = {"body": {"taxObjects": {"carDataObject": [{"model": "Cobalt", "year": 2020}, {"model": "Nexia", "kuzov": "K1"}]}}}
+    expanded = batch.expand_vehicles([({"index": 0}, line, None), ({"index": 1}, {"MODEL": "Spark"}, None), ({"index": 2}, None, "bad")])
+    assert expanded == [
+        ({"index": 0, "vehicle": 0}, {"MODEL": "Cobalt", "YEAR": 2020}, None),
+        ({"index": 0, "vehicle": 1}, {"MODEL": "Nexia", "KUZOV": "K1"}, None),
+        ({"index": 1}, {"MODEL": "Spark"}, None),
+        ({"index": 2}, None, "bad"),
+    ]
+
+
+def test_vehicle_key_prefers_the_body_number():
+    assert batch.vehicle_key({"MODEL": "Cobalt", "KUZOV": "k1"}) == batch.vehicle_key({"MODEL": "Nexia", "KUZOV": "K1"})
+    assert batch.vehicle_key({"MODEL": "Cobalt", "YEAR": 2020, "KUZOV": "---"}) != batch.vehicle_key({"MODEL": "Cobalt", "YEAR": 2021})
+
+
+# --- Runner ---
+def test_duplicates_are_valued_once():
+    value = StubValue()
+    lines = run(records("Cobalt", "Nexia", "Cobalt", "Cobalt"), value)
+    assert sorted(value.calls) == ["Cobalt", "Nexia"]
+    items = {line["index"]: line for line in lines[:-1]}
+    assert set(items) == {0, 1, 2, 3}
+    assert items[2]["duplicate_of"] == items[3]["duplicate_of"] == 0
+    assert "duplicate_of" not in items[0] and "duplicate_of" not in items[1]
+    assert items[3]["result"] == items[0]["result"] == {"model": "Cobalt", "language": "uz"}
+    assert lines[-1]["summary"]["items"] == 4
+    assert lines[-1]["summary"]["valuations"] == 2
+    assert lines[-1]["summary"]["duplicates"] == 2
+
+
+def test_duplicate_vehicles_point_at_the_first_vehicle():
+    items = [({"index": 0, "vehicle": 0}, {"MODEL": "Cobalt"}, None), ({"index": 0, "vehicle": 1}, {"MODEL": "Cobalt"}, None)]
+    lines = run(items, StubValue())
+    assert lines[1] == {"index": 0, "vehicle": 1, "status": "ok", "result": {"model": "Cobalt", "language": "uz"},
+                        "duplicate_of": 0, "duplicate_of_vehicle": 0}
+
+
+def test_lines_arrive_in_completion_order():
+    value = StubValue({"slow": 0.2, "fast": 0.01})
+    lines = run(records("slow", "fast", "slow"), value)
+    assert [line.get("index") for line in lines] == [1, 0, 2, None]
+
+
+def test_invalid_lines_and_failures_are_reported_per_item():
+    items = records("Cobalt", "missing", "broken") + [({"index": 3}, None, "Invalid JSON line: x")]
+    lines = run(items, StubValue())
+    assert lines[0] == {"index": 3, "status": "error", "error": "Invalid JSON line: x"}
+    errors = {line["index"]: line.get("error") for line in lines[1:-1]}
+    assert errors == {0: None, 1: "No listings", 2: "bad year"}
+    assert lines[-1]["summary"]["errors"] == 3
+
+
+def test_workers_are_bounded():
+    value = StubValue()
+    lines = run(records(*[f"model {i}" for i in range(20)]), value)
+    assert len(lines) == 21
+    assert value.peak == CONCURRENCY
+
+
+def test_a_slow_reader_holds_back_the_valuations():
+    value = StubValue()
+
+    async def read_one():
+        lines = batch.run_batch(records(*[f"model {i}" for i in range(50)]), value, lambda body: body["MODEL"], "uz")
+        first = json.loads(await lines.__anext__())
+        await asyncio.sleep(0.2)
+        started = len(value.calls)
+        await lines.aclose()
+        return first, started
+
+    first, started = asyncio.run(read_one())
+    assert first["status"] == "ok"
+    # Running workers plus the finished results waiting in the queue, not the whole batch
+    assert started <= 2 * CONCURRENCY + 1
+
+
+def test_disconnect_cancels_the_valuations():
+    value = StubValue({f"model {i}": 10 for i in range(1, 10)})
+
+    async def disconnect():
+        lines = batch.run_batch(records(*[f"model {i}" for i in range(10)]), value, lambda body: body["MODEL"], "uz")
+        await lines.__anext__()
+        await lines.aclose()
+        # Give the cancelled workers a turn to unwind
+        await asyncio.sleep(0.05)
+
+    asyncio.run(disconnect())
+    # The fast first item, then one slow item per worker, both cancelled
+    assert len(value.calls) == CONCURRENCY + 1
+    assert value.cancelled == CONCURRENCY
+    assert value.running == 0
+
+
+# --- Endpoint ---
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(avto, "value_avto", StubValue())
+    monkeypatch.setattr(spreadsheet, "MAX_UPLOAD_BYTES", 1000)
+    app = FastAPI()
+    app.include_router(batch.router)
+    return TestClient(app)
+
+
+def test_endpoint_streams_ndjson(client):
+    response = client.post("/webhook/avto/batch?language=ru", content='{"MODEL": "Cobalt"}\n{"MODEL": "Cobalt"}\n')
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert lines[0]["result"] == {"model": "Cobalt", "language": "ru"}
+    assert lines[1]["duplicate_of"] == 0
+
+
+def test_endpoint_stops_a_streamed_body_over_the_limit(client):
+    def chunks():
+        for _ in range(20):
+            yield b'{"MODEL": "Cobalt"}\n' * 10
+
+    response = client.post("/webhook/avto/batch", content=chunks())
+    assert response.status_code == 413
@@ -0,0 +1,138 @@
+import asyncio
+import os
+from datetime import date, timedelta
+
+import httpx
+import pytest
+
+import cbu_rates
+
+TODAY = date.today()
+
+
+def cbu_payload(day: date, usd: str) -> list:
+    """The list cbu.uz returns, for a few currencies."""
+    stamp = day.strftime("%d.%m.%Y")
+    return [
+        {"Ccy": "USD", "Rate": usd, "Nominal": "1", "Date": stamp},
+        {"Ccy": "EUR", "Rate": "13900.50", "Nominal": "1", "Date": stamp},
+        {"Ccy": "JPY", "Rate": "8345.10", "Nominal": "100", "Date": stamp},
+    ]
+
+
+class StandIn:
+    """Local stand-in for the CBU endpoint: latest rates at the base URL, a day at /all/<date>/."""
+
+    def __init__(self):
+        self.calls = []
+        self.days = {}
+        self.latest = (TODAY, "12800.00")
+        self.down = False
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.calls.append(request.url.path)
+        if self.down:
+            return httpx.Response(503)
+        parts = request.url.path.strip("/").split("/")
+        if "all" in parts:
+            requested = date.fromisoformat(parts[parts.index("all") + 1])
+            # Like cbu.uz: a day without its own rates gets the latest published ones
+            day, usd = (requested, self.days[requested]) if requested in self.days else self.latest
+            return httpx.Response(200, json=cbu_payload(day, usd))
+        return httpx.Response(200, json=cbu_payload(*self.latest))
+
+
+@pytest.fixture
+def cbu(tmp_path, monkeypatch):
+    stand_in = StandIn()
+    monkeypatch.setattr(cbu_rates, "ARCHIVE_DIR", str(tmp_path))
+    monkeypatch.setattr(cbu_rates, "CBU_RATES_URL", "http://cbu.test/uz/arkhiv-kursov-valyut/json/")
+    monkeypatch.setattr(cbu_rates, "_rates", {})
+    monkeypatch.setattr(cbu_rates, "_rates_date", None)
+    monkeypatch.setattr(cbu_rates, "_history", cbu_rates.OrderedDict())
+
+    def client() -> httpx.AsyncClient:
+        # Closed again by cbu_rates.stop()
+        if cbu_rates._client is None or cbu_rates._client.is_closed:
+            cbu_rates._client = httpx.AsyncClient(transport=httpx.MockTransport(stand_in.handler))
+        return cbu_rates._client
+
+    monkeypatch.setattr(cbu_rates, "_get_client", client)
+    return stand_in
+
+
+def run(coro):
+    async def wrapped():
+        try:
+            return await coro
+        finally:
+            await cbu_rates.stop()
+    return asyncio.run(wrapped())
+
+
+def test_lookups_served_from_memory_after_start(cbu):
+    async def scenario():
+        await cbu_rates.start()
+        before = len(cbu.calls)
+        rates = [cbu_rates.get_rate("USD"), cbu_rates.get_rate("EUR"), cbu_rates.get_rate("JPY"), await cbu_rates.get_usd_rate()]
+        return rates, len(cbu.calls) - before
+
+    rates, calls = run(scenario())
+    assert rates == pytest.approx([12800.0, 13900.5, 83.451, 12800.0])
+    assert calls == 0
+    assert cbu_rates.rates_date() == TODAY.isoformat()
+
+
+def test_historical_rate_is_fetched_once_and_archived(cbu, tmp_path):
+    day = TODAY - timedelta(days=30)
+    cbu.days[day] = "12500.00"
+
+    async def scenario():
+        await cbu_rates.start()
+        first = await cbu_rates.get_usd_rate(day.strftime("%d.%m.%Y"))
+        second = await cbu_rates.get_usd_rate(day.isoformat())
+        return first, second
+
+    assert run(scenario()) == (12500.0, 12500.0)
+    assert sum("/all/" in path for path in cbu.calls) == 1
+    assert os.path.exists(tmp_path / f"{day.isoformat()}.json")
+
+    # A fresh process reads the archive instead of calling cbu.uz again
+    cbu_rates._history.clear()
+    calls = len(cbu.calls)
+    assert run(cbu_rates.get_rate_on(day)) == 12500.0
+    assert len(cbu.calls) == calls
+
+
+def test_future_date_is_clamped_to_today(cbu, tmp_path):
+    future = TODAY + timedelta(days=5)
+    cbu.latest = (TODAY - timedelta(days=1), "12700.00")
+
+    assert run(cbu_rates.get_usd_rate(future.isoformat())) == 12700.0
+    # Asked for (and archived) under today, never under the future date
+    assert [path for path in cbu.calls if "/all/" in path] == [f"/uz/arkhiv-kursov-valyut/json/all/{TODAY.isoformat()}/"]
+    assert not os.path.exists(tmp_path / f"{future.isoformat()}.json")
+    assert future.isoformat() not in cbu_rates._history
+
+
+def test_history_is_bounded(cbu, monkeypatch):
+    monkeypatch.setattr(cbu_rates, "HISTORY_SIZE", 3)
+
+    async def scenario():
+        for n in range(1, 6):
+            await cbu_rates.get_rate_on(TODAY - timedelta(days=n))
+
+    run(scenario())
+    assert list(cbu_rates._history) == [(TODAY - timedelta(days=n)).isoformat() for n in (3, 4, 5)]
+
+
+def test_unreachable_source_falls_back_to_latest_archive(cbu, tmp_path):
+    cbu_rates._write_archive((TODAY - timedelta(days=2)).isoformat(), {"USD": 12650.0})
+    cbu.down = True
+
+    async def scenario():
+        await cbu_rates.start()
+        return cbu_rates.get_rate("USD")
+
+    assert run(scenario()) == 12650.0
+    assert cbu_rates.rates_stats()["last_error"]
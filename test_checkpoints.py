@@ -0,0 +1,169 @@
+import asyncio
+import operator
+import time
+from types import SimpleNamespace
+from typing import Annotated, List, TypedDict
+
+import pytest
+from langgraph.graph import END, START, StateGraph
+
+import checkpoints
+
+# conftest.py picks the memory backend for the app; both backends are exercised here directly
+
+
+class State(TypedDict):
+    turns: Annotated[List[str], operator.add]
+
+
+def chat_graph(saver):
+    """One node that records the turn, so the state shows every earlier turn of the thread."""
+    graph = StateGraph(State)
+    graph.add_node("reply", lambda state: {"turns": [f"reply {len(state['turns'])}"]})
+    graph.add_edge(START, "reply")
+    graph.add_edge("reply", END)
+    return graph.compile(checkpointer=saver)
+
+
+def thread(thread_id):
+    return {"configurable": {"thread_id": thread_id}}
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(checkpoints, "time", SimpleNamespace(time=clock))
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def saver(request, tmp_path, monkeypatch):
+    # Sweeps only when a test asks for one
+    monkeypatch.setattr(checkpoints, "SWEEP_INTERVAL", float("inf"))
+    if request.param == "memory":
+        return checkpoints.BoundedMemorySaver()
+    return checkpoints.SQLiteSaver(str(tmp_path / "checkpoints.sqlite3"))
+
+
+def say(app, thread_id, text):
+    return app.invoke({"turns": [text]}, thread(thread_id))["turns"]
+
+
+def checkpoint_count(saver, thread_id):
+    return len(list(saver.list(thread(thread_id))))
+
+
+def test_state_carries_across_turns(saver):
+    app = chat_graph(saver)
+    assert say(app, "a", "salom") == ["salom", "reply 1"]
+    assert say(app, "b", "привет") == ["привет", "reply 1"]
+    assert say(app, "a", "yana") == ["salom", "reply 1", "yana", "reply 3"]
+    assert app.get_state(thread("a")).values["turns"][-1] == "reply 3"
+
+
+def test_state_carries_across_async_turns(saver):
+    app = chat_graph(saver)
+
+    async def run():
+        await app.ainvoke({"turns": ["salom"]}, thread("a"))
+        return (await app.ainvoke({"turns": ["yana"]}, thread("a")))["turns"]
+
+    assert asyncio.run(run()) == ["salom", "reply 1", "yana", "reply 3"]
+
+
+def test_sqlite_state_survives_a_new_saver(tmp_path):
+    path = str(tmp_path / "checkpoints.sqlite3")
+    say(chat_graph(checkpoints.SQLiteSaver(path)), "a", "salom")
+    # A restarted worker (or another one on the host) opens the same file
+    assert say(chat_graph(checkpoints.SQLiteSaver(path)), "a", "yana") == ["salom", "reply 1", "yana", "reply 3"]
+
+
+def test_old_checkpoints_are_pruned(saver, monkeypatch):
+    monkeypatch.setattr(checkpoints, "MAX_CHECKPOINTS", 2)
+    app = chat_graph(saver)
+    for i in range(5):
+        turns = say(app, "a", f"turn {i}")
+    assert checkpoint_count(saver, "a") == 2
+    assert saver.counters["pruned_checkpoints"] > 0
+    # The kept checkpoints still hold the whole conversation
+    assert len(turns) == 10
+    assert say(app, "a", "last")[:2] == ["turn 0", "reply 1"]
+
+
+def test_pruning_is_per_thread(saver, monkeypatch):
+    monkeypatch.setattr(checkpoints, "MAX_CHECKPOINTS", 2)
+    app = chat_graph(saver)
+    say(app, "a", "salom")
+    for i in range(4):
+        say(app, "b", f"turn {i}")
+    assert say(app, "a", "yana") == ["salom", "reply 1", "yana", "reply 3"]
+
+
+def test_idle_session_expires(saver, clock, monkeypatch):
+    monkeypatch.setattr(checkpoints, "SESSION_TTL", 60.0)
+    app = chat_graph(saver)
+    say(app, "a", "salom")
+    clock.now += 30
+    assert say(app, "a", "yana")[:2] == ["salom", "reply 1"]
+    # Each use restarts the TTL; a minute of silence after the last one forgets the session
+    clock.now += 61
+    assert saver.get_tuple(thread("a")) is None
+    assert saver.counters["expired_sessions"] == 1
+    assert say(app, "a", "qaytdim") == ["qaytdim", "reply 1"]
+
+
+def test_sweep_drops_expired_sessions(saver, clock, monkeypatch):
+    monkeypatch.setattr(checkpoints, "SESSION_TTL", 60.0)
+    app = chat_graph(saver)
+    say(app, "old", "salom")
+    clock.now += 50
+    say(app, "new", "salom")
+    clock.now += 20
+    saver.sweep()
+    assert saver.stats()["sessions"] == 1
+    assert checkpoint_count(saver, "old") == 0
+    assert checkpoint_count(saver, "new") > 0
+    assert saver.counters["expired_sessions"] == 1
+
+
+def test_least_recently_used_session_is_evicted(saver, clock, monkeypatch):
+    monkeypatch.setattr(checkpoints, "MAX_SESSIONS", 2)
+    monkeypatch.setattr(checkpoints, "SWEEP_INTERVAL", 0.0)
+    app = chat_graph(saver)
+    say(app, "a", "salom")
+    clock.now += 1
+    say(app, "b", "salom")
+    clock.now += 1
+    # Reading "a" makes "b" the least recently used
+    assert saver.get_tuple(thread("a")) is not None
+    clock.now += 1
+    say(app, "c", "salom")
+    assert saver.stats()["sessions"] == 2
+    assert checkpoint_count(saver, "b") == 0
+    assert checkpoint_count(saver, "a") > 0 and checkpoint_count(saver, "c") > 0
+    assert saver.counters["evicted_sessions"] == 1
+
+
+def test_checkpoint_stats(saver):
+    say(chat_graph(saver), "a", "salom")
+    stats = checkpoints.checkpoint_stats(saver)
+    assert stats["backend"] == saver.backend
+    assert stats["sessions"] == 1
+    assert stats["checkpoints"] > 0
+    assert stats["bytes"] > 0
+
+
+def test_create_checkpointer(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoints, "DB_PATH", str(tmp_path / "checkpoints.sqlite3"))
+    assert isinstance(checkpoints.create_checkpointer("memory"), checkpoints.BoundedMemorySaver)
+    assert isinstance(checkpoints.create_checkpointer("sqlite"), checkpoints.SQLiteSaver)
+    with pytest.raises(ValueError):
+        checkpoints.create_checkpointer("redis")
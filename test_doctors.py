@@ -0,0 +1,154 @@
+import asyncio
+import fcntl
+import json
+import os
+
+import httpx
+import pytest
+
+import doctors
+
+CATALOG = [
+    {"id": 1, "fullName": "Karimov Aziz", "speciality": [{"slug": "cardiologist"}], "rating": 4.9, "experience": 12},
+    {"id": 2, "fullName": "Aliyeva Dilnoza", "speciality": [{"slug": "neurologist"}], "rating": 4.7, "experience": 8},
+    {"id": 3, "fullName": "Karimova Nodira", "speciality": [{"slug": "neurologist"}, {"slug": "pediatrician"}], "rating": 4.7, "experience": 15},
+    {"id": 4, "fullName": "Usmonov Bekzod", "speciality": [{"slug": "dentist"}], "rating": 4.2, "experience": 3},
+    {"id": 5, "fullName": "Rahimov Karim", "speciality": [{"slug": "cardiologist"}], "rating": 4.5, "experience": 20},
+]
+
+
+class StandIn:
+    """Local stand-in for the plusmed searchDoctor API over CATALOG."""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.calls = 0
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        payload = json.loads(request.content)
+        page, size = int(payload["page"]), int(payload["pageSize"])
+        found = [
+            d for d in self.catalog
+            if (not payload["speciality"] or set(payload["speciality"]) & set(doctors.doctor_specialities(d)))
+            and all(w in doctors.normalize_name(doctors.doctor_name(d)) for w in doctors.normalize_name(payload["name"]).split())
+        ]
+        found.sort(key=lambda d: (-d["rating"], -d["experience"]))
+        return httpx.Response(200, json={"results": found[(page - 1) * size:page * size], "total": len(found)})
+
+
+@pytest.fixture
+def plusmed(tmp_path, monkeypatch):
+    stand_in = StandIn(CATALOG)
+    monkeypatch.setattr(doctors, "SNAPSHOT_PATH", str(tmp_path / "doctors.json"))
+    monkeypatch.setattr(doctors, "LOCK_PATH", str(tmp_path / "doctors.json.lock"))
+    monkeypatch.setattr(doctors, "_index", None)
+    monkeypatch.setattr(doctors, "_snapshot_mtime", None)
+    monkeypatch.setattr(doctors, "_client", httpx.AsyncClient(transport=httpx.MockTransport(stand_in.handler)))
+    yield stand_in
+    doctors._release_sync_lock()
+
+
+def run(coro):
+    async def wrapped():
+        try:
+            return await coro
+        finally:
+            await doctors.stop()
+    return asyncio.run(wrapped())
+
+
+async def settle(rounds: int = 50):
+    for _ in range(rounds):
+        await asyncio.sleep(0.01)
+
+
+def test_only_the_lock_holder_downloads_the_catalog(plusmed, tmp_path):
+    # Another worker holds the lock and has written its snapshot
+    other = os.open(tmp_path / "doctors.json.lock", os.O_RDWR | os.O_CREAT)
+    fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    doctors._write_snapshot(CATALOG[:2])
+
+    async def scenario():
+        await doctors.start()
+        await settle()
+        return len(doctors._index), doctors.doctors_stats()["sync_owner"]
+
+    try:
+        assert run(scenario()) == (2, False)
+        assert plusmed.calls == 0
+    finally:
+        os.close(other)
+
+
+def test_follower_reloads_a_newer_snapshot(plusmed, tmp_path, monkeypatch):
+    monkeypatch.setattr(doctors, "RELOAD_INTERVAL", 0.01)
+    other = os.open(tmp_path / "doctors.json.lock", os.O_RDWR | os.O_CREAT)
+    fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    doctors._write_snapshot(CATALOG[:2])
+
+    async def scenario():
+        await doctors.start()
+        doctors._write_snapshot(CATALOG)
+        # A later mtime even on filesystems with coarse timestamps
+        os.utime(doctors.SNAPSHOT_PATH, (os.path.getmtime(doctors.SNAPSHOT_PATH) + 5,) * 2)
+        await settle()
+        return len(doctors._index)
+
+    try:
+        assert run(scenario()) == len(CATALOG)
+        assert plusmed.calls == 0
+    finally:
+        os.close(other)
+
+
+def test_lock_holder_syncs_and_writes_the_snapshot(plusmed):
+    async def scenario():
+        await doctors.start()
+        await settle()
+        return len(doctors._index), doctors.doctors_stats()["sync_owner"]
+
+    assert run(scenario()) == (len(CATALOG), True)
+    assert plusmed.calls > 0
+    assert len(doctors._read_snapshot()) == len(CATALOG)
+
+
+def test_fresh_snapshot_is_not_downloaded_again(plusmed):
+    doctors._write_snapshot(CATALOG)
+
+    async def scenario():
+        await doctors.start()
+        await settle()
+        return doctors.doctors_stats()["sync_owner"]
+
+    assert run(scenario()) is True
+    assert plusmed.calls == 0
+
+
+# (local query, the same query as the API takes it, specialities, page, page size)
+@pytest.mark.parametrize("name, remote_name, speciality, page, page_size", [
+    ("", "", ["cardiologist"], 1, 3),
+    ("", "", ["neurologist", "pediatrician"], 1, 3),
+    ("karim", "karim", [], 1, 3),
+    ("karim", "karim", [], 2, 2),
+    # The mirror also matches the Cyrillic spelling of a name
+    ("Каримов", "karimov", [], 1, 3),
+    ("ka", "ka", ["cardiologist"], 1, 3),
+    ("aliyeva dilnoza", "aliyeva dilnoza", ["neurologist"], 1, 3),
+])
+def test_local_search_matches_the_remote_api(plusmed, name, remote_name, speciality, page, page_size):
+    local = doctors.DoctorIndex(CATALOG).search(name, speciality, page, page_size)
+    remote = run(doctors.remote_search(page, page_size, remote_name, speciality))
+    assert [d["id"] for d in local["results"]] == [d["id"] for d in remote["results"]]
+    assert local["total"] == remote["total"]
+
+
+def test_unknown_speciality_falls_back_to_the_api(plusmed):
+    assert doctors.DoctorIndex(CATALOG).search("", ["cosmetologist"]) is None
+
+    async def scenario():
+        doctors._index = doctors.DoctorIndex(CATALOG)
+        return await doctors.search("1", "3", "", ["cosmetologist"])
+
+    assert run(scenario())["results"] == []
+    assert plusmed.calls == 1
@@ -0,0 +1,186 @@
+import asyncio
+import json
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import forma1
+import forma2
+import forma_cache
+import forma_extract
+import spreadsheet
+
+HEADER = [
+    ["BUXGALTERIYA BALANSI - 1-SON SHAKL", None, None, None, None],
+    ["31 dekabr 2024 y. holatiga", None, None, None, None],
+    ["Korxona, tashkilot", "OOO Test Savdo", None, None, None],
+    ["Tarmoq", "Savdo", None, None, None],
+    ["STIR", "301234567", None, None, None],
+    ["Manzil", "Toshkent sh., Chilonzor t.", None, None, None],
+    ["Ko'rsatkichlar nomi", "Satr kodi", None, "Davr boshiga", "Davr oxiriga"],
+]
+
+
+def sheet(rows):
+    """A DataFrame as read_excel returns it: the first line becomes the column names."""
+    width = max(len(r) for r in rows)
+    rows = [list(r) + [None] * (width - len(r)) for r in rows]
+    columns = [c if c is not None else f"Unnamed: {i}" for i, c in enumerate(rows[0])]
+    return pd.DataFrame(rows[1:], columns=columns)
+
+
+def balance_rows(codes, start=0):
+    # The empty third column is a merged cell in the exports
+    return [[f"Satr {code}", code, None, 1000 * (n + start), f"{n + start} 500,5"] for n, code in enumerate(codes)]
+
+
+FORMA1_CODES = ["010", "011", "012", "020", "030", "040", "130", "390", "400"]
+OUT_OF_BALANCE = ["001", "002", "003"]
+
+
+def forma1_sheet(**changes):
+    rows = HEADER + balance_rows(FORMA1_CODES) + [["BALANSDAN TASHQARI SCHYOTLARDA HISOBGA OLINADIGAN QIYMATLIKLAR"]] + balance_rows(OUT_OF_BALANCE)
+    for index, row in changes.items():
+        rows[int(index.lstrip("r"))] = row
+    return sheet(rows)
+
+
+def test_forma1_rules_read_header_rows_and_second_table():
+    extracted = forma_extract.extract_forma1(forma1_sheet())
+    data = extracted["data"]
+    assert (data["date"], data["company"], data["network"], data["inn"], data["address"]) == (
+        "31 dekabr 2024 y.", "OOO Test Savdo", "Savdo", "301234567", "Toshkent sh., Chilonzor t.")
+    assert [r["row_no"] for r in data["rows"]] == FORMA1_CODES
+    assert data["rows"][1] == {"row_no": "011", "sum_begin_period": "1000", "sum_end_period": "1500.5"}
+    assert [r["row_no"] for r in data["rows_out_of_balance"]] == OUT_OF_BALANCE
+    assert "BALANSDAN TASHQARI" in extracted["titles"]["rows_out_of_balance"]
+    assert extracted["unresolved"] == {} and extracted["missing_header"] == []
+    assert not forma_extract.needs_llm(extracted)
+
+
+def test_codes_typed_as_numbers_are_found():
+    rows = HEADER + [[f"Satr {c}", float(int(c)), None, 1, 2] for c in FORMA1_CODES]
+    data = forma_extract.extract_forma1(sheet(rows))["data"]
+    assert [r["row_no"] for r in data["rows"]] == FORMA1_CODES
+
+
+def test_code_restart_switches_section_without_a_title():
+    rows = HEADER + balance_rows(FORMA1_CODES) + balance_rows(OUT_OF_BALANCE)
+    extracted = forma_extract.extract_forma1(sheet(rows))
+    assert [r["row_no"] for r in extracted["data"]["rows_out_of_balance"]] == OUT_OF_BALANCE
+    assert extracted["titles"] == {}
+
+
+def test_sheet_without_enough_codes_is_left_to_the_llm():
+    rows = HEADER + balance_rows(["010", "020", "030", "040"])
+    assert forma_extract.extract_forma1(sheet(rows)) is None
+
+
+def test_text_in_a_value_cell_is_unresolved():
+    rows = HEADER + balance_rows(FORMA1_CODES)
+    rows[len(HEADER) + 2][4] = "izoh 3-ilovada"
+    extracted = forma_extract.extract_forma1(sheet(rows))
+    assert "012" not in [r["row_no"] for r in extracted["data"]["rows"]]
+    assert extracted["unresolved"] == {"rows": ["Satr 012 | 012 | 2000 | izoh 3-ilovada"]}
+    assert forma_extract.needs_llm(extracted)
+
+
+def test_forma2_budget_table_uses_the_leftmost_value_columns():
+    rows = [
+        ["MOLIYAVIY NATIJALAR TO'G'RISIDA HISOBOT", None, None, None, None, None],
+        ["Korxona", "OOO Test Savdo"], ["INN 301234567"], ["01.01.2025"],
+        ["Ko'rsatkich", "Kod", "Daromad", "Xarajat", "Daromad", "Xarajat"],
+    ]
+    rows += [[f"Satr {c}", c, 1, 2, 3, 4] for c in ("010", "020", "030", "100", "240")]
+    rows += [["BYUDJETGA TO‘LOVLAR TO'G'RISIDA MA'LUMOT"]]
+    rows += [[f"Soliq {c}", c, 10, 9, None, None] for c in ("250", "260", "270")]
+    extracted = forma_extract.extract_forma2(sheet(rows))
+    data = extracted["data"]
+    assert data["rows"][0] == {"row_no": "010", "sum_old_income": "1", "sum_old_outcome": "2", "sum_period_income": "3", "sum_period_outcome": "4"}
+    assert data["rows_payments_to_budget"][2] == {"row_no": "270", "sum_begin_period": "10", "sum_end_period": "9"}
+    assert (data["company"], data["inn"], data["date"]) == ("OOO Test Savdo", "301234567", "01.01.2025")
+
+
+@pytest.mark.parametrize("cell, number", [
+    ("1 234 567,89", 1234567.89), ("(1 234)", -1234.0), ("1234.5", 1234.5), (12, 12.0),
+    ("-", None), ("", None), ("nan", None), (float("nan"), None), ("abc", None), (True, None),
+])
+def test_parse_number(cell, number):
+    assert forma_extract.parse_number(cell) == number
+
+
+class FakeLLM:
+    def __init__(self, reply=None, error=None):
+        self.reply, self.error, self.calls = reply, error, []
+
+    async def ainvoke(self, messages):
+        self.calls.append(messages[-1].content)
+        if self.error:
+            raise self.error
+        return SimpleNamespace(content=json.dumps(self.reply))
+
+
+def test_missing_network_and_address_do_not_call_the_llm():
+    rows = [r for r in HEADER if r[0] not in ("Tarmoq", "Manzil")] + balance_rows(FORMA1_CODES)
+    extracted = forma_extract.extract_forma1(sheet(rows))
+    assert set(extracted["missing_header"]) == {"network", "address"}
+    llm = FakeLLM()
+    data = asyncio.run(forma_extract.resolve_with_llm(llm, "prompt", extracted))
+    assert llm.calls == [] and data["network"] is None
+
+
+def test_llm_gets_only_header_and_unresolved_rows():
+    rows = [r for r in HEADER if r[0] != "STIR"] + balance_rows(FORMA1_CODES)
+    rows[len(rows) - 1][3] = "qarang"
+    extracted = forma_extract.extract_forma1(sheet(rows))
+    llm = FakeLLM({"inn": "309999999", "rows": [{"row_no": "400", "sum_begin_period": "8000", "sum_end_period": "8500"}]})
+    data = asyncio.run(forma_extract.resolve_with_llm(llm, "prompt", extracted))
+    assert "Satr 400" in llm.calls[0] and "Satr 010" not in llm.calls[0]
+    assert data["inn"] == "309999999"
+    assert [r["row_no"] for r in data["rows"]] == FORMA1_CODES
+
+
+@pytest.fixture
+def forma_app(monkeypatch, tmp_path):
+    monkeypatch.setattr(forma_cache, "DB_PATH", str(tmp_path / "forma.sqlite3"))
+    monkeypatch.setattr(forma_cache, "_db_ready", False)
+    monkeypatch.setattr(forma_cache, "_memory", OrderedDict())
+    app = FastAPI()
+    app.include_router(forma1.router)
+    app.include_router(forma2.router)
+
+    def serve(df, llm):
+        async def parse_upload(upload):
+            return df, spreadsheet.flatten_frame(df)
+        monkeypatch.setattr(spreadsheet, "parse_upload", parse_upload)
+        monkeypatch.setattr(forma1, "get_llm", lambda *args: llm)
+        return TestClient(app)
+
+    return serve
+
+
+def upload(client, path, content=b"a,b\n"):
+    # A distinct body per test so the forma cache never answers
+    return client.post(path, files={"file": ("forma.csv", content + path.encode() + str(id(client)).encode())})
+
+
+def test_llm_failure_returns_flagged_partial_result(forma_app):
+    rows = [r for r in HEADER if r[0] != "STIR"] + balance_rows(FORMA1_CODES)
+    client = forma_app(sheet(rows), FakeLLM(error=RuntimeError("timeout")))
+    response = upload(client, "/webhook/forma1")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["incomplete"] is True and body["missing_header"] == ["inn"]
+    assert len(body["rows"]) == len(FORMA1_CODES)
+
+
+def test_llm_failure_without_rows_is_an_error(forma_app):
+    rows = HEADER + [[f"Satr {c}", c, None, "qarang", "qarang"] for c in FORMA1_CODES]
+    client = forma_app(sheet(rows), FakeLLM(error=RuntimeError("timeout")))
+    response = upload(client, "/webhook/forma1")
+    assert response.status_code == 500
+    assert response.json()["detail"].startswith("AI Parsing failed")
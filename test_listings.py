@@ -0,0 +1,174 @@
+import asyncio
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import listings
+
+# Tashkent centre
+LAT, LON = 41.311, 69.279
+
+
+def flats(n=2000, spread=0.3, seed=7):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "latitude": LAT + rng.uniform(-spread, spread, n),
+        "longitude": LON + rng.uniform(-spread, spread, n),
+        "type": rng.choice(["first_line", "SECOND_LINE", " first_line "], n),
+        "area_m2": rng.uniform(30, 200, n).round(1),
+        "price_usd": rng.uniform(20_000, 200_000, n).round(),
+        "title": [f"flat {i}" for i in range(n)],
+    })
+
+
+def brute_force(df, latitude, longitude, area, property_type, k):
+    """Every listing's distance, filtered the way nearest() documents."""
+    df = df.assign(type=df["type"].map(listings.normalize_type))
+    dist = listings.haversine_km(latitude, longitude, df["latitude"].to_numpy(), df["longitude"].to_numpy())
+    keep = dist <= listings.MAX_RADIUS_KM
+    if property_type:
+        keep &= (df["type"] == listings.normalize_type(property_type)).to_numpy()
+    if area:
+        a = df["area_m2"].to_numpy()
+        keep &= (a >= area * (1 - listings.AREA_BAND)) & (a <= area * (1 + listings.AREA_BAND))
+    order = np.argsort(dist[keep], kind="stable")[:k]
+    return list(df["title"].to_numpy()[keep][order])
+
+
+@pytest.mark.parametrize("latitude, longitude, area, property_type, k", [
+    (LAT, LON, 80, "FIRST_LINE", 8),
+    (LAT + 0.005, LON - 0.005, None, None, 20),
+    (LAT, LON, 190, "second_line", 5),
+    # Grid cell corners: the nearest listing may sit in the next cell
+    (41.30, 69.28, 60, "FIRST_LINE", 3),
+    # Near the edge of the data: fewer than k within MAX_RADIUS_KM
+    (LAT + 0.4, LON + 0.4, None, None, 50),
+])
+def test_nearest_matches_a_full_scan(latitude, longitude, area, property_type, k):
+    df = flats()
+    index = listings.GeoIndex(df)
+    rows = index.nearest(latitude, longitude, area, property_type, k)
+    assert [r["title"] for r in rows] == brute_force(df, latitude, longitude, area, property_type, k)
+    assert all(r["distance_km"] <= listings.MAX_RADIUS_KM for r in rows)
+    assert [r["distance_km"] for r in rows] == sorted(r["distance_km"] for r in rows)
+
+
+def test_nearest_rows():
+    index = listings.GeoIndex(flats())
+    row = index.nearest(LAT, LON, 80, "FIRST_LINE", 1)[0]
+    assert set(row) == {"title", "price_usd", "area_m2", "type", "price_per_m2_usd", "distance_km"}
+    assert row["type"] == "FIRST_LINE"
+    assert row["price_per_m2_usd"] == round(row["price_usd"] / row["area_m2"], 2)
+
+
+def test_nothing_nearby():
+    index = listings.GeoIndex(flats())
+    assert index.nearest(39.65, 66.96, 80, "FIRST_LINE") == []
+    assert index.nearest(LAT, LON, 80, "VILLA") == []
+
+
+def test_unusable_rows_are_dropped():
+    df = pd.DataFrame({
+        "latitude": [LAT, "x", LAT, LAT],
+        "longitude": [LON, LON, LON, LON],
+        "type": ["A", "A", "A", "A"],
+        "area_m2": [50, 50, 0, 50],
+        "price_usd": [50_000, 50_000, 50_000, None],
+    })
+    assert len(listings.GeoIndex(df)) == 1
+    with pytest.raises(ValueError, match="missing columns"):
+        listings.GeoIndex(df.drop(columns=["price_usd"]))
+
+
+def test_dump_is_reloaded_when_the_file_changes(tmp_path, monkeypatch):
+    path = tmp_path / "uy_joy.csv"
+    monkeypatch.setattr(listings, "uy_joy", listings.Dump("real-estate", str(path), listings.GeoIndex))
+    df = flats(20, spread=0.05)
+    df["listed_at"] = pd.Timestamp("2024-05-01")
+
+    async def query():
+        return await listings.find_comparables(LAT, LON, None, None, k=100)
+
+    # No dump yet: the handlers fall back to the search agent
+    assert asyncio.run(query()) is None
+    df.to_csv(path, index=False)
+    asyncio.run(listings.uy_joy.refresh(force=True))
+    rows = asyncio.run(query())
+    assert len(rows) == 20
+    assert rows[0]["listed_at"].startswith("2024-05-01")
+
+    df.head(5).to_csv(path, index=False)
+    os.utime(path, (0, os.path.getmtime(path) + 10))
+    asyncio.run(listings.uy_joy.refresh(force=True))
+    assert len(asyncio.run(query())) == 5
+    # A broken dump keeps the previous one in service
+    path.write_text("latitude\n1\n")
+    os.utime(path, (0, os.path.getmtime(path) + 20))
+    asyncio.run(listings.uy_joy.refresh(force=True))
+    assert len(asyncio.run(query())) == 5
+    assert listings.uy_joy.stats()["load_errors"] == 1
+
+
+def test_find_comparables_needs_coordinates(monkeypatch):
+    monkeypatch.setattr(listings.uy_joy, "index", listings.GeoIndex(flats(50)))
+    monkeypatch.setattr(listings.uy_joy, "checked_at", float("inf"))
+    for latitude, longitude in ((None, LON), ("abc", LON), (float("nan"), LON)):
+        assert asyncio.run(listings.find_comparables(latitude, longitude)) is None
+    assert asyncio.run(listings.find_comparables(str(LAT), str(LON), "x")) != []
+
+
+# --- Vehicles ---
+@pytest.mark.parametrize("body, engine", [
+    ({"ENGINE": "1.5"}, "1.5"),
+    ({"ENGINE": "1,5 L"}, "1.5"),
+    ({"ENGINE": "1485"}, "1.5"),
+    ({"MODEL": "Chevrolet Cobalt 1.5 LTZ"}, "1.5"),
+    ({"MODEL": "Chevrolet Cobalt", "ENGINE": "1.6", "MOTOR": "4G15K123456"}, "1.6"),
+    # Generations and serial numbers are not volumes
+    ({"MODEL": "Chevrolet Nexia 3"}, None),
+    ({"MODEL": "Chevrolet Malibu 2", "MOTOR": "4G15K123456"}, None),
+    ({"MODEL": "Chevrolet Cobalt", "MOTOR": "2.0"}, None),
+    ({"MODEL": "Chevrolet Cobalt", "ENGINE": "---"}, None),
+])
+def test_vehicle_engine(body, engine):
+    assert listings.vehicle_engine(body) == engine
+
+
+def cars():
+    return pd.DataFrame({
+        "model": ["Chevrolet Cobalt"] * 6 + ["chevrolet  COBALT-ltz", "Chevrolet Nexia 3", "Chevrolet Cobalt"],
+        "year": [2014, 2017, 2019, 2020, 2021, 2023, "2020", 2020, "n/a"],
+        "engine": ["1.5", "1.5", "1,5 L", "1485", "1.6", "1.5", "1.5", "1.5", "1.5"],
+        "price_usd": [6_000, 8_000, 9_500, 10_000, 10_500, 12_000, 10_200, 7_000, 9_000],
+        "title": [f"car {i}" for i in range(9)],
+    })
+
+
+def test_vehicle_comparables_within_the_year_window():
+    index = listings.VehicleIndex(cars())
+    found = index.comparables("CHEVROLET COBALT", "2020")
+    # 2014 is outside +-3 years, "n/a" is dropped, Nexia and Cobalt LTZ are other models
+    assert sorted(found["years"]) == [2017, 2019, 2020, 2021, 2023]
+    assert found["same_engine"] is False
+    # Closest model years first
+    assert list(found["rows"]["year"][:2]) == [2020, 2019]
+    assert len(found["prices_usd"]) == len(found["rows"])
+
+
+def test_vehicle_comparables_prefer_the_same_engine():
+    index = listings.VehicleIndex(cars())
+    found = index.comparables("Chevrolet Cobalt", 2020, "1.5")
+    assert found["same_engine"] is True
+    assert sorted(found["years"]) == [2017, 2019, 2020, 2023]
+    # Too few 1.6 listings: all engines are used
+    assert index.comparables("Chevrolet Cobalt", 2020, "1.6")["same_engine"] is False
+
+
+def test_vehicle_comparables_none():
+    index = listings.VehicleIndex(cars())
+    assert index.comparables("Chevrolet Spark", 2020) is None
+    assert index.comparables("Chevrolet Cobalt", "---") is None
+    assert index.comparables("Chevrolet Cobalt", 2030) is None
+    assert index.comparables("Chevrolet Nexia 3", 2020)["rows"]["title"].tolist() == ["car 7"]
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+import pipeline
+
+
+@pytest.fixture(autouse=True)
+def stats(monkeypatch):
+    monkeypatch.setattr(pipeline, "_stats", {})
+
+
+class Log:
+    """Records when each stage starts and ends."""
+
+    def __init__(self):
+        self.events = []
+
+    def stage(self, name, result=None, delay=0.01, error=None):
+        async def func(**inputs):
+            self.events.append(("start", name, inputs))
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.events.append(("cancelled", name))
+                raise
+            if error is not None:
+                raise error
+            self.events.append(("end", name))
+            return result if result is not None else name
+        return func
+
+    def index(self, event, name):
+        return next(i for i, e in enumerate(self.events) if e[0] == event and e[1] == name)
+
+
+def run(stages):
+    return asyncio.run(pipeline.run("test", stages))
+
+
+def test_stage_runs_after_its_deps_and_receives_their_results():
+    log = Log()
+    results = run([
+        # Listed out of order on purpose
+        pipeline.Stage("valuation", log.stage("valuation", {"price": 1}), deps=("search", "rate")),
+        pipeline.Stage("search", log.stage("search", ["listing"], delay=0.05)),
+        pipeline.Stage("rate", log.stage("rate", 12_500.0)),
+    ])
+    assert results == {"valuation": {"price": 1}, "search": ["listing"], "rate": 12_500.0}
+    assert log.index("start", "valuation") > log.index("end", "search")
+    assert log.index("start", "valuation") > log.index("end", "rate")
+    assert log.events[log.index("start", "valuation")][2] == {"search": ["listing"], "rate": 12_500.0}
+
+
+def test_independent_stages_overlap():
+    log = Log()
+    run([
+        pipeline.Stage("search", log.stage("search", delay=0.05)),
+        pipeline.Stage("rate", log.stage("rate", delay=0.05)),
+    ])
+    # Both start before either ends
+    assert [e[0] for e in log.events] == ["start", "start", "end", "end"]
+
+
+def test_failure_without_fallback_fails_the_pipeline_and_cancels_the_rest():
+    log = Log()
+    with pytest.raises(ValueError, match="no rate"):
+        run([
+            pipeline.Stage("search", log.stage("search", delay=1)),
+            pipeline.Stage("rate", log.stage("rate", error=ValueError("no rate"))),
+            pipeline.Stage("valuation", log.stage("valuation"), deps=("search", "rate")),
+        ])
+    assert ("cancelled", "search") in log.events
+    assert not any(e[1] == "valuation" and e[0] == "start" for e in log.events)
+    assert pipeline.pipeline_stats()["test"]["rate"]["failures"] == 1
+
+
+def test_fallback_value_and_callable():
+    log = Log()
+    results = run([
+        pipeline.Stage("comparables", log.stage("comparables", error=LookupError("no dump")), fallback=None),
+        pipeline.Stage("search", log.stage("search", error=RuntimeError("429")),
+                       fallback=lambda e: {"status": "no_listing_found", "error": str(e)}),
+        pipeline.Stage("valuation", log.stage("valuation"), deps=("comparables", "search")),
+    ])
+    assert results["comparables"] is None
+    assert results["search"] == {"status": "no_listing_found", "error": "429"}
+    assert log.events[log.index("start", "valuation")][2] == {"comparables": None, "search": results["search"]}
+    stats = pipeline.pipeline_stats()["test"]
+    assert stats["search"]["fallbacks"] == 1 and stats["valuation"]["runs"] == 1
+
+
+def test_timeout():
+    log = Log()
+    with pytest.raises(pipeline.StageTimeout, match="'search' timed out"):
+        run([pipeline.Stage("search", log.stage("search", delay=1), timeout=0.01)])
+    assert ("cancelled", "search") in log.events
+
+    results = run([pipeline.Stage("rate", log.stage("rate", delay=1), timeout=0.01, fallback=lambda e: type(e).__name__)])
+    assert results == {"rate": "StageTimeout"}
+    assert pipeline.pipeline_stats()["test"]["rate"]["timeouts"] == 1
+
+
+@pytest.mark.parametrize("stages, message", [
+    ([pipeline.Stage("a", None), pipeline.Stage("a", None)], "Duplicate stage names"),
+    ([pipeline.Stage("a", None, deps=("b",))], "unknown stages"),
+    ([pipeline.Stage("a", None, deps=("b",)), pipeline.Stage("b", None, deps=("a",))], "Dependency cycle"),
+])
+def test_invalid_graphs(stages, message):
+    with pytest.raises(ValueError, match=message):
+        run(stages)
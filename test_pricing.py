@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import pricing
+
+RATE = 12_500.0
+
+
+def test_depreciation_curve():
+    prices = np.array([10_000.0] * 5)
+    years = np.array([2018, 2019, 2020, 2021, 2022], dtype=float)
+    adjusted = pricing.adjust_to_year(prices, years, 2020, rate=0.02)
+    # Newer listings lose 2% per year, older ones gain it back, compounded
+    assert adjusted == pytest.approx([10_000 / 0.98 ** 2, 10_000 / 0.98, 10_000, 9_800, 9_604])
+    assert list(adjusted) == sorted(adjusted, reverse=True)
+
+
+def test_depreciation_is_compounded_not_linear():
+    adjusted = pricing.adjust_to_year(np.array([10_000.0]), np.array([2030.0]), 2020, rate=0.02)
+    assert adjusted[0] == pytest.approx(10_000 * 0.98 ** 10)
+    assert adjusted[0] > 10_000 * (1 - 0.02 * 10)
+
+
+def test_same_year_comparables_are_not_adjusted():
+    prices = np.array([9_000.0, 10_000.0, 11_000.0])
+    result = pricing.price_range(prices, np.array([2020.0] * 3), "2020", RATE)
+    assert result["estimated_min_price"] == 112_500_000
+    assert result["estimated_max_price"] == 137_500_000
+    assert result["median_price_usd"] == 10_000
+    assert result["comparables"] == 3
+    assert result["usd_rate"] == RATE
+
+
+def test_small_samples_use_min_and_max_large_ones_the_quartiles():
+    small = np.array([5_000.0, 10_000.0, 20_000.0])
+    assert pricing.price_range(small, np.full(3, 2020.0), 2020, RATE)["estimated_max_price"] == 250_000_000
+
+    large = np.array([5_000.0] + [10_000.0] * 8 + [50_000.0])
+    result = pricing.price_range(large, np.full(10, 2020.0), 2020, RATE)
+    # An outlier on either side doesn't stretch the range
+    assert result["estimated_min_price"] == result["estimated_max_price"] == 125_000_000
+
+
+def test_prices_are_rounded():
+    result = pricing.price_range(np.array([10_001.0, 10_002.0, 10_003.0]), np.full(3, 2020.0), 2020, RATE)
+    assert result["estimated_min_price"] % pricing.ROUND_TO == 0
+    assert result["estimated_min_price"] == 125_000_000
+
+
+def test_older_subject_is_priced_lower():
+    prices = np.array([9_000.0, 10_000.0, 11_000.0])
+    years = np.full(3, 2020.0)
+    newer = pricing.price_range(prices, years, 2022, RATE)
+    older = pricing.price_range(prices, years, 2016, RATE)
+    assert older["estimated_max_price"] < newer["estimated_max_price"]
+
+
+@pytest.mark.parametrize("prices, year, rate", [
+    (np.array([10_000.0, 11_000.0]), 2020, RATE),
+    (np.array([10_000.0] * 3), "---", RATE),
+    (np.array([10_000.0] * 3), float("nan"), RATE),
+    (np.array([10_000.0] * 3), 2020, 0),
+])
+def test_no_range_without_enough_data(prices, year, rate):
+    assert pricing.price_range(prices, np.full(len(prices), 2020.0), year, rate) is None
@@ -0,0 +1,164 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import avto
+import reasons
+import valuation_cache
+
+
+class ReasonLLM:
+    """Writes the explanation in the requested language after a short delay; counts the calls."""
+
+    def __init__(self):
+        self.languages = []
+        self.running = 0
+        self.peak = 0
+
+    async def ainvoke(self, messages):
+        language = messages[-1].content.split("language: ")[1].splitlines()[0]
+        self.languages.append(language)
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(0.05)
+        self.running -= 1
+        return SimpleNamespace(content=f"<p>Narx {language} bo‘yicha</p>", usage_metadata=None)
+
+
+@pytest.fixture
+def llm(tmp_path, monkeypatch):
+    monkeypatch.setattr(reasons, "DB_PATH", str(tmp_path / "reasons.sqlite3"))
+    monkeypatch.setattr(reasons, "_db_ready", False)
+    monkeypatch.setattr(reasons, "_valuations", OrderedDict())
+    monkeypatch.setattr(reasons, "_reasons", OrderedDict())
+    monkeypatch.setattr(reasons, "_counters", {k: 0 for k in reasons._counters})
+    fake = ReasonLLM()
+    monkeypatch.setattr(reasons, "get_llm", lambda *args: fake)
+    return fake
+
+
+def valuation(reason=None, language="uz"):
+    context = {"input": "Car Info: {}", "usd_rate": 12_500, "estimated_min_price": 1, "estimated_max_price": 2}
+    return asyncio.run(reasons.new_valuation("avto", context, reason, language))
+
+
+# --- Languages ---
+@pytest.mark.parametrize("value, language", [
+    (None, "uz"), ("", "uz"), ("uz", "uz"), ("UZ_LATN", "uz"),
+    ("cyrl", "cyrl"), (" uz_cyrl ", "cyrl"), ("uz_kiril", "cyrl"), ("Kiril", "cyrl"),
+    ("ru", "ru"), ("en", "en"), ("ALL", "all"),
+])
+def test_normalize_language(value, language):
+    assert reasons.normalize_language(value) == language
+
+
+def test_unknown_language_is_a_400():
+    with pytest.raises(HTTPException) as e:
+        reasons.normalize_language("de")
+    assert e.value.status_code == 400
+
+
+def test_expand_and_model_language():
+    assert reasons.expand("all") == ["uz", "cyrl", "ru", "en"]
+    assert reasons.expand("ru") == ["ru"]
+    assert [reasons.model_language(l) for l in ("all", "cyrl", "uz", "ru", "en")] == ["uz", "uz", "uz", "ru", "en"]
+
+
+# --- Generation ---
+def test_only_the_requested_language_is_generated(llm):
+    valuation_id = valuation()
+    texts = asyncio.run(reasons.get_reasons(valuation_id, "avto", "ru"))
+    assert texts == {"ru": "<p>Narx Rus tili bo‘yicha</p>"}
+    assert llm.languages == ["Rus tili"]
+
+
+def test_cyrillic_is_transliterated_from_the_latin_text(llm):
+    valuation_id = valuation()
+    texts = asyncio.run(reasons.get_reasons(valuation_id, "avto", "cyrl"))
+    assert texts == {"cyrl": "<p>Нарх Ўзбек тили (лотин алифбоси) бўйича</p>"}
+    assert llm.languages == [reasons.LANGUAGES["uz"]]
+
+
+def test_all_generates_the_three_model_languages_concurrently(llm):
+    valuation_id = valuation()
+    texts = asyncio.run(reasons.get_reasons(valuation_id, "avto", "all"))
+    assert list(texts) == ["uz", "cyrl", "ru", "en"]
+    assert sorted(llm.languages) == sorted(reasons.LANGUAGES.values())
+    # cyrl waits for uz instead of making a fourth call
+    assert llm.peak == 3
+
+
+def test_reason_from_the_valuation_call_is_reused(llm):
+    valuation_id = valuation("<p>Tayyor izoh</p>", "uz")
+    assert asyncio.run(reasons.get_reasons(valuation_id, "avto", "uz")) == {"uz": "<p>Tayyor izoh</p>"}
+    assert llm.languages == []
+
+
+def test_concurrent_requests_share_one_call(llm):
+    valuation_id = valuation()
+
+    async def scenario():
+        return await asyncio.gather(*(reasons.get_reason(valuation_id, "avto", "en") for _ in range(5)))
+
+    assert len(set(asyncio.run(scenario()))) == 1
+    assert llm.languages == ["Ingliz tili"]
+
+
+def test_another_worker_finds_the_valuation_on_disk(llm, monkeypatch):
+    valuation_id = valuation()
+    asyncio.run(reasons.get_reasons(valuation_id, "avto", "uz"))
+    # A fresh process: nothing in memory, same SQLite file
+    monkeypatch.setattr(reasons, "_valuations", OrderedDict())
+    monkeypatch.setattr(reasons, "_reasons", OrderedDict())
+    assert asyncio.run(reasons.get_reasons(valuation_id, "avto", "uz")) == {"uz": "<p>Narx O'zbek tili (lotin alifbosi) bo‘yicha</p>"}
+    assert len(llm.languages) == 1
+    # The valuation context and the explanation
+    assert reasons._counters["disk_hits"] == 2
+
+
+def test_unknown_or_other_kind_valuation_is_a_404(llm):
+    valuation_id = valuation()
+    for args in (("missing", "avto"), (valuation_id, "uy_joy")):
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(reasons.get_valuation(*args))
+        assert e.value.status_code == 404
+
+
+# --- API ---
+@pytest.fixture
+def client(llm, monkeypatch):
+    monkeypatch.setattr(valuation_cache, "_entries", OrderedDict())
+
+    async def value_avto(body, language):
+        valuation_id = await reasons.new_valuation("avto", {"input": "Car Info: {}"})
+        texts = await reasons.get_reasons(valuation_id, "avto", language)
+        return {"valuation_id": valuation_id, **{avto.REASON_FIELDS[l]: t for l, t in texts.items()}}
+
+    monkeypatch.setattr(avto, "value_avto", value_avto)
+    app = FastAPI()
+    app.include_router(avto.router)
+    return TestClient(app)
+
+
+def test_webhook_defaults_to_uzbek(client, llm):
+    body = client.post("/webhook/avto", json={"MODEL": "Cobalt"}).json()
+    assert set(body) == {"valuation_id", "reason_uz"}
+    assert llm.languages == [reasons.LANGUAGES["uz"]]
+
+
+def test_webhook_language_from_the_body_or_query(client):
+    assert "reason_ru" in client.post("/webhook/avto", json={"MODEL": "Cobalt", "language": "ru"}).json()
+    body = client.post("/webhook/avto?language=all", json={"MODEL": "Cobalt"}).json()
+    assert {"reason_uz", "reason_uz_kiril", "reason_ru", "reason_en"} <= set(body)
+    assert client.post("/webhook/avto?language=fr", json={"MODEL": "Cobalt"}).status_code == 400
+
+
+def test_follow_up_endpoint_adds_another_language(client, llm):
+    valuation_id = client.post("/webhook/avto", json={"MODEL": "Cobalt"}).json()["valuation_id"]
+    body = client.get(f"/webhook/avto/{valuation_id}/reason?language=en").json()
+    assert body == {"valuation_id": valuation_id, "reason_en": "<p>Narx Ingliz tili bo‘yicha</p>"}
+    assert client.get("/webhook/avto/missing/reason").status_code == 404
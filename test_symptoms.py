@@ -0,0 +1,95 @@
+import pytest
+
+import symptoms
+
+# Complaint -> the speciality its rules must point at
+POSITIVE = [
+    ("boshim og‘riyapti", "neurologist"),
+    ("Голова болит и кружится", "neurologist"),
+    ("tishim og'riyapti", "dentist"),
+    ("болит зуб", "dentist"),
+    ("qon bosimim oshib ketdi", "cardiologist"),
+    ("давление скачет", "cardiologist"),
+    ("высокое давление", "cardiologist"),
+    ("ko‘rish qobiliyatim pasaydi", "ophthalmologist"),
+    ("ko'zim qizarib ketdi", "ophthalmologist"),
+    ("температура 38", "therapist"),
+    ("qornim og‘riyapti", "gastroenterologist"),
+    ("тошнит после еды", "gastroenterologist"),
+    ("terimda toshma chiqdi", "dermatovenereologist"),
+    ("terida qizil dog‘lar", "dermatovenereologist"),
+    ("yuzimda husnbuzar ko'p", "dermatovenereologist"),
+    ("угревая сыпь на лице", "dermatovenereologist"),
+    ("угри на спине", "dermatovenereologist"),
+    ("кожа чешется", "dermatovenereologist"),
+    ("yo‘tal to‘xtamayapti", "pulmonologist"),
+    ("боль в легких", "pulmonologist"),
+    ("легочная недостаточность", "pulmonologist"),
+    ("siydik yo'lida og'riq", "urologist"),
+    ("кровь в моче", "urologist"),
+    ("моча темная", "urologist"),
+    ("почки болят", "urologist"),
+    ("uxlay olmayapman", "somnolog"),
+    ("isitmam bor", "therapist"),
+    ("у меня легкая слабость", "therapist"),
+]
+
+# Everyday phrases that share a start with a symptom stem and must not be routed by it
+NEGATIVE = [
+    ("есть угроза?", "dermatovenereologist"),
+    ("terilib ketdi", "dermatovenereologist"),
+    ("paxta terimi boshlandi", "dermatovenereologist"),
+    ("мочь не могу", "urologist"),
+    ("у меня легкая слабость", "pulmonologist"),
+    ("легко сказать", "pulmonologist"),
+    ("угрюмое настроение", "dermatovenereologist"),
+    # "ko‘rish" is also the verb "to see / to meet"
+    ("Doktor bilan ko'rishmoqchiman", "ophthalmologist"),
+    ("Shifokorni ko'rishim kerak", "ophthalmologist"),
+    ("давление в шинах", "cardiologist"),
+    # Negated complaints
+    ("у меня нет температуры", "therapist"),
+    ("температуры нет, но болит горло", "therapist"),
+    ("isitmam yo'q", "therapist"),
+    ("без температуры", "therapist"),
+]
+
+# Enough evidence for a guess without the model: a phrase rule or several hits
+CLASSIFIED = [
+    ("Голова болит и кружится", ["neurologist"]),
+    ("высокое давление и болит сердце", ["cardiologist"]),
+    ("tishim og'riyapti, milkim qonayapti", ["dentist"]),
+    ("температура и слабость", ["therapist"]),
+    ("не могу спать и храп", ["somnolog"]),
+]
+
+# A single one-word stem is too weak to route on its own
+UNCLASSIFIED = [
+    "болит зуб",
+    "кожа чешется",
+    "Doktor bilan ko'rishmoqchiman",
+    "у меня нет температуры",
+    "давление в шинах",
+    "salom, qalaysiz?",
+    "есть угроза?",
+]
+
+
+@pytest.mark.parametrize("message, slug", POSITIVE)
+def test_routed(message, slug):
+    assert slug in symptoms.scores(message)
+
+
+@pytest.mark.parametrize("message, slug", NEGATIVE)
+def test_not_routed(message, slug):
+    assert slug not in symptoms.scores(message)
+
+
+@pytest.mark.parametrize("message, slugs", CLASSIFIED)
+def test_classified(message, slugs):
+    assert symptoms.classify(message) == slugs
+
+
+@pytest.mark.parametrize("message", UNCLASSIFIED)
+def test_left_to_the_model(message):
+    assert symptoms.classify(message) == []
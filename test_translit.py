@@ -0,0 +1,58 @@
+import pytest
+
+import translit
+
+# Every apostrophe form the model and the exports use for o‘, g‘ and the tutuq belgisi
+APOSTROPHES = ["‘", "’", "'", "ʻ", "ʼ", "`"]
+
+
+@pytest.mark.parametrize("apostrophe", APOSTROPHES)
+def test_apostrophe_variants(apostrophe):
+    assert translit.to_cyrillic(f"o{apostrophe}zbek") == "ўзбек"
+    assert translit.to_cyrillic(f"G{apostrophe}alla") == "Ғалла"
+    assert translit.to_cyrillic(f"ma{apostrophe}lumot") == "маълумот"
+    assert translit.to_cyrillic(f"yo{apostrophe}l") == "йўл"
+    assert translit.to_cyrillic(f"mas{apostrophe}hur") == "масҳур"
+
+
+@pytest.mark.parametrize("latin, cyrillic", [
+    ("Yevropa", "Европа"),
+    ("yer", "ер"),
+    ("YER", "ЕР"),
+    ("Yoshlar", "Ёшлар"),
+    ("yoz", "ёз"),
+    ("Yuqori", "Юқори"),
+    ("yangi", "янги"),
+    # э at the start of a word and after a vowel, е elsewhere
+    ("ekspert", "эксперт"),
+    ("poezd", "поэзд"),
+    ("sement", "семент"),
+    # ts is т + с: it spans a suffix boundary as often as it stands for ц (o‘t-sa)
+    ("o‘tsa", "ўтса"),
+    ("tsex", "тсех"),
+])
+def test_word_start_sequences(latin, cyrillic):
+    assert translit.to_cyrillic(latin) == cyrillic
+
+
+def test_case_is_kept():
+    assert translit.to_cyrillic("Shahar SHAHAR shahar") == "Шаҳар ШАҲАР шаҳар"
+    assert translit.to_cyrillic("CHorvoq Chorvoq") == "Чорвоқ Чорвоқ"
+
+
+def test_digits_and_punctuation_are_kept():
+    assert translit.to_cyrillic("Narx: 120 000 000 so‘m (2024-yil).") == "Нарх: 120 000 000 сўм (2024-йил)."
+
+
+def test_html_markup_is_untouched():
+    html = '<p class="note">Narx &amp; sifat&nbsp;<strong>yaxshi</strong></p>'
+    assert translit.to_cyrillic_html(html) == '<p class="note">Нарх &amp; сифат&nbsp;<strong>яхши</strong></p>'
+    assert translit.to_cyrillic_html(None) is None
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_stream_matches_the_whole_text(size):
+    html = "<p>Yangi <strong>o‘zbek</strong> ma’lumot &amp; Yevropa narxi: 100 000 so‘m</p>"
+    stream = translit.CyrillicStream()
+    out = "".join(stream.feed(html[i:i + size]) for i in range(0, len(html), size)) + stream.flush()
+    assert out == translit.to_cyrillic_html(html)
@@ -0,0 +1,213 @@
+import asyncio
+import json
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+
+import avto
+import cbu_rates
+import listings
+import reasons
+import uy_joy
+import valuation_cache
+
+USD_RATE = 12_500.0
+
+
+class EchoLLM:
+    """Explanations repeat the context they were written from, so a test can read what they could name."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def ainvoke(self, messages):
+        system, user = messages[0].content, messages[1].content
+        self.calls.append(user)
+        if system == reasons.REASON_PROMPT:
+            content = f"<p>{user}</p>"
+        elif system == uy_joy.VALUATION_PROMPT:
+            content = json.dumps({"estimated_min_price": 800_000_000, "estimated_max_price": 900_000_000})
+        else:
+            raise AssertionError("only the valuation and reason agents are expected")
+        return SimpleNamespace(content=content, usage_metadata=None)
+
+
+@pytest.fixture
+def rates(tmp_path, monkeypatch):
+    monkeypatch.setattr(reasons, "DB_PATH", str(tmp_path / "reasons.sqlite3"))
+    monkeypatch.setattr(reasons, "_db_ready", False)
+    monkeypatch.setattr(reasons, "_valuations", OrderedDict())
+    monkeypatch.setattr(reasons, "_reasons", OrderedDict())
+    monkeypatch.setattr(valuation_cache, "_entries", OrderedDict())
+    monkeypatch.setattr(valuation_cache, "_counters", {k: 0 for k in valuation_cache._counters})
+    rates = {"USD": USD_RATE}
+
+    async def usd_rate(on_date=None):
+        return rates["USD"]
+
+    monkeypatch.setattr(cbu_rates, "get_usd_rate", usd_rate)
+    return rates
+
+
+@pytest.fixture
+def llm(rates, monkeypatch):
+    fake = EchoLLM()
+    for module in (avto, uy_joy, reasons):
+        monkeypatch.setattr(module, "get_llm", lambda *args: fake)
+    return fake
+
+
+def cached_valuation(request_input, listings=None, pricing=None):
+    """A finished valuation stored under one fingerprint, as the handlers leave it."""
+    async def scenario():
+        context = {
+            "input": request_input,
+            "listings": listings or {"status": "ok", "listings": [{"price": 10_000}]},
+            "pricing": pricing,
+            "usd_rate": USD_RATE,
+            "estimated_min_price": 100_000_000,
+            "estimated_max_price": 120_000_000,
+        }
+        valuation_id = await reasons.new_valuation("avto", context)
+        result = {"estimated_min_price": 100_000_000, "estimated_max_price": 120_000_000}
+        await valuation_cache.store("avto", ("cobalt", "2020", None), valuation_id, result)
+        return valuation_id
+
+    return asyncio.run(scenario())
+
+
+def lookup(request_input, fingerprint=("cobalt", "2020", None)):
+    return asyncio.run(valuation_cache.lookup("avto", fingerprint, request_input))
+
+
+def test_miss_and_uncacheable(rates):
+    assert lookup("Car Info: {}", fingerprint=None) is None
+    assert lookup("Car Info: {}") is None
+    assert valuation_cache._counters["uncacheable"] == 1
+    assert valuation_cache._counters["misses"] == 1
+
+
+def test_same_request_reuses_the_valuation(rates):
+    valuation_id = cached_valuation('Car Info: {"KUZOV": "K-111"}')
+    valuations = reasons._counters["valuations"]
+    assert lookup('Car Info: {"KUZOV": "K-111"}') == (valuation_id, {"estimated_min_price": 100_000_000, "estimated_max_price": 120_000_000})
+    assert reasons._counters["valuations"] == valuations
+    assert valuation_cache._counters["hits"] == 1
+
+
+def test_another_request_gets_an_explanation_of_its_own(rates):
+    first = cached_valuation('Car Info: {"KUZOV": "K-111", "COLOR": "oq"}')
+    second, result = lookup('Car Info: {"KUZOV": "K-222", "COLOR": "qora"}')
+    assert second != first
+    assert result["estimated_min_price"] == 100_000_000
+    context = asyncio.run(reasons.get_valuation(second, "avto"))
+    # The listings and figures are shared, nothing from the first customer's body is
+    assert context["input"] == 'Car Info: {"KUZOV": "K-222", "COLOR": "qora"}'
+    assert "K-111" not in json.dumps(context) and "oq" not in json.dumps(context)
+    assert context["listings"] == {"status": "ok", "listings": [{"price": 10_000}]}
+    assert valuation_cache._counters["hits"] == 1
+
+
+def test_rate_change_rescales_the_prices(rates):
+    pricing = {"estimated_min_price": 100_000_000, "estimated_max_price": 120_000_000, "usd_rate": USD_RATE}
+    first = cached_valuation('Car Info: {"KUZOV": "K-111"}', pricing=pricing)
+    rates["USD"] = USD_RATE * 1.1
+    valuation_id, result = lookup('Car Info: {"KUZOV": "K-111"}')
+    assert valuation_id != first
+    assert result == {"estimated_min_price": 110_000_000, "estimated_max_price": 132_000_000}
+    context = asyncio.run(reasons.get_valuation(valuation_id, "avto"))
+    assert context["usd_rate"] == rates["USD"] == context["pricing"]["usd_rate"]
+    assert context["pricing"]["estimated_max_price"] == 132_000_000
+    assert valuation_cache._counters["rescaled"] == 1
+    # The moved entry is now a plain hit at the new rate
+    assert lookup('Car Info: {"KUZOV": "K-111"}') == (valuation_id, result)
+
+
+def test_expired_entry_is_a_miss(rates):
+    cached_valuation('Car Info: {"KUZOV": "K-111"}')
+    entry = next(iter(valuation_cache._entries.values()))
+    entry["stored_at"] -= (valuation_cache.CACHE_DAYS + 2) * 86400
+    assert lookup('Car Info: {"KUZOV": "K-111"}') is None
+    assert valuation_cache._counters["expired"] == 1
+    assert not valuation_cache._entries
+
+
+def vehicle(kuzov, shassi, color):
+    return {"MODEL": "Chevrolet Cobalt", "YEAR": "2020", "KUZOV": kuzov, "SHASSI": shassi, "COLOR": color}
+
+
+def test_cached_vehicle_explanation_names_only_its_own_car(llm, monkeypatch):
+    async def comparables(model, year, engine=None):
+        return {
+            "rows": pd.DataFrame({"model": ["Cobalt"] * 3, "year": [2019, 2020, 2021], "price_usd": [9_000, 10_000, 11_000]}),
+            "prices_usd": np.array([9_000.0, 10_000.0, 11_000.0]),
+            "years": np.array([2019.0, 2020.0, 2021.0]),
+        }
+
+    monkeypatch.setattr(listings, "find_vehicle_comparables", comparables)
+
+    async def scenario():
+        first = await avto.value_avto(vehicle("K-111", "S-111", "oq"), "uz")
+        second = await avto.value_avto(vehicle("K-222", "S-222", "qora"), "uz")
+        again = await avto.value_avto(vehicle("K-222", "S-222", "qora"), "uz")
+        return first, second, again
+
+    first, second, again = asyncio.run(scenario())
+    assert valuation_cache._counters["hits"] == 2
+    assert second["estimated_min_price"] == first["estimated_min_price"]
+    assert "K-111" in first["reason_uz"]
+    assert "K-222" in second["reason_uz"] and "S-222" in second["reason_uz"]
+    assert "K-111" not in second["reason_uz"] and "S-111" not in second["reason_uz"]
+    # The same body again reuses its own explanation
+    assert again == second
+    assert len(llm.calls) == 2
+
+
+def test_cached_property_explanation_names_only_its_own_address(llm, monkeypatch):
+    async def comparables(latitude, longitude, area, building_type):
+        return [{"price_usd": 70_000, "area": 100}]
+
+    monkeypatch.setattr(listings, "find_comparables", comparables)
+
+    def flat(address):
+        return {"address": address, "latitude": 41.311, "longitude": 69.279, "area": {"actualLandArea": 100}, "type": "FIRST_LINE"}
+
+    async def scenario():
+        first = await uy_joy.value_uy_joy(flat("Yunusobod 4-kvartal, 12-uy"), "uz")
+        second = await uy_joy.value_uy_joy(flat("Yunusobod 4-kvartal, 14-uy"), "uz")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert valuation_cache._counters["hits"] == 1
+    assert second["estimated_max_price"] == first["estimated_max_price"] == 900_000_000
+    assert "14-uy" in second["reason"]["uz"] and "12-uy" not in second["reason"]["uz"]
+    assert "price_usd" in second["reason"]["uz"]
+
+
+def test_vehicle_fingerprint_ignores_the_engine_serial_number():
+    cars = [
+        {"MODEL": "Chevrolet Cobalt", "YEAR": "2020", "MOTOR": "4G15K123456"},
+        {"MODEL": "chevrolet  cobalt", "YEAR": 2020, "MOTOR": "B15D2 987654"},
+        {"MODEL": "Chevrolet Cobalt", "YEAR": "2020"},
+    ]
+    assert {valuation_cache.vehicle_fingerprint(car) for car in cars} == {("chevrolet cobalt", "2020", None)}
+    assert valuation_cache.vehicle_fingerprint({**cars[0], "ENGINE": "1.5"}) == ("chevrolet cobalt", "2020", "1.5")
+
+
+def test_avto_never_reads_the_engine_volume_from_motor(llm, monkeypatch):
+    engines = []
+
+    async def comparables(model, year, engine=None):
+        engines.append(engine)
+        return None
+
+    monkeypatch.setattr(listings, "find_vehicle_comparables", comparables)
+    for model in ("Chevrolet Cobalt", "Chevrolet Cobalt 1.5"):
+        # Without comparables the valuation needs the (stubbed out) valuation agent
+        with pytest.raises(HTTPException):
+            asyncio.run(avto.value_avto({**vehicle("K-1", "S-1", "oq"), "MODEL": model, "MOTOR": "4G15K123456"}, "uz"))
+    assert engines == [None, "1.5"]
@@ -0,0 +1,192 @@
+import asyncio
+import json
+from typing import Any, List, Tuple
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import xmed
+
+TURNS = 60
+
+
+class RecordingModel(BaseChatModel):
+    """Answers every call with a fixed-size JSON reply and records the tokens it was sent."""
+
+    sent: List[int] = []
+    systems: List[int] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "RecordingModel":
+        return self
+
+    def _generate(self, messages: List[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        self.sent.append(count_tokens_approximately(messages))
+        self.systems.append(sum(isinstance(m, SystemMessage) for m in messages))
+        answer = {"answer": "Shifokorga murojaat qiling. " * 20, "doctor_id": None}
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=json.dumps(answer)))])
+
+
+def test_per_turn_tokens_stay_flat(monkeypatch):
+    model = RecordingModel(sent=[], systems=[])
+    monkeypatch.setattr(xmed, "get_llm", lambda *args: model)
+    monkeypatch.setattr(xmed, "_agent", None)
+
+    async def session():
+        for n in range(TURNS):
+            # Not a classified complaint, so no doctors are prefetched
+            response = await xmed.handle_xmed(xmed.XMedRequest(session_id="flat-tokens", message=f"Savolim bor, {n}-xabar"))
+            assert json.loads(response.body)["answer"]
+
+    asyncio.run(session())
+    assert len(model.sent) == TURNS
+    # The prompt is sent once per call, never accumulated in the thread
+    assert set(model.systems) == {1}
+    # Growth stops at the history budget: the late turns cost what the middle ones did
+    late, middle = model.sent[-10:], model.sent[TURNS // 2 - 5:TURNS // 2 + 5]
+    assert max(late) <= max(middle) + 50
+    assert max(model.sent) <= count_tokens_approximately([SystemMessage(content=xmed.SYSTEM_PROMPT)]) + xmed.HISTORY_TOKENS + 200
+    assert model.sent[-1] > model.sent[0]
+
+
+def test_compact_history_keeps_tool_calls_with_their_results(monkeypatch):
+    monkeypatch.setattr(xmed, "HISTORY_TOKENS", 200)
+    messages: List[BaseMessage] = [SystemMessage(content="old prompt")]
+    for n in range(30):
+        messages += [
+            HumanMessage(content=f"savol {n} " * 10),
+            AIMessage(content="", tool_calls=[{"name": "search_doctor", "args": {}, "id": f"call_{n}"}]),
+            ToolMessage(content="[]" * 20, name="search_doctor", tool_call_id=f"call_{n}"),
+            AIMessage(content=f"javob {n} " * 10),
+        ]
+    messages.append(HumanMessage(content="oxirgi savol"))
+
+    compact = xmed.compact_history(messages)
+    assert compact[-1].content == "oxirgi savol"
+    assert isinstance(compact[0], HumanMessage)
+    assert not any(isinstance(m, SystemMessage) for m in compact)
+    assert count_tokens_approximately(compact[:-1]) <= 200
+    calls = {c["id"] for m in compact if isinstance(m, AIMessage) for c in m.tool_calls}
+    results = {m.tool_call_id for m in compact if isinstance(m, ToolMessage)}
+    assert calls == results
+
+
+def feed_all(chunks: List[str]) -> List[str]:
+    stream = xmed.AnswerStream()
+    return [stream.feed(chunk) for chunk in chunks]
+
+
+def test_answer_stream_waits_for_split_keys_and_escapes():
+    out = feed_all(['{"ans', 'wer"', ' : "Sa', 'lom\\', 'n', 'do\\u04', '1a', 'ktor\\"', '!", "doctor_id": 7}'])
+    assert "".join(out) == 'Salom\ndoКktor"!'
+    assert out[:2] == ["", ""]
+
+
+def test_answer_stream_decodes_a_split_surrogate_pair():
+    out = feed_all(['{"answer": "Salom ', "\\ud83d", "\\ude00", " doktor", '"}'])
+    assert out == ["Salom ", "", "😀", " doktor", ""]
+    assert xmed.sse("token", {"text": "".join(out)}).encode("utf-8")
+    # The low half split inside its own escape
+    assert "".join(feed_all(['{"answer": "', "\\ud83d\\u", "de", "00", '"'])) == "😀"
+
+
+def test_answer_stream_replaces_a_lone_surrogate():
+    text = "".join(feed_all(['{"answer": "a\\ud83d b\\ude00c"}']))
+    assert text == "a� b�c"
+    text.encode("utf-8")
+
+
+def test_answer_stream_ignores_the_other_fields():
+    out = feed_all(['{"doctor_id": 3, "answer_2": "x", "answer": "ok", "answer_3": "#fill"}'])
+    assert "".join(out) == "ok"
+
+
+FOUND = {"results": [{"id": 42, "fullName": "Karimova Nodira", "speciality": [{"slug": "neurologist"}]}]}
+
+
+class ScriptedModel(BaseChatModel):
+    """Streams one scripted reply per call, a chunk at a time."""
+
+    replies: List[Any] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "ScriptedModel":
+        return self
+
+    def _generate(self, messages: List[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        chunks = list(self._stream(messages))
+        message = chunks[0].message
+        for chunk in chunks[1:]:
+            message = message + chunk.message
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any):
+        reply = self.replies.pop(0)
+        if isinstance(reply, dict):
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": "search_doctor", "args": json.dumps(reply), "id": "call_1", "index": 0},
+            ]))
+            return
+        for chunk in reply:
+            if run_manager:
+                run_manager.on_llm_new_token(chunk)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+
+def read_events(body: str) -> List[Tuple[str, Any]]:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_stream_route_sends_tool_token_and_final_events(monkeypatch):
+    answer = ['{"ans', 'wer": "Nevrolog', 'ga boring ', '\\ud83d', '\\ude00', '", "doctor_id": 42', ', "answer_2": null}']
+    model = ScriptedModel(replies=[{"speciality": ["neurologist"]}, answer])
+    monkeypatch.setattr(xmed, "get_llm", lambda *args: model)
+    monkeypatch.setattr(xmed, "_agent", None)
+
+    async def search(*args, **kwargs):
+        return FOUND
+
+    monkeypatch.setattr(xmed.doctors, "search", search)
+    app = FastAPI()
+    app.include_router(xmed.router)
+
+    with TestClient(app) as client:
+        response = client.post("/webhook/xmed/stream", json={"session_id": "sse", "message": "Salom"})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    # Valid UTF-8 all the way through (a lone surrogate would have broken the stream)
+    events = read_events(response.content.decode("utf-8"))
+
+    kinds = [kind for kind, _ in events]
+    assert kinds[:2] == ["tool", "tool"]
+    assert events[0][1]["status"] == "start" and events[0][1]["input"]["speciality"] == ["neurologist"]
+    assert events[1][1] == {"status": "end", "name": "search_doctor", "found": 1}
+    assert "".join(data["text"] for kind, data in events if kind == "token") == "Nevrologga boring 😀"
+    assert events[-1] == ("final", {"answer": "Nevrologga boring 😀", "doctor_id": 42, "answer_2": None, "answer_3": None, "answer_4": None})
+
+
+def test_stream_route_reports_agent_failure(monkeypatch):
+    model = ScriptedModel(replies=[])
+    monkeypatch.setattr(xmed, "get_llm", lambda *args: model)
+    monkeypatch.setattr(xmed, "_agent", None)
+    app = FastAPI()
+    app.include_router(xmed.router)
+
+    with TestClient(app) as client:
+        events = read_events(client.post("/webhook/xmed/stream", json={"session_id": "sse-error", "message": "Salom"}).text)
+    assert events[-1][0] == "error"
+    assert events[-1][1]["detail"].startswith("Medical Agent failed")
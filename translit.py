@@ -0,0 +1,105 @@
+import re
+from typing import Any
+
+# Uzbek Latin -> Cyrillic. The model answers in Latin only; the Cyrillic variant is
+# produced here instead of asking for (and paying for) a second copy of the text.
+
+APOSTROPHES = "‘’'ʻʼ`"
+
+# Multi-letter sequences and letters whose Cyrillic form depends on context
+_SEQUENCES = {
+    "yo‘": "йў",
+    "o‘": "ў",
+    "g‘": "ғ",
+    "s‘h": "сҳ",
+    "sh": "ш",
+    "ch": "ч",
+    "yo": "ё",
+    "yu": "ю",
+    "ya": "я",
+    "ye": "е",
+}
+
+_LETTERS = {
+    "a": "а", "b": "б", "c": "с", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "ҳ",
+    "i": "и", "j": "ж", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п",
+    "q": "қ", "r": "р", "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "х",
+    "y": "й", "z": "з",
+}
+_TABLE = str.maketrans({**_LETTERS, **{k.upper(): v.upper() for k, v in _LETTERS.items()}})
+
+_A = f"[{APOSTROPHES}]"
+_SEQUENCE_RE = re.compile(
+    "|".join([
+        # ё/ю/я/ў/ғ/ш/ч and friends, longest first
+        *(k.replace("‘", _A) for k in sorted(_SEQUENCES, key=len, reverse=True)),
+        # э at the start of a word and after a vowel, е elsewhere
+        rf"(?<![A-Za-z{APOSTROPHES}])e",
+        r"(?<=[aeiou])e",
+        # tutuq belgisi between letters (ma'lumot -> маълумот)
+        rf"(?<=[a-z]){_A}(?=[a-z])",
+    ]),
+    re.IGNORECASE,
+)
+
+# Tags and entities are copied as they are
+_MARKUP_RE = re.compile(r"(<[^>]*>|&#?\w+;)")
+
+# Letters (and apostrophes) that may still combine with what comes next in a stream
+_WORD_TAIL_RE = re.compile(rf"[A-Za-z{APOSTROPHES}]+$")
+
+def _replace(m: "re.Match[str]") -> str:
+    s = m.group(0)
+    low = s.lower()
+    if low[0] in APOSTROPHES:
+        return "ъ"
+    # A lone "e" only matches where it is pronounced э
+    out = "э" if low == "e" else _SEQUENCES[re.sub(_A, "‘", low)]
+    letters = [c for c in s if c.isalpha()]
+    if len(letters) > 1 and all(c.isupper() for c in letters):
+        return out.upper()
+    if letters[0].isupper():
+        return out[0].upper() + out[1:]
+    return out
+
+def to_cyrillic(text: str) -> str:
+    """Plain Uzbek Latin text to Cyrillic; digits and punctuation are kept."""
+    if not text:
+        return text
+    return _SEQUENCE_RE.sub(_replace, text).translate(_TABLE)
+
+def to_cyrillic_html(html: Any) -> Any:
+    """Transliterates the text of an HTML fragment, leaving tags, attributes and entities untouched."""
+    if not isinstance(html, str) or not html:
+        return html
+    parts = _MARKUP_RE.split(html)
+    # Odd indexes are the markup captured by the split
+    return "".join(p if i % 2 else to_cyrillic(p) for i, p in enumerate(parts))
+
+class CyrillicStream:
+    """Incremental to_cyrillic_html for streamed model output.
+
+    Text is released only up to a point where nothing later can change it: after the last
+    complete word and outside of any unfinished tag or entity."""
+
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, chunk: str) -> str:
+        text = self.pending + chunk
+        cut = len(text)
+        lt = text.rfind("<")
+        if lt > text.rfind(">"):
+            cut = lt
+        amp = text.rfind("&", 0, cut)
+        if amp != -1 and ";" not in text[amp:cut] and re.fullmatch(r"&#?\w*", text[amp:cut]):
+            cut = amp
+        tail = _WORD_TAIL_RE.search(text, 0, cut)
+        if tail:
+            cut = tail.start()
+        self.pending = text[cut:]
+        return to_cyrillic_html(text[:cut])
+
+    def flush(self) -> str:
+        text, self.pending = self.pending, ""
+        return to_cyrillic_html(text)
@@ -1,53 +1,75 @@
 import os
 import json
-import httpx
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import JSONResponse
 from pydantic import RootModel
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
+
+import cbu_rates
+import listings
+import pipeline
+import prompts
+import reasons
+import valuation_cache
+from llm_clients import get_llm
 
 router = APIRouter()
 
 # Load environment variables
 load_dotenv()
-API_KEY = os.getenv("OPENAI_API_KEY")
 
-if not API_KEY:
-    raise RuntimeError("OPENAI_API_KEY is not set")
+# Static prompts (cacheable prefix); the exchange rate is sent in the trailing parameters message
+SEARCH_PROMPT = prompts.register("uy_joy.search", """Siz internet qidiruv agentisiz. Vazifa — O‘zbekiston bozorida berilgan mulkka o‘xshash e’lonlarni topish.
+Foydalaniladigan platformalar: olx.uz, domtut.uz, realt24.uz, uybor.uz, etc.
+
+FAQAT JSON FORMATIDA CHIQARING.
+{
+ "status": "ok",
+ "listings": [
+   { "title": "...", "price_usd": ..., "area_m2": ..., "link": "..." }
+ ]
+}""")
+
+VALUATION_PROMPT = prompts.register("uy_joy.valuation", """Siz O‘zbekiston bozorida ko‘chmas mulk narxini aniqlaydigan kredit baholash agentisiz.
+Vazifa: kiruvchi ma’lumotlar va web qidiruvdan kelgan e’lonlar asosida obyektning bozor narxini aniqlash.
+
+LTV (Kreditning qiymatga nisbati) ko'rsatkichi 64% gacha ijobiy.
+
+USD/UZS Kursi: oxirgi xabardagi "usd_rate" parametri.
+
+CHIQISH FORMATI (FAQAT JSON):
+{
+ "estimated_min_price": <raqam_uzs>,
+ "estimated_max_price": <raqam_uzs>,
+ "reason": "<HTML, oxirgi xabardagi "language" parametridagi tilda>"
+}
+
+Hech qachon JSON tashqarisida matn qaytarmang.""")
+
+# reasons language -> key in the response "reason" object
+REASON_KEYS = {"uz": "uz", "cyrl": "uz_cyrl", "ru": "ru", "en": "en"}
 
 # --- Models ---
 class WebhookRequest(RootModel):
     root: Dict[str, Any]
 
-# --- Helpers ---
-async def get_usd_rate() -> float:
-    """Fetches the current USD to UZS exchange rate from CBU API."""
-    url = "https://cbu.uz/uz/arkhiv-kursov-valyut/json/"
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-            # Find USD
-            for item in data:
-                if item.get("Ccy") == "USD":
-                    return float(item.get("Rate", 0))
-    except Exception as e:
-        print(f"Error fetching exchange rate: {e}")
-    return 12850.0  # Fallback rate
-
 # --- Core Logic ---
 @router.post("/webhook/uy-joy")
-async def handle_uy_joy(payload: WebhookRequest):
+async def handle_uy_joy(payload: WebhookRequest, language: Optional[str] = Query(None)):
     raw_payload = payload.root
     
     if isinstance(raw_payload, list):
         body = raw_payload[0] if raw_payload else {}
     else:
         body = raw_payload.get("body") if isinstance(raw_payload.get("body"), dict) else raw_payload
+
+    # Only the requested explanation is generated (uz by default); "all" fans out concurrently
+    language = reasons.normalize_language(language or body.get("language"))
+    return JSONResponse(content=await value_uy_joy(body, language))
+
+async def value_uy_joy(body: Dict[str, Any], language: str) -> Dict[str, Any]:
+    """One property valuation (shared by the webhook and the batch endpoint)."""
     address = body.get("address", "---")
     area_info = body.get("area", {})
     actual_land_area = area_info.get("actualLandArea", 0)
@@ -55,19 +77,29 @@ async def handle_uy_joy(payload: WebhookRequest):
     latitude = body.get("latitude")
     longitude = body.get("longitude")
 
-    # 1. Search Agent - Simulate the market research
-    llm_search = ChatOpenAI(model="gpt-4o", api_key=API_KEY, temperature=0.3)
-    
-    search_system_prompt = """Siz internet qidiruv agentisiz. Vazifa — O‘zbekiston bozorida berilgan mulkka o‘xshash e’lonlarni topish.
-Foydalaniladigan platformalar: olx.uz, domtut.uz, realt24.uz, uybor.uz, etc.
+    # What the explanation may say about this property (address); never shared between requests
+    user_natija = f"""
+"user_natija": {{
+    "address": "{address}",
+    "actualLandArea": {actual_land_area},
+    "type": "{building_type}"
+}}"""
+
+    # 0. Already valued (same fingerprint): reused, rescaled to the current USD rate if it moved
+    fingerprint = valuation_cache.property_fingerprint(body)
+    cached = await valuation_cache.lookup("uy_joy", fingerprint, user_natija, body.get("rateDate"))
+    if cached is not None:
+        valuation_id, result = cached
+        try:
+            texts = await reasons.get_reasons(valuation_id, "uy_joy", language)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Valuation failed: {str(e)}")
+        return {"valuation_id": valuation_id, **result, "reason": {REASON_KEYS[lang]: text for lang, text in texts.items()}}
 
-FAQAT JSON FORMATIDA CHIQARING.
-{
- "status": "ok",
- "listings": [
-   { "title": "...", "price_usd": ..., "area_m2": ..., "link": "..." }
- ]
-}"""
+    # 1. Search Agent - Simulate the market research
+    llm_search = get_llm("gpt-4o", 0.3)
     
     search_user_message = f"""Adress: {address}
 Actual Land Area: {actual_land_area}
@@ -76,68 +108,86 @@ Coords: {latitude}, {longitude}
 
 Toshkent bo'yicha kamida 5 ta o'xshash elonlarni toping."""
 
-    try:
-        search_result = llm_search.invoke([
-            SystemMessage(content=search_system_prompt),
-            HumanMessage(content=search_user_message)
-        ])
+    async def search() -> Dict[str, Any]:
+        # Comparables from the local listings dump when there is one; the LLM search otherwise
+        comparables = await listings.find_comparables(latitude, longitude, actual_land_area, building_type)
+        if comparables:
+            return {"status": "ok", "source": "local_listings", "listings": comparables}
+
+        search_result = await prompts.ainvoke(llm_search, "uy_joy.search", search_user_message)
         # Try to parse JSON from search result
         search_text = search_result.content.strip()
         if "```json" in search_text:
             search_text = search_text.split("```json")[1].split("```")[0].strip()
-        market_data = json.loads(search_text)
-    except Exception as e:
-        print(f"Search agent parsing error: {e}")
-        market_data = {"status": "no_listing_found", "listings": []}
+        return json.loads(search_text)
 
-    # 2. Get Exchange Rate
-    usd_rate = await get_usd_rate()
+    # 2. Get Exchange Rate (doesn't depend on the search, so it runs alongside it)
+    async def rate() -> float:
+        return await cbu_rates.get_usd_rate(body.get("rateDate"))
 
     # 3. Valuation Agent
-    llm_val = ChatOpenAI(model="gpt-4o", api_key=API_KEY, temperature=0.3)
-    
-    valuation_system_prompt = f"""Siz O‘zbekiston bozorida ko‘chmas mulk narxini aniqlaydigan kredit baholash agentisiz.
-Vazifa: kiruvchi ma’lumotlar va web qidiruvdan kelgan e’lonlar asosida obyektning bozor narxini aniqlash.
-
-LTV (Kreditning qiymatga nisbati) ko'rsatkichi 64% gacha ijobiy.
-
-USD/UZS Kursi: {usd_rate}
-
-CHIQISH FORMATI (FAQAT JSON):
-{{
- "estimated_min_price": <raqam_uzs>,
- "estimated_max_price": <raqam_uzs>,
- "reason": {{
-    "uz": "<HTML>",
-    "uz_cyrl": "<HTML>",
-    "ru": "<HTML>",
-    "en": "<HTML>"
- }}
-}}
+    llm_val = get_llm("gpt-4o", 0.3)
 
-Hech qachon JSON tashqarisida matn qaytarmang."""
-
-    valuation_user_message = f"""
-"user_natija": {{
-    "address": "{address}",
-    "actualLandArea": {actual_land_area},
-    "type": "{building_type}"
-}},
-"web_natija": {json.dumps(market_data, ensure_ascii=False)}
+    async def valuation(search: Dict[str, Any], rate: float) -> Tuple[str, Dict[str, Any]]:
+        valuation_user_message = f"""{user_natija},
+"web_natija": {json.dumps(search, ensure_ascii=False, default=str)}
 """
-
-    try:
-        val_result = llm_val.invoke([
-            SystemMessage(content=valuation_system_prompt),
-            HumanMessage(content=valuation_user_message)
-        ])
+        val_result = await prompts.ainvoke(
+            llm_val, "uy_joy.valuation", valuation_user_message,
+            {"usd_rate": rate, "language": reasons.LANGUAGES[reasons.model_language(language)]},
+        )
         
         val_text = val_result.content.strip()
         if "```json" in val_text:
             val_text = val_text.split("```json")[1].split("```")[0].strip()
             
         final_json = json.loads(val_text)
-        return JSONResponse(content=final_json)
-        
+
+        reason = final_json.pop("reason", None)
+        valuation_id = await reasons.new_valuation(
+            "uy_joy",
+            {
+                "input": user_natija,
+                # Kept apart from the input text so a cached valuation can reuse them for another property
+                "listings": search,
+                "usd_rate": rate,
+                "estimated_min_price": final_json.get("estimated_min_price"),
+                "estimated_max_price": final_json.get("estimated_max_price"),
+            },
+            reason,
+            reasons.model_language(language),
+        )
+        return valuation_id, final_json
+
+    # 4. Explanations in the requested language(s)
+    async def explain(valuation: Tuple[str, Dict[str, Any]]) -> Dict[str, str]:
+        return await reasons.get_reasons(valuation[0], "uy_joy", language)
+
+    try:
+        results = await pipeline.run("uy_joy", [
+            pipeline.Stage("search", search, timeout=pipeline.SEARCH_TIMEOUT,
+                           fallback=lambda e: {"status": "no_listing_found", "listings": []}),
+            pipeline.Stage("rate", rate, timeout=pipeline.RATE_TIMEOUT, fallback=lambda e: cbu_rates.get_rate("USD")),
+            pipeline.Stage("valuation", valuation, deps=("search", "rate"), timeout=pipeline.LLM_TIMEOUT),
+            pipeline.Stage("explain", explain, deps=("valuation",), timeout=pipeline.LLM_TIMEOUT),
+        ])
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Valuation failed: {str(e)}")
+
+    valuation_id, final_json = results["valuation"]
+    await valuation_cache.store("uy_joy", fingerprint, valuation_id, final_json, body.get("rateDate"))
+    return {"valuation_id": valuation_id, **final_json, "reason": {REASON_KEYS[lang]: text for lang, text in results["explain"].items()}}
+
+@router.get("/webhook/uy-joy/{valuation_id}/reason")
+async def uy_joy_reason(valuation_id: str, language: str = Query("uz")):
+    """Explanation of an earlier valuation in another language, generated once and cached."""
+    language = reasons.normalize_language(language)
+    try:
+        texts = await reasons.get_reasons(valuation_id, "uy_joy", language)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Reason generation failed: {str(e)}")
+    return JSONResponse(content={"valuation_id": valuation_id, "reason": {REASON_KEYS[lang]: text for lang, text in texts.items()}})
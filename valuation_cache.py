@@ -0,0 +1,214 @@
+import os
+import math
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, HTTPException, Query
+from pydantic import RootModel
+
+import cbu_rates
+import listings
+import pricing
+import reasons
+
+router = APIRouter()
+
+# Load environment variables
+load_dotenv()
+
+# Finished valuations keyed by an asset fingerprint rather than the exact request, so the
+# same model/year or the same spot and size skip the search and valuation calls. Prices
+# are UZS, so a cached entry is moved to a new USD rate instead of being recomputed.
+CACHE_SIZE = int(os.getenv("VALUATION_CACHE_SIZE", "5000"))
+# Lifetime in CBU rate days (the wall clock is only a backstop for a stale rate feed)
+CACHE_DAYS = int(os.getenv("VALUATION_CACHE_DAYS", "7"))
+GEOHASH_PRECISION = int(os.getenv("VALUATION_CACHE_GEOHASH_PRECISION", "7"))
+# Property areas in the same bucket differ by less than AREA_STEP (10%)
+AREA_STEP = float(os.getenv("VALUATION_CACHE_AREA_STEP", "0.1"))
+
+PRICE_FIELDS = ("estimated_min_price", "estimated_max_price")
+KINDS = {"avto": "avto", "uy-joy": "uy_joy", "uy_joy": "uy_joy"}
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# (kind, fingerprint) -> entry
+_entries: "OrderedDict[Tuple[str, Hashable], Dict[str, Any]]" = OrderedDict()
+_counters = {"hits": 0, "rescaled": 0, "misses": 0, "uncacheable": 0, "stored": 0, "expired": 0, "evictions": 0, "invalidated": 0}
+
+# --- Fingerprints ---
+def geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, x = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if x >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+def _number(value: Any) -> Optional[float]:
+    try:
+        n = float(str(value).replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+    return n if math.isfinite(n) else None
+
+# A fingerprint is None when its key fields are missing: such requests are never cached,
+# or every incomplete body would share one price
+def vehicle_fingerprint(body: Dict[str, Any]) -> Optional[Hashable]:
+    model = listings.normalize_model(body.get("MODEL"))
+    year = str(body.get("YEAR") or "").strip()
+    if not model or not year:
+        return None
+    # Engine volume, never the MOTOR serial number: that would make every car unique
+    return (model, year, listings.vehicle_engine(body))
+
+def property_fingerprint(body: Dict[str, Any]) -> Optional[Hashable]:
+    lat, lon = _number(body.get("latitude")), _number(body.get("longitude"))
+    if lat is not None and lon is not None and -90 <= lat <= 90 and -180 <= lon <= 180:
+        place = geohash(lat, lon)
+    else:
+        place = " ".join(str(body.get("address") or "").lower().split())
+    area = _number((body.get("area") or {}).get("actualLandArea"))
+    if not place or not area or area <= 0:
+        return None
+    bucket = round(math.log(area) / math.log1p(AREA_STEP))
+    return (place, bucket, listings.normalize_type(body.get("type")))
+
+# --- Cache ---
+def _rate_day(on_date: Any) -> date:
+    try:
+        iso_date = cbu_rates.normalize_date(on_date) or cbu_rates.rates_date()
+    except ValueError:
+        iso_date = cbu_rates.rates_date()
+    return date.fromisoformat(iso_date) if iso_date else date.today()
+
+def _expired(entry: Dict[str, Any], rate_day: date) -> bool:
+    return (
+        abs((rate_day - entry["rate_day"]).days) > CACHE_DAYS
+        or time.time() - entry["stored_at"] > (CACHE_DAYS + 1) * 86400
+    )
+
+async def store(kind: str, fingerprint: Optional[Hashable], valuation_id: str, result: Dict[str, Any], on_date: Any = None) -> None:
+    """Keeps a finished valuation (prices must be numbers) for later requests with the same fingerprint."""
+    if fingerprint is None or not all(isinstance(result.get(f), (int, float)) for f in PRICE_FIELDS):
+        return
+    context = await reasons.get_valuation(valuation_id, kind)
+    key = (kind, fingerprint)
+    _entries[key] = {
+        "valuation_id": valuation_id,
+        "result": dict(result),
+        "context": {k: v for k, v in context.items() if k != "kind"},
+        "usd_rate": context.get("usd_rate"),
+        "rate_day": _rate_day(on_date),
+        "stored_at": time.time(),
+    }
+    _entries.move_to_end(key)
+    _counters["stored"] += 1
+    while len(_entries) > CACHE_SIZE:
+        _entries.popitem(last=False)
+        _counters["evictions"] += 1
+
+async def lookup(kind: str, fingerprint: Optional[Hashable], request_input: str, on_date: Any = None) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """(valuation_id, result) for a cached fingerprint at the rate of `on_date`, or None.
+
+    `request_input` is this request's own part of the explanation context (the "input" the
+    handler stores). Only the same input reuses the cached explanation; another car or
+    property with the same fingerprint gets a new one, so no text names another customer's
+    chassis, colour or address."""
+    if fingerprint is None:
+        _counters["uncacheable"] += 1
+        return None
+    key = (kind, fingerprint)
+    entry = _entries.get(key)
+    if entry is None:
+        _counters["misses"] += 1
+        return None
+    if _expired(entry, _rate_day(on_date)):
+        del _entries[key]
+        _counters["expired"] += 1
+        _counters["misses"] += 1
+        return None
+    _entries.move_to_end(key)
+
+    rate = await cbu_rates.get_usd_rate(on_date)
+    if rate == entry["usd_rate"] and entry["context"].get("input") == request_input:
+        try:
+            await reasons.get_valuation(entry["valuation_id"], kind)
+            _counters["hits"] += 1
+            return entry["valuation_id"], dict(entry["result"])
+        except HTTPException:
+            # Explanations expired before the valuation did: register it again below
+            pass
+
+    # Same UZS value in USD terms, moved to the requested rate; only the explanation is redone,
+    # from the cached listings and figures plus this request's own input
+    scale = rate / entry["usd_rate"] if entry["usd_rate"] else 1.0
+    result = dict(entry["result"])
+    for field in PRICE_FIELDS:
+        result[field] = int(round(result[field] * scale / pricing.ROUND_TO) * pricing.ROUND_TO)
+    context = {**entry["context"], "input": request_input, "usd_rate": rate, **{f: result[f] for f in PRICE_FIELDS}}
+    if context.get("pricing"):
+        # The explanation is regenerated from these figures, so they move with the rate too
+        context["pricing"] = {**context["pricing"], "usd_rate": rate, **{f: result[f] for f in PRICE_FIELDS}}
+    valuation_id = await reasons.new_valuation(kind, context)
+    entry.update(valuation_id=valuation_id, result=result, context=context, usd_rate=rate)
+    _counters["hits" if scale == 1.0 else "rescaled"] += 1
+    return valuation_id, dict(result)
+
+def invalidate(kind: Optional[str] = None, fingerprint: Optional[Hashable] = None) -> int:
+    if fingerprint is not None:
+        removed = 1 if _entries.pop((kind, fingerprint), None) is not None else 0
+    else:
+        keys = [k for k in _entries if kind is None or k[0] == kind]
+        for k in keys:
+            del _entries[k]
+        removed = len(keys)
+    _counters["invalidated"] += removed
+    return removed
+
+def _kind(value: str) -> str:
+    kind = KINDS.get(value)
+    if kind is None:
+        raise HTTPException(status_code=400, detail=f"Unknown valuation kind '{value}'. Use avto or uy-joy.")
+    return kind
+
+class AssetRequest(RootModel):
+    root: Dict[str, Any]
+
+@router.delete("/valuation-cache")
+async def clear_cache(kind: Optional[str] = Query(None)):
+    """Drops every cached valuation, or only those of one kind (avto, uy-joy)."""
+    return {"removed": invalidate(_kind(kind) if kind else None)}
+
+@router.post("/valuation-cache/{kind}/invalidate")
+async def invalidate_asset(kind: str, payload: AssetRequest):
+    """Drops the cached valuation matching a webhook body (same fingerprint)."""
+    kind = _kind(kind)
+    body = payload.root.get("body") if isinstance(payload.root.get("body"), dict) else payload.root
+    fingerprint = vehicle_fingerprint(body) if kind == "avto" else property_fingerprint(body)
+    if fingerprint is None:
+        raise HTTPException(status_code=400, detail="The body is missing the fields a valuation is cached by.")
+    return {"removed": invalidate(kind, fingerprint), "fingerprint": list(fingerprint)}
+
+def cache_stats() -> Dict[str, Any]:
+    lookups = _counters["hits"] + _counters["rescaled"] + _counters["misses"]
+    return {
+        **_counters,
+        "hit_rate": round((_counters["hits"] + _counters["rescaled"]) / lookups, 3) if lookups else None,
+        "entries": len(_entries),
+        "size": CACHE_SIZE,
+        "days": CACHE_DAYS,
+    }
@@ -1,26 +1,33 @@
 import os
 import json
-import httpx
+import time
 import re
-from typing import Any, Dict, List, Optional
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
 from dotenv import load_dotenv
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage, HumanMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
 from langchain_core.tools import tool
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.messages.ai import add_usage
 from langgraph.prebuilt import create_react_agent
 
+import checkpoints
+import doctors
+import prompts
+import symptoms
+from llm_clients import get_llm
+
 router = APIRouter()
 
 # Load environment variables
 load_dotenv()
-API_KEY = os.getenv("OPENAI_API_KEY")
 
-if not API_KEY:
-    raise RuntimeError("OPENAI_API_KEY is not set")
+# Earlier turns sent to the model, newest first, up to this many (approximate) tokens;
+# the current turn is always sent whole
+HISTORY_TOKENS = int(os.getenv("XMED_HISTORY_TOKENS", "3000"))
 
 # --- Models ---
 class XMedRequest(BaseModel):
@@ -39,30 +46,11 @@ async def search_doctor(page: str = "1", pageSize: str = "3", name: str = "", sp
         name: Full or partial name of the doctor
         speciality: List of specialities (e.g. ["dentist", "surgeon"])
     """
-    url = "https://api.plusmed.uz/be/common/searchDoctor"
-    headers = {
-        "language": "uz",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "page": page,
-        "pageSize": pageSize,
-        "name": name,
-        "speciality": speciality or []
-    }
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload, headers=headers, timeout=30.0)
-            response.raise_for_status()
-            data = response.json()
-            return data
-    except Exception as e:
-        return {"error": str(e), "results": []}
+    # Local catalog mirror first; the plusmed API only when it has nothing for the query
+    return await doctors.search(page, pageSize, name, speciality)
 
 # --- Agent System Prompt ---
-SYSTEM_PROMPT = """Sen malakali doctor yordamchisisan! 
+SYSTEM_PROMPT = prompts.register("xmed.system", """Sen malakali doctor yordamchisisan! 
 Sening vazifang user yozgan shikoyatlari bo'yicha qaysi doktor unga mos kelishini aniqlash va uni to'g'ri doktorga yo'naltirish.
 
 Eng muhim qoidalar:
@@ -95,18 +83,47 @@ CHIQUVCHI FORMAT FAQAT JSON:
 Ishlash qoidalari:
 - savol:To'lov qilish va hisobni to'ldirish -> javob: "answer": "#fill", qolganlar null.
 - Chat davomida mavzudan tashqari savullar bo'lsa "Men faqat mavzu doirasida javob bera olaman" deysan.
-"""
+""")
 
 # --- Agent Initialization ---
-llm = ChatOpenAI(model="gpt-4o", api_key=API_KEY, temperature=0)
-checkpointer = MemorySaver()
+# Bounded, persistent conversation store (XMED_CHECKPOINTER=sqlite|memory)
+checkpointer = checkpoints.create_checkpointer()
+
+def compact_history(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """Current turn verbatim; earlier turns, newest first, while they fit in HISTORY_TOKENS.
+
+    Cut at a user message, so a tool call is never separated from its result. System
+    messages stored by older sessions are dropped (the prompt is added per call)."""
+    history = [m for m in messages if not isinstance(m, SystemMessage)]
+    current = max((i for i, m in enumerate(history) if isinstance(m, HumanMessage)), default=0)
+    earlier = trim_messages(
+        history[:current],
+        max_tokens=HISTORY_TOKENS,
+        token_counter=count_tokens_approximately,
+        strategy="last",
+        start_on="human",
+    )
+    return earlier + history[current:]
 
-# Simplified agent without modifiers for better compatibility
-agent_executor = create_react_agent(
-    model=llm, 
-    tools=[search_doctor], 
-    checkpointer=checkpointer
-)
+def agent_prompt(state: Dict[str, Any]) -> List[BaseMessage]:
+    # The system prompt lives here, not in the checkpointed history, so a session carries
+    # it once per model call instead of once per turn
+    return [SystemMessage(content=SYSTEM_PROMPT)] + compact_history(state["messages"])
+
+_agent: Any = None
+
+def get_agent():
+    """The agent on the current pooled client; rebuilt after llm_clients.close_clients()."""
+    global _agent
+    llm = get_llm("gpt-4o", 0)
+    if _agent is None or _agent[0] is not llm:
+        _agent = (llm, create_react_agent(
+            model=llm, 
+            tools=[search_doctor], 
+            prompt=agent_prompt,
+            checkpointer=checkpointer
+        ))
+    return _agent[1]
 
 # --- Helpers ---
 def extract_json(text: str) -> Dict[str, Any]:
@@ -123,32 +140,180 @@ def extract_json(text: str) -> Dict[str, Any]:
     except:
         return {"answer": text, "doctor_id": None, "answer_2": None, "answer_3": None, "answer_4": None}
 
+async def turn_messages(message: str) -> List[BaseMessage]:
+    """The user message, plus a search_doctor call and its result when the complaint maps to a
+    speciality locally, so the model can answer in one call instead of choosing and searching."""
+    messages: List[BaseMessage] = [HumanMessage(content=message)]
+    specialities = symptoms.classify(message)
+    if not specialities:
+        return messages
+    args = {"page": "1", "pageSize": "3", "name": "", "speciality": specialities}
+    found = await doctors.search(args["page"], args["pageSize"], args["name"], args["speciality"])
+    if not doctors.extract_doctors(found):
+        return messages
+    call_id = f"call_{uuid.uuid4().hex[:24]}"
+    messages.append(AIMessage(content="", tool_calls=[{"name": "search_doctor", "args": args, "id": call_id}]))
+    messages.append(ToolMessage(content=json.dumps(found, ensure_ascii=False), name="search_doctor", tool_call_id=call_id))
+    return messages
+
+def record_turn_usage(messages: List[BaseMessage], elapsed: float) -> None:
+    """Token usage of this turn's model calls (everything after the last user message)."""
+    current = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+    usage = None
+    for message in messages[current:]:
+        if isinstance(message, AIMessage) and message.usage_metadata:
+            usage = add_usage(usage, message.usage_metadata)
+    prompts.record_usage("xmed.system", usage, elapsed)
+
+def response_fields(text: str) -> Dict[str, Any]:
+    parsed_output = extract_json(text)
+    return {
+        "answer": parsed_output.get("answer"),
+        "doctor_id": parsed_output.get("doctor_id"),
+        "answer_2": parsed_output.get("answer_2"),
+        "answer_3": parsed_output.get("answer_3"),
+        "answer_4": parsed_output.get("answer_4")
+    }
+
+def _code_unit(escape: str) -> int:
+    """The UTF-16 code unit of a \\uXXXX escape; -1 for anything else."""
+    try:
+        return int(escape[2:6], 16) if escape.startswith("\\u") and len(escape) == 6 else -1
+    except ValueError:
+        return -1
+
+class AnswerStream:
+    """Pulls the value of the "answer" field out of the model's JSON while it is streamed,
+    decoding escapes; text after the closing quote (the other fields) is not shown."""
+
+    _START = re.compile(r'"answer"\s*:\s*"')
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos: Optional[int] = None
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        if self.done:
+            return ""
+        self.buffer += chunk
+        if self.pos is None:
+            m = self._START.search(self.buffer)
+            if not m:
+                return ""
+            self.pos = m.end()
+        out = []
+        i, text = self.pos, self.buffer
+        while i < len(text):
+            c = text[i]
+            if c == '"':
+                self.done = True
+                break
+            if c == "\\":
+                # Wait for the whole escape sequence
+                end = i + (6 if text[i + 1:i + 2] == "u" else 2)
+                if end > len(text):
+                    break
+                if 0xD800 <= _code_unit(text[i:end]) < 0xDC00:
+                    # High surrogate (emoji etc.): decoded together with the low half after it
+                    rest = text[end:end + 6]
+                    if len(rest) < 6 and (rest.startswith("\\u") or "\\u".startswith(rest)):
+                        break
+                    if 0xDC00 <= _code_unit(rest) < 0xE000:
+                        end += 6
+                try:
+                    decoded = json.loads(f'"{text[i:end]}"')
+                except ValueError:
+                    decoded = ""
+                # A surrogate without its other half can't be encoded as UTF-8
+                if any(0xD800 <= ord(ch) < 0xE000 for ch in decoded):
+                    decoded = "\ufffd"
+                out.append(decoded)
+                i = end
+                continue
+            out.append(c)
+            i += 1
+        self.pos = i
+        return "".join(out)
+
 @router.post("/webhook/xmed")
 async def handle_xmed(payload: XMedRequest):
     """XMed Integrated Portal: Medical Assistant Agent."""
     config = {"configurable": {"thread_id": payload.session_id}}
     
     try:
-        # Prepend SYSTEM_PROMPT to every request to ensure instructions are respected
-        input_data = {"messages": [
-            SystemMessage(content=SYSTEM_PROMPT),
-            HumanMessage(content=payload.message)
-        ]}
-        
-        result = await agent_executor.ainvoke(input_data, config=config)
-        
-        last_message = result["messages"][-1].content
-        parsed_output = extract_json(last_message)
-        
-        response_json = {
-            "answer": parsed_output.get("answer"),
-            "doctor_id": parsed_output.get("doctor_id"),
-            "answer_2": parsed_output.get("answer_2"),
-            "answer_3": parsed_output.get("answer_3"),
-            "answer_4": parsed_output.get("answer_4")
-        }
+        # Only the new user message (and any prefetched doctors) is stored; the system prompt
+        # is applied by agent_prompt
+        input_data = {"messages": await turn_messages(payload.message)}
+
+        start = time.perf_counter()
+        result = await get_agent().ainvoke(input_data, config=config)
+        record_turn_usage(result["messages"], time.perf_counter() - start)
         
-        return JSONResponse(content=response_json)
+        return JSONResponse(content=response_fields(result["messages"][-1].content))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Medical Agent failed: {str(e)}")
+
+def found_doctors(output: Any) -> int:
+    if isinstance(output, str):
+        try:
+            output = json.loads(output)
+        except ValueError:
+            return 0
+    return len(doctors.extract_doctors(output))
+
+def sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/webhook/xmed/stream")
+async def handle_xmed_stream(payload: XMedRequest):
+    """Same agent as /webhook/xmed, as server-sent events: "tool" (search progress), "token"
+    (text of the "answer" field as it is generated) and finally "final" with the full object."""
+    config = {"configurable": {"thread_id": payload.session_id}}
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            input_data = {"messages": await turn_messages(payload.message)}
+            # Doctors prefetched for a classified complaint are reported like a finished search
+            for message in input_data["messages"][1:]:
+                if isinstance(message, AIMessage):
+                    for call in message.tool_calls:
+                        yield sse("tool", {"status": "start", "name": call["name"], "input": call["args"]})
+                elif isinstance(message, ToolMessage):
+                    yield sse("tool", {"status": "end", "name": message.name, "found": found_doctors(message.content)})
+
+            start = time.perf_counter()
+            answer = AnswerStream()
+            agent_executor = get_agent()
+            async for event in agent_executor.astream_events(input_data, config=config, version="v2"):
+                kind, data = event["event"], event["data"]
+                if kind == "on_chat_model_stream":
+                    chunk = data["chunk"].content
+                    text = answer.feed(chunk) if isinstance(chunk, str) else ""
+                    if text:
+                        yield sse("token", {"text": text})
+                elif kind == "on_chat_model_end":
+                    # A model call after a tool result writes its own answer
+                    answer = AnswerStream()
+                elif kind == "on_tool_start":
+                    yield sse("tool", {"status": "start", "name": event["name"], "input": data.get("input")})
+                elif kind == "on_tool_end":
+                    output = getattr(data.get("output"), "content", data.get("output"))
+                    yield sse("tool", {"status": "end", "name": event["name"], "found": found_doctors(output)})
+
+            state = await agent_executor.aget_state(config)
+            messages = state.values["messages"]
+            record_turn_usage(messages, time.perf_counter() - start)
+            yield sse("final", response_fields(messages[-1].content))
+        except Exception as e:
+            yield sse("error", {"detail": f"Medical Agent failed: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def checkpointer_stats() -> Dict[str, Any]:
+    return checkpoints.checkpoint_stats(checkpointer)